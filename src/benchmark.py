@@ -0,0 +1,329 @@
+"""
+ベンチマーク
+ネットワークに接続せずに、ランダムに作成したwallet・chainで主要な処理の速度を計測し、結果をjsonで出力する
+コミットごとに結果を保存して比較する
+
+python benchmark.py -o results.json
+python benchmark.py --quick --only proof_of_work,valid_chain
+"""
+import json
+import logging
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+
+import blockchain
+import blockchain_server
+import difficulty
+import miner
+import models
+import validator
+import verifier
+import wallet
+import wire
+
+# 結果の形式のバージョン（項目を変えた場合は上げる）
+BENCHMARK_VERSION = 3
+BENCHMARK_SEED = 1
+BENCHMARK_REPEAT = 3
+# proof_of_workを計測するdifficulty（ハッシュ値の先頭の16進数の0の数）
+POW_DIFFICULTIES = (1, 2, 3, 4, 5)
+# valid_chain・calculate_total_amountで使うchainの長さ
+CHAIN_SIZES = (1000, 10000, 100000)
+QUICK_CHAIN_SIZES = (1000, 10000)
+# 作成するchainのtarget（nonceを探す時間を短くするために最も易しくしている）
+# ブロックのtimestampはTARGET_BLOCK_INTERVAL_SECの間隔にするので、targetは変わらない
+CHAIN_TARGET = difficulty.MAX_TARGET
+# ブロックごとのトランザクション数（マイニング報酬を除く）
+CHAIN_BLOCK_TRANSACTIONS = 4
+WALLETS = 16
+SIGNATURES = 50
+HTTP_TRANSACTIONS = 50
+HTTP_CHAIN_SIZE = 1000
+
+
+class Benchmark(object):
+
+    def __init__(self, repeat=BENCHMARK_REPEAT, quick=False, seed=BENCHMARK_SEED):
+        self.repeat = repeat
+        self.quick = quick
+        self.random = random.Random(seed)
+        self.results = []
+        self._wallets = None
+        self._chain = None
+
+    def measure(self, name, params, operations, func, setup=None):
+        """
+        funcをrepeat回実行し、1回ごとの時間と1秒あたりの処理数（最も速かった回）を記録する
+        setupを指定した場合は毎回計測の前に実行し、その戻り値をfuncに渡す（setupの時間は含めない）
+        """
+        seconds = []
+        for _ in range(self.repeat):
+            args = (setup(),) if setup else ()
+            start = time.perf_counter()
+            func(*args)
+            seconds.append(time.perf_counter() - start)
+        result = {
+            'name': name,
+            'params': params,
+            'operations': operations,
+            'seconds': seconds,
+            'best': min(seconds),
+            'mean': sum(seconds) / len(seconds),
+            'operations_per_sec': operations / min(seconds) if min(seconds) else None,
+        }
+        self.results.append(result)
+        print({'name': name, 'params': params, 'best': result['best']}, file=sys.stderr)
+        return result
+
+    @property
+    def wallets(self):
+        if self._wallets is None:
+            self._wallets = [wallet.Wallet() for _ in range(WALLETS)]
+        return self._wallets
+
+    def random_transactions(self, count):
+        addresses = [w.blockchain_address for w in self.wallets]
+        return [
+            models.Transaction(
+                self.random.choice(addresses),
+                self.random.choice(addresses),
+                round(self.random.uniform(0.1, 10.0), 2),
+                1600000000.0 + self.random.random(),
+            )
+            for _ in range(count)
+        ]
+
+    def chain(self, length):
+        # CHAIN_TARGETで正しいnonceを持つchain（一番長いものを作っておき、短いchainはその先頭を使う）
+        if self._chain is None or len(self._chain) < length:
+            chain = []
+            previous_hash = '0' * 64
+            for index in range(1, length + 1):
+                transactions = [
+                    models.Transaction(blockchain.MINING_SENDER, self.wallets[index % WALLETS].blockchain_address,
+                                       blockchain.MINING_REWARD, 1600000000.0 + index)
+                ] + self.random_transactions(CHAIN_BLOCK_TRANSACTIONS)
+                timestamp = 1600000000.0 + index * difficulty.TARGET_BLOCK_INTERVAL_SEC
+                target = difficulty.next_target(chain[-(difficulty.RETARGET_WINDOW_BLOCKS + 1):], CHAIN_TARGET)
+                template = models.Block(index, timestamp, transactions, 0, previous_hash, target)
+                nonce = miner.proof_of_work(template.header_prefix(), target, workers=1)
+                block = models.Block(index, timestamp, transactions, nonce, previous_hash, target, template.merkle_root)
+                previous_hash = block.hash
+                chain.append(block)
+            self._chain = chain
+        return self._chain[:length]
+
+    def chain_sizes(self):
+        return QUICK_CHAIN_SIZES if self.quick else CHAIN_SIZES
+
+    def bench_proof_of_work(self):
+        """
+        BlockChain.proof_of_workを、1プロセスとminer.MINING_WORKERS個のプロセスで計測する
+        ハッシュ計算数は1プロセスで見つかるnonce + 1（最小のnonceまでの数）とし、
+        プロセス数を増やした場合の1秒あたりのハッシュ計算数（プロセスの起動時間を含む）を比較できるようにする
+        """
+        transactions = self.random_transactions(CHAIN_BLOCK_TRANSACTIONS)
+        difficulties = POW_DIFFICULTIES[:3] if self.quick else POW_DIFFICULTIES
+        chains = {
+            workers: blockchain.BlockChain(blockchain_address='benchmark', mining_workers=workers)
+            for workers in sorted({1, miner.MINING_WORKERS})
+        }
+        for zeros in difficulties:
+            target = (1 << (256 - 4 * zeros)) - 1
+            blocks = [
+                models.Block(1, 1600000000.0, transactions, 0, '%064x' % self.random.getrandbits(256), target)
+                for _ in range(max(1, 64 >> zeros))
+            ]
+            hashes = sum(miner.proof_of_work(block.header_prefix(), target, workers=1) + 1 for block in blocks)
+            for workers, block_chain in chains.items():
+                self.measure(
+                    'proof_of_work', {'difficulty': zeros, 'workers': workers, 'blocks': len(blocks)}, hashes,
+                    lambda: [block_chain.proof_of_work(block) for block in blocks],
+                )
+
+    def bench_signatures(self):
+        signed = []
+        for i in range(SIGNATURES):
+            sender = self.wallets[i % WALLETS]
+            transaction = wallet.Transaction(
+                sender.private_key, sender.public_key, sender.blockchain_address,
+                self.wallets[(i + 1) % WALLETS].blockchain_address, 1.0, 1600000000.0 + i)
+            signed.append((transaction, transaction.generate_signature()))
+
+        self.measure(
+            'generate_signature', {'signatures': SIGNATURES}, SIGNATURES,
+            lambda: [transaction.generate_signature() for transaction, _ in signed],
+        )
+
+        block_chain = blockchain.BlockChain(blockchain_address='benchmark')
+
+        def verify(batch):
+            for transaction, signature in batch:
+                assert block_chain.verify_transaction(
+                    transaction.sender_public_key,
+                    signature,
+                    models.Transaction(transaction.sender_blockchain_address, transaction.recipient_blockchain_address,
+                                       transaction.value, transaction.timestamp),
+                )
+
+        # publicKeyのキャッシュがない状態と、ある状態（同じ送信者が続く場合）
+        def cold_keys():
+            verifier.load_verifying_key.cache_clear()
+            return signed
+
+        self.measure('verify_transaction', {'signatures': SIGNATURES, 'key_cache': False}, SIGNATURES, verify,
+                     setup=cold_keys)
+        self.measure('verify_transaction', {'signatures': SIGNATURES, 'key_cache': True}, SIGNATURES, verify,
+                     setup=lambda: signed)
+
+        items = [
+            (transaction.sender_public_key, signature, verifier.transaction_messages(models.Transaction(
+                transaction.sender_blockchain_address, transaction.recipient_blockchain_address,
+                transaction.value, transaction.timestamp)))
+            for transaction, signature in signed
+        ]
+        for workers in sorted({1, verifier.VERIFICATION_WORKERS}):
+            signature_verifier = verifier.SignatureVerifier(workers=workers)
+            self.measure('verify_batch', {'signatures': SIGNATURES, 'workers': workers}, SIGNATURES,
+                         lambda: signature_verifier.verify_batch(items))
+
+    def bench_valid_chain(self):
+        # ブロックのハッシュ値はBlockに保持されるので、毎回dictから作り直す（作り直す時間は含めない）
+        # 検証済みのブロックを覚えないようにcache_sizeは0にする
+        for workers in sorted({1, validator.VALIDATION_WORKERS}):
+            chain_validator = validator.ChainValidator(CHAIN_TARGET, workers=workers, cache_size=0)
+            for size in self.chain_sizes():
+                dicts = [block.to_dict() for block in self.chain(size)]
+
+                def run(chain):
+                    assert chain_validator.valid_chain(chain)
+
+                self.measure('valid_chain', {'blocks': size, 'workers': workers}, size, run,
+                             setup=lambda: [models.Block.from_dict(block) for block in dicts])
+
+    def bench_calculate_total_amount(self):
+        block_chain = blockchain.BlockChain(blockchain_address='benchmark')
+        addresses = [w.blockchain_address for w in self.wallets]
+        for size in self.chain_sizes():
+            block_chain.chain = self.chain(size)
+            block_chain.ledger.rebuild(block_chain.chain)
+            lookups = 10000
+
+            def run():
+                for i in range(lookups):
+                    block_chain.calculate_total_amount(addresses[i % WALLETS], pending=bool(i & 1))
+
+            self.measure('calculate_total_amount', {'blocks': size}, lookups, run)
+
+    def bench_http(self):
+        # Flaskのテストクライアントでリクエストを送る（サーバーは起動しない）
+        block_chain = blockchain.BlockChain(blockchain_address='benchmark')
+        block_chain.chain = self.chain(HTTP_CHAIN_SIZE)
+        block_chain.ledger.rebuild(block_chain.chain)
+        blockchain_server.cache['blockchain'] = block_chain
+        client = blockchain_server.app.test_client()
+
+        def payloads():
+            block_chain.clear_transaction_pool()
+            result = []
+            for i in range(HTTP_TRANSACTIONS):
+                sender = self.wallets[i % WALLETS]
+                transaction = wallet.Transaction(
+                    sender.private_key, sender.public_key, sender.blockchain_address,
+                    self.wallets[(i + 1) % WALLETS].blockchain_address, 1.0)
+                result.append({
+                    'sender_blockchain_address': transaction.sender_blockchain_address,
+                    'recipient_blockchain_address': transaction.recipient_blockchain_address,
+                    'value': transaction.value,
+                    'sender_public_key': transaction.sender_public_key,
+                    'signature': transaction.generate_signature(),
+                    'timestamp': transaction.timestamp,
+                })
+            return result
+
+        def post(batch):
+            for payload in batch:
+                assert client.post('/transactions', json=payload).status_code == 201
+
+        self.measure('http_post_transactions', {'transactions': HTTP_TRANSACTIONS}, HTTP_TRANSACTIONS, post,
+                     setup=payloads)
+
+        def post_batch(batch):
+            response = client.post('/transactions/batch', json={'transactions': batch})
+            assert response.status_code == 200 and response.json['accepted'] == len(batch)
+
+        self.measure('http_post_transactions_batch', {'transactions': HTTP_TRANSACTIONS}, HTTP_TRANSACTIONS,
+                     post_batch, setup=payloads)
+        block_chain.clear_transaction_pool()
+
+        for accept in ('application/json', wire.STREAM_MEDIA_TYPE):
+            def get():
+                response = client.get('/chain', headers={'Accept': accept})
+                assert response.status_code == 200 and response.data
+
+            self.measure('http_get_chain', {'blocks': HTTP_CHAIN_SIZE, 'accept': accept}, HTTP_CHAIN_SIZE, get)
+
+    def run(self, only=None):
+        benchmarks = {
+            'proof_of_work': self.bench_proof_of_work,
+            'signatures': self.bench_signatures,
+            'valid_chain': self.bench_valid_chain,
+            'calculate_total_amount': self.bench_calculate_total_amount,
+            'http': self.bench_http,
+        }
+        for name, bench in benchmarks.items():
+            if only and name not in only:
+                continue
+            bench()
+        return {
+            'version': BENCHMARK_VERSION,
+            'meta': metadata(self.repeat, self.quick),
+            'results': self.results,
+        }
+
+
+def metadata(repeat, quick):
+    try:
+        commit = subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'commit': commit,
+        'timestamp': time.time(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'repeat': repeat,
+        'quick': quick,
+    }
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser()
+    parser.add_argument('-o', '--output', default=None, type=str, help='file to write the results (default: stdout)')
+    parser.add_argument('-r', '--repeat', default=BENCHMARK_REPEAT, type=int, help='number of runs for each benchmark')
+    parser.add_argument('--only', default='', type=str,
+                        help='comma separated benchmarks (proof_of_work,signatures,valid_chain,calculate_total_amount,http)')
+    parser.add_argument('--quick', action='store_true', help='skip the largest chain and difficulty')
+    args = parser.parse_args()
+
+    # ログは結果のjsonに混ざらないようにstderrに出力し、計測中のINFOログは出力しない
+    for handler in logging.getLogger().handlers:
+        handler.setStream(sys.stderr)
+    logging.disable(logging.INFO)
+    results = Benchmark(repeat=args.repeat, quick=args.quick).run([name for name in args.only.split(',') if name])
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        sys.stdout.write('\n')
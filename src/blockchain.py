@@ -1,3 +1,4 @@
+import concurrent.futures
 import contextlib
 import logging
 import sys
@@ -5,48 +6,114 @@ import time
 import hashlib
 import json
 import threading
-import requests
 
-from ecdsa import NIST256p
-from ecdsa import VerifyingKey
+import requests
 
+import difficulty
+import gossip
+import ledger
+import mempool
+import metrics
+import miner
+import models
+import scheduler
+import storage
 import utils
+import validator
+import verifier
+import wire
 
 
 
-# マイニングの難易度
-# challenge + previous_hash + transactionの値の先頭が0 * MINING_DIFFICULTYになるようなnonceを探す
-# 例えば、MINING_DIFFICULTY=3の場合、先頭が000になるようなnonceを探す
-# 大体10minくらいで見つかる値が良いらしい
-# このnonceを探す処理のことを「マイニング」という
-MINING_DIFFICULTY = 3
+# マイニングの難易度（ブロックごとのtarget）はdifficulty.pyで、直近のブロックの間隔から決める
 # マイニングの報酬を送る人
 MINING_SENDER = 'THE BLOCKCHAIN'
 # マイニング報酬
 MINING_REWARD = 1.0
-# マイニングの実行間隔
-MINING_TIMER_SEC = 20
+# 1つのブロックに含めるトランザクションの最大数
+MAX_BLOCK_TRANSACTIONS = 1000
+# TODO デバッグ用にマイナスの残高を許可している。Falseにすると残高が足りない送金は失敗する
+ALLOW_NEGATIVE_BALANCE = True
 
 # utils.pyのfind_neighborsを使って探索する範囲を指定
 BLOCKCHAIN_PORT_RANGE = (5050, 5051)
 NEIGHBORS_IP_RANGE = (-2, 2)
 BLOCKCHAIN_NEIGHBORS_SYNC_TIME_SEC = 20
+# 他ノードに既知のノードを問い合わせる際のタイムアウト
+PEER_EXCHANGE_TIMEOUT_SEC = 3
+# コンセンサスで他ノードからchainを取得する際のタイムアウト（ストリーミングではデータが届く間隔）
+SYNC_TIMEOUT_SEC = 10
+# block_locatorで末尾から1つずつ選ぶブロックの数
+LOCATOR_DENSE_BLOCKS = 10
+# /transactions/batchで1回に受け付けるトランザクションの最大数
+MAX_TRANSACTION_BATCH = 10000
+# /transactions/historyで1回に返す履歴の数
+HISTORY_PAGE_SIZE = 50
+MAX_HISTORY_PAGE_SIZE = 1000
+# /transactions/batchのトランザクションに必要なキー（POST /transactionsと同じ）
+TRANSACTION_REQUIRED_KEYS = frozenset({
+    'sender_blockchain_address',
+    'recipient_blockchain_address',
+    'value',
+    'sender_public_key',
+    'signature',
+})
 
 
 logging.basicConfig(level=logging.INFO, stream=sys.stdout)
 logger = logging.getLogger(__name__)
 
 class BlockChain(object):
-    def __init__(self, blockchain_address=None, port=None):
-        self.transaction_pool = []
+    def __init__(self, blockchain_address=None, port=None, mining_workers=None, store=None, seeds=None):
+        # トランザクションプール（トランザクションIDで重複を除いて保持する）
+        self.mempool = mempool.Mempool()
         self.chain = []
+        # chain・トランザクションプール・残高をまとめて変更する処理は、このロックを取って行う
+        # （/mineと自動マイニング、コンセンサス、トランザクションの追加が別のスレッドから同時に行われる）
+        self.lock = threading.RLock()
         self.neighbors = []
-        # 最初のブロックを作成
-        self.create_block(0, self.hash({}))
+        # アドレスごとの残高
+        self.ledger = ledger.BalanceLedger()
+        # アドレスごとの取引履歴（ブロックのindexと位置）
+        self.history = ledger.AddressHistory()
+        # ブロックのハッシュ値・トランザクションIDからの参照
+        self.index = ledger.ChainIndex()
+        # chainの検証（検証済みのブロックを覚えておく）
+        self.validator = validator.ChainValidator()
+        # 署名の検証（他ノードから同期されたトランザクションはバックグラウンドでまとめて検証する）
+        self.signature_verifier = verifier.SignatureVerifier(
+            on_verified=self.append_transaction)
+        # 他ノードへの同期の送信
+        self.broadcaster = gossip.Broadcaster()
+        # chainの保存先（Noneの場合はメモリ上にだけ保持する）
+        self.store = store
+        # 最後にスナップショットを保存した時のchainの長さ
+        self.snapshot_length = 0
+        # ディスクに保存されたchainがなければ最初のブロックを作成
+        if self.store is None or not self.restore():
+            self.create_block(0, self.hash({}))
         self.blockchain_address = blockchain_address
         self.port = port
+        # 探索範囲外でも接続するノード（'host:port'のリスト）
+        self.seeds = list(seeds or [])
+        # proof_of_workで使うプロセス数
+        self.mining_workers = mining_workers or miner.MINING_WORKERS
         self.mining_semaphore = threading.Semaphore(1)
+        # miningは同時に1つだけ実行する（/mineのジョブと自動マイニングが重ならないように）
+        self.mining_lock = threading.Lock()
+        # /mineのリクエストはジョブにしてバックグラウンドでマイニングする
+        self.mining_scheduler = scheduler.MiningScheduler(self.mining)
+        # 自動マイニングを止める
+        self.mining_stopped = threading.Event()
         self.sync_neighbors_semaphore = threading.Semaphore(1)
+        # /metricsの出力時に値を取得する
+        metrics.MEMPOOL_TRANSACTIONS.set_function(lambda: len(self.mempool))
+        metrics.CHAIN_LENGTH.set_function(lambda: len(self.chain))
+        metrics.MINING_DIFFICULTY.set_function(lambda: difficulty.difficulty(self.next_target()))
+
+    @property
+    def transaction_pool(self):
+        return self.mempool.transactions()
 
     def run(self):
         # ブロックチェーンサーバー起動時に実行する処理
@@ -60,19 +127,50 @@ class BlockChain(object):
 
     def set_neighbors(self):
         # ブロックチェーンノードの探索
-        self.neighbors = utils.find_neighbors(
-            utils.get_host(),
-            self.port,
-            NEIGHBORS_IP_RANGE[0],
-            NEIGHBORS_IP_RANGE[1],
-            BLOCKCHAIN_PORT_RANGE[0],
-            BLOCKCHAIN_PORT_RANGE[1]
-        )
+        my_address = f'{utils.get_host()}:{self.port}'
+        with metrics.FIND_NEIGHBORS_SECONDS.time():
+            neighbors = utils.find_neighbors(
+                utils.get_host(),
+                self.port,
+                NEIGHBORS_IP_RANGE[0],
+                NEIGHBORS_IP_RANGE[1],
+                BLOCKCHAIN_PORT_RANGE[0],
+                BLOCKCHAIN_PORT_RANGE[1],
+                seeds=self.seeds,
+            ) or []
+        # 見つかったノードが知っているノードも候補に加える（探索範囲外のノードも見つけられる）
+        exchanged = [
+            node for node in self.exchange_peers(neighbors)
+            if node != my_address and node not in neighbors
+        ]
+        self.neighbors = neighbors + utils.find_live_hosts(exchanged)
         logger.info({
             "action": "set_neighbors",
             "neighbors": self.neighbors,
         })
 
+    def exchange_peers(self, neighbors):
+        # 各ノードに既知のノードを同時に問い合わせる
+        def fetch(node):
+            try:
+                response = requests.get(
+                    f'http://{node}/neighbors', headers={'Accept': wire.ACCEPT}, timeout=PEER_EXCHANGE_TIMEOUT_SEC)
+                nodes = wire.parse_response(response)['neighbors']
+            except Exception as ex:
+                logger.error({'action': 'exchange_peers', 'node': node, 'error': ex})
+                return []
+            if not isinstance(nodes, list):
+                logger.error({'action': 'exchange_peers', 'node': node, 'error': 'invalid neighbors'})
+                return []
+            # 'host:port'の形式でないアドレスは使わない
+            return [address for address in nodes if utils.parse_address(address) is not None]
+
+        if not neighbors:
+            return []
+        with concurrent.futures.ThreadPoolExecutor(max_workers=min(utils.NEIGHBOR_SCAN_CONCURRENCY, len(neighbors))) as executor:
+            results = executor.map(fetch, neighbors)
+        return list(dict.fromkeys(node for nodes in results for node in nodes))
+
     def sync_neighbors(self):
         # ブロックチェーンノードの自動探索（同期）
         is_acquired = self.sync_neighbors_semaphore.acquire(blocking=False)
@@ -81,137 +179,325 @@ class BlockChain(object):
                 stack.callback(self.sync_neighbors_semaphore.release)
                 self.set_neighbors()
                 loop = threading.Timer(BLOCKCHAIN_NEIGHBORS_SYNC_TIME_SEC, self.sync_neighbors)
+                # プロファイラーの結果でスレッドを区別できるように名前をつける
+                loop.name = 'sync_neighbors'
                 loop.start()
 
-    def create_block(self, nonce, previous_hash):
-        # Creates a new Block and adds it to the chain
-        block = {
-            'index': len(self.chain) + 1,
-            'timestamp': time.time(),
-            'transactions': self.transaction_pool,
-            'nonce': nonce,
-            'previous_hash': previous_hash or self.hash(self.chain[-1]),
-        }
-        block = utils.sort_dict_by_key(block)
-        self.chain.append(block)
-        self.transaction_pool = []
+    def next_target(self):
+        # 次のブロックのtarget（直近のブロックのtimestampから計算する）
+        return difficulty.next_target(self.chain[-(difficulty.RETARGET_WINDOW_BLOCKS + 1):])
+
+    def block_template(self, transactions=None):
+        # nonce以外が決まった次のブロック（proof_of_workでこのブロックヘッダーのnonceを探す）
+        if transactions is None:
+            transactions = self.transaction_pool
+        return models.Block(
+            index=len(self.chain) + 1,
+            timestamp=difficulty.next_timestamp(self.chain[-1]),
+            transactions=transactions,
+            nonce=0,
+            previous_hash=self.hash(self.chain[-1]),
+            target=self.next_target(),
+        )
 
-        # 他のノードにsync
-        for node in self.neighbors:
-            requests.delete(
-                f'http://{node}/transactions'
+    def create_block(self, nonce, previous_hash, selected=None, timestamp=None, target=None):
+        # Creates a new Block and adds it to the chain
+        # selected: ブロックに含めるトランザクションのリスト（指定しない場合はプール全体）
+        # timestamp, target: proof_of_workを行ったブロックヘッダーの値（ハッシュ値に含まれるので同じ値にする）
+        if selected is None:
+            selected = self.mempool.select()
+        with self.lock:
+            block = models.Block(
+                index=len(self.chain) + 1,
+                timestamp=difficulty.next_timestamp(self.chain[-1] if self.chain else None) if timestamp is None else timestamp,
+                transactions=selected,
+                nonce=nonce,
+                previous_hash=previous_hash or self.hash(self.chain[-1]),
+                target=self.next_target() if target is None else target,
             )
+            self.chain.append(block)
+            self.ledger.apply_block(block)
+            self.history.apply_block(block)
+            self.index.apply_block(block)
+            # 自身で作成したブロックは検証済みとして扱う
+            self.validator.remember(self.hash(block))
+            # ブロックに含めたトランザクションだけをプールから削除する
+            # 他ノードのプールからは、コンセンサスでこのブロックを受け取った際に削除される
+            self.remove_transactions(selected)
+            if self.store is not None:
+                self.store.append(block.to_dict())
+                self.save_snapshot_if_needed()
 
         return block
 
-    def add_transaction(self, sender_blockchain_address, recipient_blockchain_address, value, sender_public_key=None, signature=None):
+    def add_transaction(self, sender_blockchain_address, recipient_blockchain_address, value, sender_public_key=None, signature=None, timestamp=None):
         # Adds a new transaction to the list of transactions
-        transaction = utils.sort_dict_by_key({
-            'sender_blockchain_address': sender_blockchain_address,
-            'recipient_blockchain_address': recipient_blockchain_address,
-            'value': float(value), # bitcoinは小数点以下を扱う
-        })
-
-        # マイニングの場合はユーザー間の送信ではないのでverificationは必要ない
+        # 追加したTransactionを返す（追加できなかった場合はNone）
+        # マイニング報酬は_miningでだけ作成する（クライアントから送られたものは署名を検証せずに通さない）
         if sender_blockchain_address == MINING_SENDER:
-            self.transaction_pool.append(transaction)
-            return True
+            logger.error({'action': 'addTransaction', 'error': 'mining sender is not allowed'})
+            return None
+        transaction = models.Transaction(sender_blockchain_address, recipient_blockchain_address, value, timestamp)
 
-        # TODO デバッグ用にマイナスを許可している状態。コメントを外す必要あり
-        # もし送信者の残高が足りない場合は失敗
-        # if self.calculate_total_amount(sender_blockchain_address) < float(value):
-        #     logger.error({'action': 'addTransaction', 'error': 'not enough balance'})
-        #     return False
+        # すでにプールにある・ブロックに含まれているトランザクション（同じ署名の送金を2回受け付けない）
+        if transaction.transaction_id in self.mempool or self.is_confirmed(transaction.transaction_id):
+            return None
+
+        if not self.has_enough_balance(sender_blockchain_address, value):
+            return None
 
         # ユーザー間の送受信の場合はverificationが必要
-        if self.verify_transaction(sender_public_key, signature, transaction):
-            self.transaction_pool.append(transaction)
+        if self.verify_transaction(sender_public_key, signature, transaction) and self.append_transaction(transaction):
+            return transaction
+
+        return None
+
+    def queue_transaction(self, sender_blockchain_address, recipient_blockchain_address, value, sender_public_key, signature, timestamp=None, transaction_id=None):
+        # 他ノードから同期されたトランザクションを追加する
+        # 署名の検証はバックグラウンドでまとめて行い、正しいものだけがトランザクションプールに追加される
+        # 同じトランザクションが複数のノードから同期された場合は、送信元が付けたトランザクションIDだけで判定してエンコードもしない
+        if sender_blockchain_address == MINING_SENDER:
+            return False
+        if transaction_id is not None and (transaction_id in self.mempool or self.is_confirmed(transaction_id)):
+            return True
+        transaction = models.Transaction(sender_blockchain_address, recipient_blockchain_address, value, timestamp)
+        if transaction.transaction_id in self.mempool or self.is_confirmed(transaction.transaction_id):
             return True
 
-        return False
+        if not self.has_enough_balance(sender_blockchain_address, value):
+            return False
 
-    def create_transaction(self, sender_blockchain_address, recipient_blockchain_address, value, sender_public_key, signature):
-        is_transacted = self.add_transaction(
-            sender_blockchain_address, recipient_blockchain_address, value, sender_public_key, signature)
+        self.signature_verifier.submit(sender_public_key, signature, transaction)
+        return True
+
+    def parse_transactions(self, items):
+        """
+        /transactions/batchで受け取ったトランザクションの形式を1回の走査でまとめて確認する
+        :return: <tuple> (itemsと同じ順番のTransaction, エラー)のリスト。形式が正しくないものはTransactionがNone
+        """
+        transactions = []
+        errors = []
+        seen = set()
+        for item in items:
+            transaction = None
+            error = None
+            if not isinstance(item, dict) or not TRANSACTION_REQUIRED_KEYS.issubset(item):
+                error = 'missing values'
+            elif item['sender_blockchain_address'] == MINING_SENDER or \
+                    not isinstance(item['sender_public_key'], str) or not isinstance(item['signature'], str):
+                error = 'invalid values'
+            else:
+                try:
+                    transaction = models.Transaction(
+                        item['sender_blockchain_address'],
+                        item['recipient_blockchain_address'],
+                        item['value'],
+                        item.get('timestamp'),
+                    )
+                    transaction_id = transaction.transaction_id
+                except (AttributeError, TypeError, ValueError):
+                    transaction = None
+                    error = 'invalid values'
+                else:
+                    # すでにプールにある・ブロックに含まれているトランザクション、同じバッチの中で2回目のトランザクション
+                    if transaction_id in seen or transaction_id in self.mempool or self.is_confirmed(transaction_id):
+                        error = 'duplicate'
+                    seen.add(transaction_id)
+            transactions.append(transaction)
+            errors.append(error)
+        return transactions, errors
+
+    def add_transactions(self, items):
+        """
+        複数のトランザクションをまとめて検証し、トランザクションプールに追加する（POST /transactions/batch）
+        署名はまとめてプロセスプールで検証し、残高は順番に確認する（同じ送信者の送金はバッチの前のものから反映される）
+        追加できたトランザクションは他ノードにまとめて同期する
+        :return: <list> itemsと同じ順番の{'transaction_id', 'accepted', 'error'}
+        """
+        transactions, errors = self.parse_transactions(items)
+        positions = [position for position, error in enumerate(errors) if error is None]
+        start = time.perf_counter()
+        verified = self.signature_verifier.verify_batch([
+            (items[position]['sender_public_key'], items[position]['signature'],
+             verifier.transaction_messages(transactions[position]))
+            for position in positions
+        ])
+        metrics.VERIFY_BATCH_SECONDS.observe(time.perf_counter() - start)
+        metrics.SIGNATURE_VERIFICATIONS.labels(result='ok').inc(sum(verified))
+        metrics.SIGNATURE_VERIFICATIONS.labels(result='failed').inc(len(verified) - sum(verified))
+
+        accepted = []
+        with self.lock:
+            for position, is_verified in zip(positions, verified):
+                transaction = transactions[position]
+                if not is_verified:
+                    errors[position] = 'invalid signature'
+                elif not self.has_enough_balance(transaction.sender_blockchain_address, transaction.value):
+                    errors[position] = 'not enough balance'
+                elif not self.append_transaction(transaction):
+                    errors[position] = 'duplicate'
+                else:
+                    accepted.append(position)
+
+        if accepted:
+            self.broadcaster.broadcast_transactions(self.neighbors, [
+                self.transaction_payload(transactions[position], items[position]['sender_public_key'],
+                                         items[position]['signature'])
+                for position in accepted
+            ])
+        logger.info({'action': 'add_transactions', 'size': len(items), 'accepted': len(accepted)})
+        return self.batch_results(transactions, errors)
+
+    def queue_transactions(self, items):
+        """
+        他ノードからまとめて同期されたトランザクションを追加する（PUT /transactions/batch）
+        形式だけ確認してすぐに戻り、署名はqueue_transactionと同じくバックグラウンドでまとめて検証する
+        """
+        transactions, errors = self.parse_transactions(items)
+        for position, transaction in enumerate(transactions):
+            if errors[position] is not None:
+                # 他ノードから同じトランザクションが何度も同期されるのは正常なので、エラーにしない
+                if errors[position] == 'duplicate':
+                    errors[position] = None
+                continue
+            if not self.has_enough_balance(transaction.sender_blockchain_address, transaction.value):
+                errors[position] = 'not enough balance'
+                continue
+            self.signature_verifier.submit(
+                items[position]['sender_public_key'], items[position]['signature'], transaction)
+        return self.batch_results(transactions, errors)
+
+    @staticmethod
+    def batch_results(transactions, errors):
+        return [
+            {
+                'transaction_id': transaction.transaction_id if transaction is not None else None,
+                'accepted': error is None,
+                'error': error,
+            }
+            for transaction, error in zip(transactions, errors)
+        ]
+
+    @staticmethod
+    def transaction_payload(transaction, sender_public_key, signature):
+        # 他ノードに同期する形式（PUT /transactions・/transactions/batch）
+        return {
+            'sender_blockchain_address': transaction.sender_blockchain_address,
+            'recipient_blockchain_address': transaction.recipient_blockchain_address,
+            'value': transaction.value,
+            'sender_public_key': sender_public_key,
+            'signature': signature,
+            'timestamp': transaction.timestamp,
+            'transaction_id': transaction.transaction_id,
+        }
+
+    def has_enough_balance(self, sender_blockchain_address, value):
+        # もし送信者の残高（transaction_poolに入っている送金も含む）が足りない場合は失敗
+        if not ALLOW_NEGATIVE_BALANCE and \
+                self.calculate_total_amount(sender_blockchain_address, pending=True) < float(value):
+            logger.error({'action': 'addTransaction', 'error': 'not enough balance'})
+            return False
+        return True
+
+    def is_confirmed(self, transaction_id):
+        # すでにchainのブロックに含まれているトランザクションか
+        return transaction_id in self.index.transactions
+
+    def append_transaction(self, transaction, priority=False):
+        # 検証済みのトランザクションをトランザクションプールに追加
+        # バックグラウンドで検証している間にブロックに含まれた場合（コンセンサスで受け取ったブロックなど）は追加しない
+        with self.lock:
+            if self.is_confirmed(transaction.transaction_id):
+                return False
+            is_added, evicted = self.mempool.add(transaction, priority)
+            if is_added:
+                self.ledger.add_pending(transaction)
+            # プールの最大数を超えたために削除されたトランザクション
+            for evicted_transaction in evicted:
+                self.ledger.remove_pending(evicted_transaction)
+        return is_added
+
+    def remove_transactions(self, transactions):
+        # トランザクションプールから削除する（プールになかったものは何もしない）
+        with self.lock:
+            for transaction in self.mempool.remove(transactions):
+                self.ledger.remove_pending(transaction)
+
+    def clear_transaction_pool(self):
+        with self.lock:
+            self.mempool.clear()
+            self.ledger.reset_pending()
+
+    def create_transaction(self, sender_blockchain_address, recipient_blockchain_address, value, sender_public_key, signature, timestamp=None):
+        # 追加したTransactionを返す（追加できなかった場合はNone）
+        transaction = self.add_transaction(
+            sender_blockchain_address, recipient_blockchain_address, value, sender_public_key, signature, timestamp)
 
         # 他のノードにSyncさせる
-        if is_transacted:
-            for node in self.neighbors:
-                requests.put(
-                    f'http://{node}/transactions',
-                    json={
-                        'sender_blockchain_address': sender_blockchain_address,
-                        'recipient_blockchain_address': recipient_blockchain_address,
-                        'value': value,
-                        'sender_public_key': sender_public_key,
-                        'signature': signature,
-                    }
-                )
-
-        return is_transacted
+        # 送信はバックグラウンドで行うので、他ノードの応答を待たずに戻る
+        # 短い間に作成されたトランザクションは/transactions/batchでまとめて送られる
+        # 追加したTransactionをそのまま送る（もう1度作成してエンコード・ハッシュ値の計算をしない）
+        if transaction is not None:
+            self.broadcaster.broadcast_transactions(
+                self.neighbors, [self.transaction_payload(transaction, sender_public_key, signature)])
+
+        return transaction
 
     def verify_transaction(self, sender_public_key, signature, transaction):
-        # 比較するためのハッシュ値を取得
-        sha256 = hashlib.sha256()
-        sha256.update(str(transaction).encode('utf-8'))
-        message = sha256.digest()
-        # 署名をpublicKeyで元に戻して比較
-        # signatureはバイト配列で渡す必要がある
-        signature_bytes = bytes().fromhex(signature)
-        verifying_key = VerifyingKey.from_string(
-            bytes().fromhex(sender_public_key), curve=NIST256p
-        )
-        # transactionの書き換えが起きていないことを検証（異なると判定されるとBadSignatureErrorが発生）
-        verified = verifying_key.verify(signature_bytes, message)
-        return verified
+        # 比較するためのハッシュ値を取得（以前の形式の署名も受け付ける場合は2つ）
+        messages = verifier.transaction_messages(transaction)
+        # transactionの書き換えが起きていないことを検証
+        # 復元したpublicKeyはキャッシュされるので、同じ送信者の2回目以降の検証は速い
+        with metrics.VERIFY_TRANSACTION_SECONDS.time():
+            is_verified = verifier.verify_signature(sender_public_key, signature, *messages)
+        metrics.SIGNATURE_VERIFICATIONS.labels(result='ok' if is_verified else 'failed').inc()
+        return is_verified
 
     def hash(self, block):
         # Hashes a Block
+        # Blockのハッシュ値は一度計算したものを使い回す
+        if isinstance(block, models.Block):
+            return block.hash
         # json.dumpsでstringに変換する際に、ソートすることで順番が入れ替わってハッシュ値が異なることを防ぐ
         # 事前にcreate_blockでソートしているが、hashメソッドを呼び出す処理があるかもしれないので、、、＋ ダブルチェックの意も込めて
         sorted_block = json.dumps(block, sort_keys=True)
         # sha256でハッシュ値を計算
         return hashlib.sha256(sorted_block.encode()).hexdigest()
 
-    def proof_of_work(self):
+    def proof_of_work(self, block=None):
         """
         コンセンサスアルゴリズムでnonceを探すことをproof of workという:
-        - Find a number nonce such that hash(challenge(candidate of nonce) + previous_hash + transaction) contains leading 3 zeroes
-        - 3 is lead from the number of difficulty
+        - Find a number nonce such that hash(block header with nonce) as a 256-bit integer <= target
+        - target is adjusted for each block from the timestamps of recent blocks
+        :param block: <Block> block_templateで作成したブロック（指定しない場合はプール全体から作成）
         :return: <int>
         """
 
         logger.info('Searching for next proof')
-        transactions = self.transaction_pool.copy()
-        previous_hash = self.hash(self.chain[-1])
-        nonce = 0
-        # transactions, previous_hash, nonceから作成されるhash値の先頭difficultyの数分
-        # 0が続くようなnonceを見つける（マイニングの難易度を満たすnonceを探す） = コンセンサスアルゴリズム
-        while self.valid_proof(transactions, previous_hash, nonce) is False:
-            nonce += 1
+        if block is None:
+            block = self.block_template()
+        # ブロックヘッダー（nonce以外は固定長の値）から作成されるhash値が
+        # target以下になるようなnonceを見つける（マイニングの難易度を満たすnonceを探す） = コンセンサスアルゴリズム
+        # nonceの探索範囲をmining_workers個のプロセスに分けて並列に探す
+        start = time.perf_counter()
+        nonce = miner.proof_of_work(block.header_prefix(), block.target, self.mining_workers)
+        elapsed = time.perf_counter() - start
+        # 各プロセスはnonceを順番に分担して探すので、見つかったnonceまでのnonceはほぼ全て試している
+        metrics.MINING_HASHES.inc(nonce + 1)
+        metrics.MINING_BLOCK_SECONDS.observe(elapsed)
+        if elapsed > 0:
+            metrics.MINING_HASH_RATE.set((nonce + 1) / elapsed)
 
         logger.info('Found proof: %s', nonce)
         return nonce
 
-    def valid_proof(self, transactions, previous_hash, nonce, difficulty=MINING_DIFFICULTY):
-        """
-        Validates the Proof: Does hash(transactions, previous_hash, nonce) contain number of difficulty leading zeroes?
-        :param transactions: <dictionary> whole transactions
-        :param previous_hash: <string> previous hash
-        :param nonce: <int> challenge
-        :return: <bool> True if correct, False if not.
-        """
-
-        guess = utils.sort_dict_by_key({
-            'transactions': transactions,
-            'previous_hash': previous_hash,
-            'nonce': nonce,
-        })
-        guess_hash = self.hash(guess)
-        # difficultyのバイト数だけ先頭が0になっているかチェック
-        return guess_hash[:difficulty] == '0' * difficulty
-
     def mining(self):
+        # 同時に実行されたマイニングは前のマイニングが終わるまで待つ（同じchainの先に2つのブロックを作らない）
+        # 作成したブロックを返す（proof_of_workの間にchainが置き換えられた場合はFalse）
+        with self.mining_lock:
+            return self._mining()
+
+    def _mining(self):
         # 空の場合でもマイニングしないと誰も仮想通貨を持っていない状態になってしまうので、トランザクションプールが空の場合も許可
         # # トランザクションプールが空の場合はマイニングしない
         # # 実際のBitcoinでは空でも実行するが、この環境では空のminingを実行してMINING_REWARDがどんどん追加されるとログが見辛くなるため
@@ -220,88 +506,361 @@ class BlockChain(object):
         #     return False
 
         # マイニング報酬を送る
-        self.add_transaction(
-            sender_blockchain_address=MINING_SENDER,
-            recipient_blockchain_address=self.blockchain_address,
-            value=MINING_REWARD,
-        )
+        # マイニング報酬は毎回同じ内容なので、timestampで別のトランザクションとして扱う
+        # 報酬はプールに入れずにブロックの先頭にだけ含める（proof_of_workが失敗しても、プールや残高に報酬が残らない）
+        reward = models.Transaction(MINING_SENDER, self.blockchain_address, MINING_REWARD, time.time())
         # マイニング
-        previous_hash = self.hash(self.chain[-1])
-        nonce = self.proof_of_work()
-        self.create_block(nonce, previous_hash)
+        # ブロックに含めるトランザクションを先に決めておく（proof_of_workの間に追加されたものは次のブロックに含める）
+        with self.lock:
+            template = self.block_template([reward] + self.mempool.select(MAX_BLOCK_TRANSACTIONS - 1))
+        nonce = self.proof_of_work(template)
+        with self.lock:
+            # proof_of_workの間にコンセンサスでchainが置き換えられた場合、このnonceは使えない
+            if template.previous_hash != self.hash(self.chain[-1]):
+                logger.info({'action': 'mining', 'status': 'stale'})
+                return False
+            block = self.create_block(
+                nonce, template.previous_hash, list(template.transactions), template.timestamp, template.target)
+        metrics.MINING_BLOCKS.inc()
         logger.info({'action': 'mining', 'status': 'success'})
 
         # SYNC
-        for node in self.neighbors:
-            requests.put(f'http://{node}/consensus')
+        self.broadcaster.broadcast(self.neighbors, 'PUT', '/consensus')
 
-        return True
+        return block
 
     def start_mining(self):
-        # マイニングを定期的に実行するメソッド
-        # blockingをTrueにすると、他のスレッドがマイニングを終えるまで待つ（キュー状）
+        # マイニングを続けて実行するスレッドを開始する（すでに実行中の場合はFalse）
+        # ブロックの間隔はtargetの調整でTARGET_BLOCK_INTERVAL_SECに近づくので、マイニングの間に待ち時間は入れない
         is_acquired = self.mining_semaphore.acquire(blocking=False)
-        if is_acquired:
-            with contextlib.ExitStack() as stack:
-                # マイニングを終えたら、セマフォを解放する（miningでexception等が起きても必ず実行）
-                stack.callback(self.mining_semaphore.release)
+        if not is_acquired:
+            return False
+        self.mining_stopped.clear()
+        loop = threading.Thread(target=self._mining_loop, name='start_mining', daemon=True)
+        loop.start()
+        return True
+
+    def _mining_loop(self):
+        with contextlib.ExitStack() as stack:
+            # マイニングを終えたら、セマフォを解放する（miningでexception等が起きても必ず実行）
+            stack.callback(self.mining_semaphore.release)
+            while not self.mining_stopped.is_set():
                 self.mining()
-                # 終了後に再度start_miningを呼び出す
-                # ただし、このサービスではdifficultyの数が0が3つなので、マイニングが終わるのが早すぎる（通常は10min程度かかるようなdifficultyが設定されているが、数秒で終了する）
-                # そのため、擬似的にTimerを使って、20秒後に再度マイニングを呼び出す
-                loop = threading.Timer(MINING_TIMER_SEC, self.start_mining)
-                loop.start()
 
+    def stop_mining(self):
+        # 実行中のproof_of_workが終わった後に止まる
+        self.mining_stopped.set()
 
-    def calculate_total_amount(self, blockchain_address):
+    def calculate_total_amount(self, blockchain_address, pending=False):
         # ブロックチェーンの合計金額を計算
-        total_amount = 0.0
-        for block in self.chain:
-            for transaction in block['transactions']:
-                if transaction['sender_blockchain_address'] == blockchain_address:
-                    total_amount -= float(transaction['value'])
-                if transaction['recipient_blockchain_address'] == blockchain_address:
-                    total_amount += float(transaction['value'])
-        return total_amount
-
-    def valid_chain(self, chain):
+        # 残高はブロック追加時にledgerで計算済みなのでchainを走査する必要はない
+        # pending=Trueの場合はtransaction_poolに入っている送金も含める
+        return self.ledger.balance(blockchain_address, pending)
+
+    def valid_chain(self, chain, history=()):
         # コンセンサス
         # ブロックチェーンの各ブロックとその繋がりが正しいか検証する
-        pre_block = chain[0]
-        current_index = 1
-        while current_index < len(chain):
-            block = chain[current_index]
-            # 1つ前のブロックを使ったハッシュ値であることを検証
-            if block['previous_hash'] != self.hash(pre_block):
-                return False
-            # nonceが正しい数値かを検証（proof_of_workで作成されるnonceであれば通過できるはず）
-            if not self.valid_proof(block['transactions'], block['previous_hash'], block['nonce']):
-                return False
+        # - 1つ前のブロックを使ったハッシュ値であること
+        # - nonceが正しい数値であること（proof_of_workで作成されるnonceであれば通過できるはず）
+        # - targetが直近のブロックのtimestampから計算した値であること（historyはchainより前のブロック）
+        # 検証済みのブロックまでは検証を省略し、ブロックが多い場合はプロセスプールで並列に検証する
+        return self.validator.valid_chain(chain, history)
+
+    def tip(self):
+        # chainの長さと最後のブロックのハッシュ値（他ノードがchainを取得すべきか判断するために使う）
+        return {
+            'length': len(self.chain),
+            'hash': self.hash(self.chain[-1]),
+        }
+
+    def confirmed_before(self, blocks, fork_index):
+        # blocksのトランザクションのうち、自身のchainのfork_index個目までのブロックに含まれているものがあるか
+        with self.lock:
+            for block in blocks:
+                for transaction in block.transactions:
+                    found = self.index.transactions.get(transaction.transaction_id)
+                    if found is not None and found[0] <= fork_index:
+                        return True
+        return False
+
+    def _indexed_transaction(self, index, position):
+        # 索引の(index, position)にあるブロックとトランザクション（chainの範囲外ならNone）
+        block = self.block_by_height(index)
+        if block is None or not 0 <= position < len(block.transactions):
+            return None, None
+        return block, block.transactions[position]
+
+    def block_by_hash(self, block_hash):
+        # ハッシュ値が一致するchainのブロック（見つからなければNone）
+        # 索引が指すブロックのハッシュ値が一致することも確認する
+        with self.lock:
+            index = self.index.blocks.get(block_hash)
+            block = self.block_by_height(index) if index is not None else None
+            return block if block is not None and self.hash(block) == block_hash else None
+
+    def block_by_height(self, index):
+        # index（1から始まる）のブロック（見つからなければNone）
+        chain = self.chain
+        block = chain[index - 1] if 1 <= index <= len(chain) else None
+        return block if block is not None and block.index == index else None
+
+    def find_transaction(self, transaction_id):
+        # トランザクションを含むブロックと、ブロック内の位置（見つからなければ(None, None)）
+        # chainは走査せずに索引から探し、索引が指すトランザクションのIDが一致することも確認する
+        with self.lock:
+            found = self.index.transactions.get(transaction_id)
+            if found is None:
+                return None, None
+            index, position = found
+            block, transaction = self._indexed_transaction(index, position)
+            if transaction is None or transaction.transaction_id != transaction_id:
+                return None, None
+            return block, position
+
+    def transaction_info(self, transaction_id):
+        # /tx/<transaction_id>で返すトランザクションと、それを含むブロックの情報
+        with self.lock:
+            block, position = self.find_transaction(transaction_id)
+            if block is None:
+                return None
+            transaction = block.transactions[position]
+            return {
+                'transaction_id': transaction_id,
+                'transaction': transaction.to_dict(),
+                'block_index': block.index,
+                'block_hash': self.hash(block),
+                'block_timestamp': block.timestamp,
+                'position': position,
+                'confirmations': len(self.chain) - block.index + 1,
+            }
+
+    def transaction_proof(self, transaction_id):
+        """
+        トランザクションがブロックに含まれることのマークル証明とブロックヘッダー
+        ライトクライアントはブロック全体を受け取らずに、マークルルートとヘッダーのハッシュ値だけで検証できる
+        """
+        block, position = self.find_transaction(transaction_id)
+        if block is None:
+            return None
+        return {
+            'transaction_id': transaction_id,
+            'block_hash': self.hash(block),
+            'position': position,
+            'proof': block.merkle_proof(position),
+            'header': block.header_fields(),
+            'length': len(self.chain),
+        }
 
-            pre_block = block
-            current_index += 1
+    def transaction_history(self, blockchain_address, before=None, limit=HISTORY_PAGE_SIZE):
+        """
+        アドレスが送信者・受取人のトランザクションを新しい順に返す（索引を使うので、chainは走査しない）
+        :param before: 前のページのnext（最初のページはNone）
+        :return: <dict> transactions: 履歴、next: 次のページのbefore（最後のページはNone）
+        """
+        limit = min(max(limit, 1), MAX_HISTORY_PAGE_SIZE)
+        with self.lock:
+            length = len(self.chain)
+            transactions = []
+            entries = self.history.page(blockchain_address, before, limit)
+            for number, index, position in entries:
+                block, transaction = self._indexed_transaction(index, position)
+                # 索引が指すトランザクションがこのアドレスのものでなければ返さない
+                if transaction is None or blockchain_address not in (
+                        transaction.sender_blockchain_address, transaction.recipient_blockchain_address):
+                    continue
+                transactions.append({
+                    'transaction_id': transaction.transaction_id,
+                    'transaction': transaction.to_dict(),
+                    'direction': 'sent' if transaction.sender_blockchain_address == blockchain_address else 'received',
+                    'block_index': index,
+                    'block_hash': self.hash(block),
+                    'block_timestamp': block.timestamp,
+                    'position': position,
+                    'confirmations': length - index + 1,
+                })
+            return {
+                'blockchain_address': blockchain_address,
+                'total': self.history.count(blockchain_address),
+                'transactions': transactions,
+                'next': entries[-1][0] if entries and entries[-1][0] > 0 else None,
+                'length': length,
+            }
+
+    def block_locator(self):
+        # 他ノードとの共通のブロックを探すための(index, hash)のリスト
+        # 末尾からLOCATOR_DENSE_BLOCKS個は1つずつ、それより前は間隔を2倍ずつ広げて選ぶ
+        locator = []
+        step = 1
+        position = len(self.chain) - 1
+        while position >= 0:
+            locator.append((position + 1, self.hash(self.chain[position])))
+            if len(locator) >= LOCATOR_DENSE_BLOCKS:
+                step *= 2
+            position -= step
+        return locator
+
+    def locate(self, locator):
+        # block_locatorの中で自身のchainにも含まれる最も新しいブロックのindexを返す
+        # 共通のブロックがなければ0を返す
+        for index, block_hash in locator:
+            if 1 <= index <= len(self.chain) and self.hash(self.chain[index - 1]) == block_hash:
+                return index
+        return 0
+
+    def replace_chain(self, fork_index, blocks):
+        # 分岐点（fork_index個目までは共通のブロック）以降のブロックだけ残高を巻き戻す・反映する
+        with self.lock:
+            for block in reversed(self.chain[fork_index:]):
+                self.ledger.revert_block(block)
+                self.history.revert_block(block)
+                self.index.revert_block(block)
+                # 取り除かれたブロックのトランザクションはプールに戻す（マイニング報酬は無効になる）
+                for transaction in block.transactions:
+                    if transaction.sender_blockchain_address != MINING_SENDER:
+                        self.append_transaction(transaction)
+            for block in blocks:
+                self.ledger.apply_block(block)
+                self.history.apply_block(block)
+                self.index.apply_block(block)
+                # 新しいブロックに含まれたトランザクションだけをプールから削除する
+                self.remove_transactions(block.transactions)
+            self.chain = self.chain[:fork_index] + blocks
+            if self.store is not None:
+                self.store.truncate(fork_index)
+                for block in blocks:
+                    self.store.append(block.to_dict())
+                self.save_snapshot_if_needed()
+
+    def restore(self):
+        # ディスクに保存されたchainと、スナップショット（残高・トランザクションプール）から状態を復元する
+        # 残高はスナップショット以降に追加されたブロックの分だけ計算すればよい
+        blocks = self.store.load()
+        if blocks and 'target' not in blocks[0]:
+            # 現在のブロックヘッダー（マークルルート・target）より前の形式のchainはハッシュ値が変わるので使えない（新しく作り直す）
+            logger.warning({'action': 'restore', 'error': 'legacy block format', 'blocks': len(blocks)})
+            self.store.truncate(0)
+            return False
+        chain = [models.Block.from_dict(block) for block in blocks]
+        if not chain:
+            return False
+
+        self.chain = chain
+        snapshot = self.store.load_snapshot()
+        if self.usable_snapshot(snapshot, chain):
+            self.ledger.balances = snapshot['balances']
+            for block in chain[snapshot['length']:]:
+                self.ledger.apply_block(block)
+            # スナップショットより後にブロックが作られていれば、プールのトランザクションはブロックに含まれている可能性がある
+            if snapshot['length'] == len(chain):
+                for transaction in snapshot['transaction_pool']:
+                    self.append_transaction(models.Transaction.from_dict(transaction))
+            self.snapshot_length = snapshot['length']
+        else:
+            # chainが置き換えられてスナップショットが使えない場合は全ブロックから計算する
+            self.ledger.rebuild(chain)
+        # 履歴はスナップショットに含めない（ファイルが大きくなるので、起動時に全ブロックから作る）
+        self.history.rebuild(chain)
+        self.index.rebuild(chain)
+
+        logger.info({'action': 'restore', 'blocks': len(chain), 'snapshot_length': self.snapshot_length})
         return True
 
+    def usable_snapshot(self, snapshot, chain):
+        # スナップショットがchainの途中までと一致して、中身の形式が正しいか
+        if not snapshot:
+            return False
+        length = snapshot.get('length')
+        return isinstance(length, int) and 1 <= length <= len(chain) and \
+            snapshot.get('hash') == self.hash(chain[length - 1]) and \
+            isinstance(snapshot.get('balances'), dict) and \
+            isinstance(snapshot.get('transaction_pool'), list)
+
+    def save_snapshot(self):
+        self.store.save_snapshot({
+            'length': len(self.chain),
+            'hash': self.hash(self.chain[-1]),
+            'balances': self.ledger.balances,
+            'transaction_pool': [transaction.to_dict() for transaction in self.mempool.transactions()],
+        })
+        self.snapshot_length = len(self.chain)
+
+    def save_snapshot_if_needed(self):
+        # chainが置き換えられてスナップショットより短くなった場合も保存し直す
+        if len(self.chain) < self.snapshot_length or \
+                len(self.chain) - self.snapshot_length >= storage.SNAPSHOT_INTERVAL_BLOCKS:
+            self.save_snapshot()
+
+    def fetch_missing_blocks(self, node):
+        # 他ノードとの共通のブロックを探して、それ以降のブロックだけを取得する
+        # レスポンスはバイナリ形式（wire）を優先する（対応していないノードからはjsonが返ってくる）
+        response = requests.post(
+            f'http://{node}/chain/locate',
+            json={'locator': self.block_locator()},
+            headers={'Accept': wire.ACCEPT},
+            timeout=SYNC_TIMEOUT_SEC,
+        )
+        fork_index = wire.parse_response(response, on_bytes=metrics.SYNC_BYTES.inc)['index']
+        # ブロックはストリーミングで受け取りながら変換するので、レスポンス全体をメモリに持たない
+        response = requests.get(
+            f'http://{node}/chain', params={'from': fork_index + 1}, headers={'Accept': wire.STREAM_ACCEPT},
+            stream=True, timeout=SYNC_TIMEOUT_SEC)
+        with response:
+            blocks = [
+                models.Block.from_dict(block)
+                for block in wire.iter_response(response, 'chain', on_bytes=metrics.SYNC_BYTES.inc)
+            ]
+        return fork_index, blocks
+
     def resolve_conflicts(self):
+        with metrics.RESOLVE_CONFLICTS_SECONDS.time():
+            is_replaced = self._resolve_conflicts()
+        metrics.RESOLVE_CONFLICTS.labels(result='replaced' if is_replaced else 'not_replaced').inc()
+        return is_replaced
+
+    def _resolve_conflicts(self):
         # リゾルブコンフリクト
         # 最も長いchainを採用するとする（これが一般的なルールだが、ここは各BlockChainで変えても良い）
-        longest_chain = None
+        # chain全体ではなく、共通のブロック以降の足りない部分だけを取得・検証する
+        longest = None
         max_length = len(self.chain)
         for node in self.neighbors:
-            response = requests.get(f'http://{node}/chain')
-            response_json = response.json()
-            chain = response_json['chain']
-            chain_length = len(chain)
-            # 別ノードから取得したchainのなかで最大長かつ、正しいnonceが設定されたものlongest_chainにいれる
-            if chain_length > max_length and self.valid_chain(chain):
+            # 応答しない・正しくないレスポンスを返すノードは飛ばして、他のノードとの同期を続ける
+            try:
+                response = requests.get(
+                    f'http://{node}/chain/tip', headers={'Accept': wire.ACCEPT}, timeout=SYNC_TIMEOUT_SEC)
+                # 自身より長いchainを持っていないノードからはブロックを取得しない
+                if wire.parse_response(response, on_bytes=metrics.SYNC_BYTES.inc)['length'] <= max_length:
+                    continue
+
+                fork_index, blocks = self.fetch_missing_blocks(node)
+            except Exception as ex:
+                logger.error({'action': 'resolve_conflicts', 'node': node, 'error': repr(ex)})
+                continue
+            chain_length = fork_index + len(blocks)
+            # 共通のブロックの次からnonceとハッシュ値の繋がりを検証する
+            # 共通のブロックがない場合はchain全体（最初のブロックは検証しない）を検証する
+            chain = self.chain[fork_index - 1:fork_index] + blocks
+            # 共通のブロックより前の直近のブロック（受け取ったブロックのtargetの計算に使う）
+            history = self.chain[max(0, fork_index - difficulty.RETARGET_WINDOW_BLOCKS - 1):max(0, fork_index - 1)]
+            # 別ノードから取得したchainのなかで最大長かつ、正しいnonceが設定されたものlongestにいれる
+            # 共通のブロックまでに含まれているトランザクションを、受け取ったブロックで再び使っていないことも確認する
+            # 受け取った最初のブロックは共通のブロックの次のindexであること（以降の繋がりはvalid_chainで検証する）
+            if chain_length > max_length and blocks and blocks[0].index == fork_index + 1 and \
+                    self.valid_chain(chain, history) and not self.confirmed_before(blocks, fork_index):
                 max_length = chain_length
-                longest_chain = chain
-
-        # もしlongest_chainが空じゃなかったら自身の保持するchainを置き換える
-        if longest_chain:
-            self.chain = longest_chain
-            logger.info({"action": "resolve_conflicts", "status": "replaced"})
-            return True
+                longest = (fork_index, blocks)
+
+        # もしlongestが空じゃなかったら自身の保持するchainを置き換える
+        # ブロックの取得・検証の間に自身のchainが変わっている場合（マイニング・他のコンセンサス）は、
+        # 共通のブロックがまだ同じで、自身のchainより長い場合だけ置き換える
+        if longest:
+            fork_index, blocks = longest
+            with self.lock:
+                if fork_index + len(blocks) > len(self.chain) and fork_index <= len(self.chain) and \
+                        (fork_index == 0 or self.hash(self.chain[fork_index - 1]) == blocks[0].previous_hash):
+                    self.replace_chain(fork_index, blocks)
+                    logger.info({"action": "resolve_conflicts", "status": "replaced"})
+                    return True
 
         logger.info({"action": "resolve_conflicts", "status": "not replaced"})
         return False
@@ -313,17 +872,17 @@ if __name__ == '__main__':
     # ブロックチェーンを作成
     blockchain = BlockChain(blockchain_address=my_blockchain_address)
     # ブロックチェーンを表示
-    utils.pprint(blockchain.chain)
+    utils.pprint([block.to_dict() for block in blockchain.chain])
 
     # トランザクションを追加（送金デモ：AさんからBさんへ1.0のブロックチェーンを送金）
     blockchain.add_transaction('A', 'B', 1.0)
     blockchain.mining()
-    utils.pprint(blockchain.chain)
+    utils.pprint([block.to_dict() for block in blockchain.chain])
 
     # トランザクションを追加（送金デモ：CさんからDさんへ2.0のブロックチェーンを送金）
     blockchain.add_transaction('C', 'D', 2.0)
     blockchain.mining()
-    utils.pprint(blockchain.chain)
+    utils.pprint([block.to_dict() for block in blockchain.chain])
 
     print('私の残高: %s' % blockchain.calculate_total_amount(my_blockchain_address))
     print('Aさんの残高: %s' % blockchain.calculate_total_amount('A'))
@@ -1,23 +1,43 @@
+import hmac
+import itertools
+import json
+
+from flask import abort
 from flask import Flask
 from flask import jsonify
 from flask import request
+from flask import Response
 
 import blockchain
+import metrics
+import profiler
+import storage
 import wallet
+import wire
 
 app = Flask(__name__)
 
 cache = {}
 
+# /chainのストリーミングで一度に変換して送るブロックの数
+CHAIN_STREAM_BLOCKS = 100
+# /mine?wait=で待つ最大の時間
+MINE_MAX_WAIT_SEC = 60
+
 
 def get_blockchain():
     # FIXME 本来であればDBに保存するが簡易的にcacheに保存する
     cached_blockchain = cache.get('blockchain')
     if not cached_blockchain:
         miners_wallet = wallet.Wallet()
+        # data_dirが指定されていればchainをディスクに保存し、再起動時はそこから復元する
+        data_dir = app.config.get('data_dir')
         cache['blockchain'] = blockchain.BlockChain(
             blockchain_address=miners_wallet.blockchain_address,
-            port=app.config['port']
+            port=app.config['port'],
+            mining_workers=app.config.get('workers'),
+            store=storage.BlockStore(data_dir) if data_dir else None,
+            seeds=app.config.get('seeds'),
         )
         # マイナスを許可しないのであれば、マイニングによって得られる仮想通貨が最初の仮想通貨になる
         # つまりwalletのUIに下記の情報を入れて、取引を行うことでマイナスを許可しない仮想通貨取引が行えるようになる
@@ -29,14 +49,108 @@ def get_blockchain():
     return cache['blockchain']
 
 
+def respond(payload, status=200):
+    # Acceptでバイナリ形式（wire）が指定されていればバイナリ形式で返す
+    # Acceptがない・*/*の場合（ブラウザ・walletのUI）はjsonで返す
+    if request.accept_mimetypes.best_match(['application/json', wire.MEDIA_TYPE]) == wire.MEDIA_TYPE:
+        response = Response(wire.dumps(payload), status=status, mimetype=wire.MEDIA_TYPE)
+    else:
+        response = jsonify(payload)
+        response.status_code = status
+    response.vary.add('Accept')
+    return response
+
+
+def request_payload():
+    # Content-Typeに合わせてリクエストのbodyを読み込む（バイナリ形式・json）
+    if request.mimetype == wire.MEDIA_TYPE:
+        try:
+            return wire.loads(request.get_data())
+        except wire.WireError as ex:
+            app.logger.error({'action': 'request_payload', 'error': repr(ex)})
+            abort(400)
+    # バイナリ形式・json以外は415を返す（送信元はjsonで送り直す）
+    if not request.is_json:
+        abort(415)
+    return request.json
+
+
+def stream_chain_json(blocks, length, next_index):
+    # {"chain": [...], "length": chainの長さ, "next": 次のページのfrom}をCHAIN_STREAM_BLOCKSずつ返す
+    yield '{"chain": ['
+    separator = ''
+    while True:
+        chunk = [block.to_json() for block in itertools.islice(blocks, CHAIN_STREAM_BLOCKS)]
+        if not chunk:
+            break
+        yield separator + ', '.join(chunk)
+        separator = ', '
+    yield f'], "length": {length}, "next": {json.dumps(next_index)}}}'
+
+
 @app.route('/chain', methods=['GET'])
 def get_chain():
+    # from・toで返すブロックの範囲（indexは1から始まり、toのブロックも含む）、limitで返すブロックの最大数を指定する
+    # chain全体のjsonを作らずに、ブロックを少しずつ変換しながらストリーミングで返す
+    chain = get_blockchain().chain
+    from_index = max(request.args.get('from', 1, type=int), 1)
+    to_index = min(request.args.get('to', len(chain), type=int), len(chain))
+    limit = request.args.get('limit', None, type=int)
+    if limit is not None and limit < 1:
+        return jsonify({'message': 'invalid limit'}), 400
+    end_index = to_index if limit is None else min(to_index, from_index + limit - 1)
+    # 続きがある場合は次のページのfrom
+    next_index = end_index + 1 if end_index < to_index else None
+    # chainが置き換えられても、ここで参照しているlistは変わらない
+    blocks = itertools.islice(chain, from_index - 1, max(end_index, from_index - 1))
+
+    # 他ノードからの同期ではバイナリ形式
+    if request.accept_mimetypes.best_match(['application/json', wire.STREAM_MEDIA_TYPE]) == wire.STREAM_MEDIA_TYPE:
+        response = Response(wire.dump_stream(block.to_dict() for block in blocks), mimetype=wire.STREAM_MEDIA_TYPE)
+    else:
+        response = Response(stream_chain_json(blocks, len(chain), next_index), mimetype='application/json')
+    response.headers['X-Chain-Length'] = str(len(chain))
+    if next_index is not None:
+        response.headers['X-Next-From'] = str(next_index)
+    response.vary.add('Accept')
+    return response
+
+
+@app.route('/chain/tip', methods=['GET'])
+def get_chain_tip():
+    # chainの長さと最後のブロックのハッシュ値
+    return respond(get_blockchain().tip())
+
+
+def valid_locator(locator):
+    # block_locatorの形式（[index, ブロックのハッシュ値(hex)]のリスト）か
+    if not isinstance(locator, list):
+        return False
+    for item in locator:
+        if not isinstance(item, (list, tuple)) or len(item) != 2:
+            return False
+        index, block_hash = item
+        if not isinstance(index, int) or isinstance(index, bool) or not isinstance(block_hash, str):
+            return False
+        if len(block_hash) != 64 or not all(c in '0123456789abcdef' for c in block_hash):
+            return False
+    return True
+
+
+@app.route('/chain/locate', methods=['POST'])
+def locate_chain():
+    # 送られてきたblock_locatorから共通のブロックのindexを探す
+    request_json = request_payload()
+    if 'locator' not in request_json:
+        return jsonify({'message': 'missing values'}), 400
+    if not valid_locator(request_json['locator']):
+        return jsonify({'message': 'invalid locator'}), 400
+
     block_chain = get_blockchain()
-    response = {
-        'chain': block_chain.chain
-    }
-    # jsonでレスポンス返す時にjsonify使用
-    return jsonify(response), 200
+    return respond({
+        'index': block_chain.locate(request_json['locator']),
+        'length': len(block_chain.chain),
+    })
 
 
 @app.route('/transactions', methods=['GET', 'POST', 'PUT', 'DELETE'])
@@ -44,16 +158,16 @@ def transaction():
     block_chain = get_blockchain()
     if request.method == 'GET':
         # トランザクションプール情報を取得
-        transactions = block_chain.transaction_pool
+        transactions = [transaction.to_dict() for transaction in block_chain.transaction_pool]
         response = {
             'transactions': transactions,
             'length': len(transactions)
         }
-        return jsonify(response), 200
+        return respond(response)
 
     if request.method == 'POST':
         # トランザクションの作成
-        request_json = request.json
+        request_json = request_payload()
         required = {
             'sender_blockchain_address',
             'recipient_blockchain_address',
@@ -68,22 +182,23 @@ def transaction():
         if not all(k in request_json for k in required):
             return jsonify({'message': 'missing values'}), 400
 
-        is_created = block_chain.create_transaction(
+        transaction = block_chain.create_transaction(
             request_json['sender_blockchain_address'],
             request_json['recipient_blockchain_address'],
             request_json['value'],
             request_json['sender_public_key'],
             request_json['signature'],
+            request_json.get('timestamp'),
         )
-        if not is_created:
-            jsonify({'message': 'fail'}), 400
+        if transaction is None:
+            return jsonify({'message': 'fail'}), 400
 
         return jsonify({'message': 'success'}), 201
 
     if request.method == 'PUT':
         # 他ノードでトランザクションが作成された際のトランザクションの同期
         # 送られてきた情報のvalue check
-        request_json = request.json
+        request_json = request_payload()
         required = {
             'sender_blockchain_address',
             'recipient_blockchain_address',
@@ -95,52 +210,225 @@ def transaction():
             return jsonify({'message': 'missing values'}), 400
 
         # 送られてきた情報をトランザクションに追加
-        is_added = block_chain.add_transaction(
+        # 署名の検証はバックグラウンドでまとめて行うので、リクエストはすぐに返す
+        is_added = block_chain.queue_transaction(
             request_json['sender_blockchain_address'],
             request_json['recipient_blockchain_address'],
             request_json['value'],
             request_json['sender_public_key'],
             request_json['signature'],
+            request_json.get('timestamp'),
+            request_json.get('transaction_id'),
         )
         if not is_added:
-            jsonify({'message': 'fail'}), 400
+            return jsonify({'message': 'fail'}), 400
 
         return jsonify({'message': 'success'}), 200
 
     if request.method == 'DELETE':
-        # ブロックが作られたらプールを空にする形での同期
-        block_chain.transaction_pool = []
+        # トランザクションプールを空にする
+        # （ブロックに含まれたトランザクションは、コンセンサスでブロックを受け取った際に個別に削除される）
+        block_chain.clear_transaction_pool()
         return jsonify({'message': 'success'}), 200
 
+@app.route('/transactions/batch', methods=['POST', 'PUT'])
+def transaction_batch():
+    # 複数のトランザクションをまとめて受け付ける（{'transactions': [POST /transactionsと同じ形式, ...]}）
+    # POST: クライアントからの作成（署名をまとめて検証してから追加し、他ノードに同期する）
+    # PUT: 他ノードからの同期（署名はバックグラウンドでまとめて検証する）
+    # 一部のトランザクションが失敗しても他は追加され、トランザクションごとの結果を同じ順番で返す
+    request_json = request_payload()
+    items = request_json.get('transactions') if isinstance(request_json, dict) else None
+    if not isinstance(items, list):
+        return jsonify({'message': 'missing values'}), 400
+    if len(items) > blockchain.MAX_TRANSACTION_BATCH:
+        return jsonify({'message': f'too many transactions (max {blockchain.MAX_TRANSACTION_BATCH})'}), 413
+
+    block_chain = get_blockchain()
+    if request.method == 'POST':
+        results = block_chain.add_transactions(items)
+    else:
+        results = block_chain.queue_transactions(items)
+    accepted = sum(result['accepted'] for result in results)
+    return respond({
+        'message': 'success',
+        'accepted': accepted,
+        'rejected': len(results) - accepted,
+        'results': results,
+    })
+
+@app.route('/transactions/proof', methods=['GET'])
+def get_transaction_proof():
+    # トランザクションがブロックに含まれることのマークル証明（ライトクライアント用）
+    transaction_id = request.args.get('transaction_id')
+    if not transaction_id:
+        return jsonify({'message': 'missing values'}), 400
+    proof = get_blockchain().transaction_proof(transaction_id)
+    if proof is None:
+        return jsonify({'message': 'not found'}), 404
+    return respond(proof)
+
+@app.route('/transactions/history', methods=['GET'])
+def get_transaction_history():
+    # アドレスの取引履歴を新しい順に返す（続きはnextをbeforeに指定して取得する）
+    blockchain_address = request.args.get('blockchain_address')
+    if not blockchain_address:
+        return jsonify({'message': 'missing values'}), 400
+    before = request.args.get('before', None, type=int)
+    limit = request.args.get('limit', blockchain.HISTORY_PAGE_SIZE, type=int)
+    if limit < 1 or limit > blockchain.MAX_HISTORY_PAGE_SIZE:
+        return jsonify({'message': f'limit must be between 1 and {blockchain.MAX_HISTORY_PAGE_SIZE}'}), 400
+    return respond(get_blockchain().transaction_history(blockchain_address, before, limit))
+
+def block_response(block):
+    # /block/<hash>・/block/height/<index>で返すブロック（ハッシュ値と承認数を含める）
+    if block is None:
+        return jsonify({'message': 'not found'}), 404
+    chain = get_blockchain().chain
+    return respond(dict(
+        block.to_dict(),
+        hash=block.hash,
+        confirmations=max(len(chain) - block.index + 1, 0),
+    ))
+
+@app.route('/block/<block_hash>', methods=['GET'])
+def get_block(block_hash):
+    # ハッシュ値からブロックを返す（chain全体を取得しなくてもよい）
+    return block_response(get_blockchain().block_by_hash(block_hash))
+
+@app.route('/block/height/<int:index>', methods=['GET'])
+def get_block_by_height(index):
+    # index（1から始まる）のブロックを返す
+    return block_response(get_blockchain().block_by_height(index))
+
+@app.route('/tx/<transaction_id>', methods=['GET'])
+def get_transaction(transaction_id):
+    # トランザクションIDからトランザクションと、それを含むブロックを返す
+    info = get_blockchain().transaction_info(transaction_id)
+    if info is None:
+        return jsonify({'message': 'not found'}), 404
+    return respond(info)
+
 @app.route('/mine', methods=['GET']) # 本当はPOSTだけど簡易的に確認するためにGETを使用
 def mine():
-    block_chain = get_blockchain()
-    is_mined = block_chain.mining()
-    if is_mined:
-        return jsonify({'message': 'success'}), 200
-    return jsonify({'message': 'fail'}), 400
+    # マイニングはバックグラウンドで行い、ジョブIDをすぐに返す（結果は/mine/jobs/<job_id>で確認する）
+    # まだ開始していないジョブがある場合は、そのジョブにまとめる
+    # ?wait=秒数を指定した場合は、その時間までマイニングの終了を待って結果を返す
+    job = get_blockchain().mining_scheduler.submit()
+    wait = request.args.get('wait', type=float)
+    if wait is not None:
+        job.wait(min(max(wait, 0), MINE_MAX_WAIT_SEC))
+    return mining_job_response(job)
+
+@app.route('/mine/jobs/<job_id>', methods=['GET'])
+def get_mining_job(job_id):
+    job = get_blockchain().mining_scheduler.get(job_id)
+    if job is None:
+        return jsonify({'message': 'not found'}), 404
+    return mining_job_response(job)
+
+def mining_job_response(job):
+    # 終了したジョブは200（失敗した場合は400）、終了していないジョブは202
+    response = dict(job.to_dict(), status_url=f'/mine/jobs/{job.job_id}')
+    if not job.finished:
+        return jsonify(response), 202
+    if job.block is None:
+        return jsonify(dict(response, message='fail')), 400
+    return jsonify(dict(response, message='success')), 200
 
 @app.route('/mine/start', methods=['GET']) # 本来であればmainで実行すべきだが、学習理解しやすいようにAPI化
 def start_mine():
     block_chain = get_blockchain()
+    # 連続してマイニングする（ブロックの間隔はtargetの調整で決まる）
     block_chain.start_mining()
     return jsonify({'message': 'start mining'}), 200
 
+@app.route('/mine/stop', methods=['GET'])
+def stop_mine():
+    get_blockchain().stop_mining()
+    return jsonify({'message': 'stop mining'}), 200
+
 @app.route('/consensus', methods=['PUT'])
 def consensus():
     blockchain = get_blockchain()
     replaced = blockchain.resolve_conflicts()
     return jsonify({'replaced': replaced}), 200
 
+@app.route('/neighbors', methods=['GET'])
+def get_neighbors():
+    # このノードが知っている他のノード（他ノードが探索範囲外のノードを見つけるために使う）
+    return respond({'neighbors': get_blockchain().neighbors})
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    # Prometheusのテキスト形式でメトリクスを返す
+    get_blockchain()
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
 @app.route('/amount', methods=["GET"])
 def get_total_amount():
     # 保持している仮想通貨の合計金額を計算
     # getパラメーターからアドレスを取得
     blockchain_address = request.args['blockchain_address']
+    # pending=trueの場合はトランザクションプールに入っている送金も含めた残高を返す
+    pending = request.args.get('pending', 'false').lower() == 'true'
     return jsonify({
-        'amount': get_blockchain().calculate_total_amount(blockchain_address)
+        'amount': get_blockchain().calculate_total_amount(blockchain_address, pending)
     }), 200
 
+def is_admin(headers):
+    # 管理用のトークン（--admin-token）が一致するか
+    token = app.config.get('admin_token')
+    return bool(token) and hmac.compare_digest(headers.get('X-Admin-Token', ''), token)
+
+
+def enable_admin(token):
+    """
+    管理用の機能（プロファイラー）を有効にする
+    トークンが指定された場合だけエンドポイントとミドルウェアを登録するので、無効の場合は何も実行されない
+    - POST /admin/profiler/start?interval=&duration= : 全スレッドのサンプリングを開始
+    - POST /admin/profiler/stop?top=&format=json|collapsed : 停止して結果を返す
+    - GET /admin/profiler : サンプリングの状態
+    - X-Profileヘッダー : そのリクエストだけcProfileで計測して結果を返す
+    """
+    app.config['admin_token'] = token
+    sampling_profiler = profiler.SamplingProfiler()
+
+    def profiler_status():
+        if not is_admin(request.headers):
+            abort(403)
+        return jsonify({
+            'running': sampling_profiler.running,
+            'samples': sampling_profiler.samples,
+            'started_at': sampling_profiler.started_at,
+        }), 200
+
+    def profiler_start():
+        if not is_admin(request.headers):
+            abort(403)
+        is_started = sampling_profiler.start(
+            interval=request.args.get('interval', profiler.PROFILER_SAMPLE_INTERVAL_SEC, type=float),
+            max_duration=request.args.get('duration', profiler.PROFILER_MAX_DURATION_SEC, type=float),
+        )
+        if not is_started:
+            return jsonify({'message': 'already running'}), 409
+        return jsonify({'message': 'started'}), 200
+
+    def profiler_stop():
+        if not is_admin(request.headers):
+            abort(403)
+        sampling_profiler.stop()
+        if request.args.get('format') == 'collapsed':
+            return Response(sampling_profiler.collapsed(), mimetype='text/plain')
+        return jsonify(sampling_profiler.report(request.args.get('top', profiler.PROFILE_TOP_FUNCTIONS, type=int))), 200
+
+    app.add_url_rule('/admin/profiler', 'profiler_status', profiler_status, methods=['GET'])
+    app.add_url_rule('/admin/profiler/start', 'profiler_start', profiler_start, methods=['POST'])
+    app.add_url_rule('/admin/profiler/stop', 'profiler_stop', profiler_stop, methods=['POST'])
+    app.wsgi_app = profiler.RequestProfilerMiddleware(
+        app.wsgi_app, lambda environ: is_admin({'X-Admin-Token': environ.get('HTTP_X_ADMIN_TOKEN', '')}))
+
+
 if __name__ == '__main__':
     # ArgumentParserはPythonの実行時にコマンドライン引数を取りたいときに使用
     from argparse import ArgumentParser
@@ -148,10 +436,19 @@ if __name__ == '__main__':
     parser = ArgumentParser()
     # -p, --portでint型のコマンドライン引数を受け取るよってこと
     parser.add_argument('-p', '--port', default=5050, type=int, help='port to listen on')
+    parser.add_argument('-w', '--workers', default=None, type=int, help='number of mining processes')
+    parser.add_argument('-d', '--data-dir', default=None, type=str, help='directory to store the chain')
+    parser.add_argument('-s', '--seeds', default='', type=str, help='comma separated host:port of nodes to connect')
+    parser.add_argument('--admin-token', default=None, type=str, help='enable the profiler endpoints with this token')
     args = parser.parse_args()
     port = args.port
 
     app.config['port'] = port
+    app.config['workers'] = args.workers
+    app.config['data_dir'] = args.data_dir
+    app.config['seeds'] = [seed for seed in args.seeds.split(',') if seed]
+    if args.admin_token:
+        enable_admin(args.admin_token)
 
     get_blockchain().run()
 
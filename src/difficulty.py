@@ -0,0 +1,71 @@
+import time
+
+# マイニングの難易度
+# ブロックヘッダーのハッシュ値を256bitの整数として、ブロックのtarget以下になるようなnonceを探す
+# targetが小さいほど難しい（16進数の先頭の0の数ではなく整数で比較するので、細かく調整できる）
+# このnonceを探す処理のことを「マイニング」という
+# 最初のtarget（先頭の16進数3桁が0になる難易度）
+INITIAL_TARGET = (1 << 244) - 1
+# 最も易しいtarget（先頭の16進数1桁が0になる難易度）
+MAX_TARGET = (1 << 252) - 1
+# ブロックを作成する間隔の目標
+# 直近のブロックのtimestampから、この間隔でブロックが作られるように次のブロックのtargetを決める
+# マイニングのプロセス数が変わっても（ノードが増減しても）、ブロックの間隔は変わらない
+TARGET_BLOCK_INTERVAL_SEC = 20
+# targetの計算に使う直近のブロックの数
+RETARGET_WINDOW_BLOCKS = 10
+# 1回の計算でtargetを変える最大の倍率（timestampを偽装して一気に易しくすることはできない）
+MAX_RETARGET_FACTOR = 4
+# 現在時刻よりこの時間以上先のtimestampのブロックは受け取らない
+MAX_FUTURE_BLOCK_SEC = 2 * 60 * 60
+
+
+def next_target(previous, initial_target=INITIAL_TARGET):
+    """
+    次のブロックのtarget
+    直近のブロックの平均のtargetを、実際の間隔 / 目標の間隔 の倍率で調整する
+    最初のブロックのtimestampは各ノードの起動時刻なので間隔の計算には使わない
+    :param previous: <list> 直前までのブロック（最後が親ブロック。末尾のRETARGET_WINDOW_BLOCKS + 1個だけ使う）
+    :return: <int>
+    """
+    blocks = [block for block in previous[-(RETARGET_WINDOW_BLOCKS + 1):] if block.index > 1]
+    if len(blocks) < 2:
+        return initial_target
+
+    intervals = len(blocks) - 1
+    # 浮動小数点の誤差でノードごとに結果が変わらないように、ミリ秒の整数で計算する
+    actual = round((blocks[-1].timestamp - blocks[0].timestamp) * 1000)
+    expected = round(intervals * TARGET_BLOCK_INTERVAL_SEC * 1000)
+    actual = min(max(actual, expected // MAX_RETARGET_FACTOR), expected * MAX_RETARGET_FACTOR)
+    average = sum(block.target for block in blocks[1:]) // intervals
+    return min(max(average * actual // expected, 1), MAX_TARGET)
+
+
+def next_timestamp(parent):
+    # ブロックのtimestampは親ブロックより前にはしない（時計が戻った場合）
+    return max(time.time(), parent.timestamp) if parent is not None else time.time()
+
+
+def valid_schedule(blocks, start, initial_target=INITIAL_TARGET, now=None):
+    """
+    start番目以降のブロックのtargetとtimestampが正しいか検証する
+    - targetがnext_targetの値と一致すること
+    - timestampが親ブロック以降かつ、現在時刻より先すぎないこと
+    :param blocks: <list> 検証するブロックと、targetの計算に必要なそれより前のブロック
+    """
+    if now is None:
+        now = time.time()
+    for position in range(max(start, 1), len(blocks)):
+        block = blocks[position]
+        parent = blocks[position - 1]
+        if block.timestamp < parent.timestamp or block.timestamp > now + MAX_FUTURE_BLOCK_SEC:
+            return False
+        window = blocks[max(0, position - RETARGET_WINDOW_BLOCKS - 1):position]
+        if block.target != next_target(window, initial_target):
+            return False
+    return True
+
+
+def difficulty(target):
+    # 最も易しいtargetの何倍難しいか（/metricsなどで表示する値）
+    return MAX_TARGET / target
@@ -0,0 +1,144 @@
+import concurrent.futures
+import logging
+import queue
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+import metrics
+import wire
+
+logger = logging.getLogger(__name__)
+
+# 他ノードへ同時に送信するリクエストの最大数
+GOSSIP_WORKERS = 16
+# 他ノードへの接続・レスポンス待ちのタイムアウト
+GOSSIP_CONNECT_TIMEOUT_SEC = 1
+GOSSIP_READ_TIMEOUT_SEC = 10
+# 接続に失敗した場合などに再送する回数
+GOSSIP_RETRIES = 2
+GOSSIP_RETRY_BACKOFF_SEC = 0.2
+# トランザクションの同期を/transactions/batchでまとめて送る最大数
+GOSSIP_TRANSACTION_BATCH_SIZE = 1000
+# バッチが埋まるまでに待つ最大時間
+GOSSIP_TRANSACTION_BATCH_WAIT_SEC = 0.05
+
+
+class Broadcaster(object):
+    """
+    他ノードへの同期（トランザクション・ブロック作成・コンセンサスの通知）を送信する
+    ノードごとにコネクションを使い回し、送信はバックグラウンドのスレッドからノードごとに並列に行う
+    呼び出し元は送信の完了を待たずにすぐに戻る
+    payloadはバイナリ形式（wire）で送信し、バイナリ形式を受け付けなかったノードにはそれ以降jsonで送信する
+    トランザクションの同期は短い間のものをまとめて/transactions/batchで送信する
+    （/transactions/batchがないノードにはそれ以降PUT /transactionsで1件ずつ送信する）
+    """
+
+    def __init__(self, workers=GOSSIP_WORKERS):
+        self.workers = workers
+        self._sessions = {}
+        self._sessions_lock = threading.Lock()
+        # バイナリ形式を受け付けなかったノード
+        self._json_only = set()
+        # /transactions/batchがないノード
+        self._no_batch = set()
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name='gossip', daemon=True)
+        self._thread.start()
+        self._transactions = queue.Queue()
+        self._transactions_thread = threading.Thread(
+            target=self._run_transactions, name='gossip_transactions', daemon=True)
+        self._transactions_thread.start()
+
+    def session(self, node):
+        # ノードごとのセッション（keep-aliveでコネクションを使い回す）
+        with self._sessions_lock:
+            session = self._sessions.get(node)
+            if session is None:
+                session = requests.Session()
+                # レスポンスを受け取れなかった場合は相手が処理している可能性があるので再送しない
+                retry = Retry(
+                    total=GOSSIP_RETRIES,
+                    read=0,
+                    backoff_factor=GOSSIP_RETRY_BACKOFF_SEC,
+                    status_forcelist=(502, 503, 504),
+                )
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.workers, max_retries=retry)
+                session.mount('http://', adapter)
+                self._sessions[node] = session
+            return session
+
+    def send(self, node, method, path, payload=None, **kwargs):
+        # 1つのノードにリクエストを送信する（失敗した場合はログを出してNoneを返す）
+        kwargs.setdefault('timeout', (GOSSIP_CONNECT_TIMEOUT_SEC, GOSSIP_READ_TIMEOUT_SEC))
+        start = time.perf_counter()
+        try:
+            if payload is None:
+                return self.session(node).request(method, f'http://{node}{path}', **kwargs)
+            if node not in self._json_only:
+                response = self.session(node).request(
+                    method, f'http://{node}{path}',
+                    data=wire.dumps(payload), headers={'Content-Type': wire.MEDIA_TYPE}, **kwargs)
+                # 415以外の400（トランザクションが正しくない等）はjsonで送り直しても同じなので、そのまま返す
+                if response.status_code != 415:
+                    return response
+                self._json_only.add(node)
+                logger.warning({'action': 'send', 'node': node, 'status': 'binary format not accepted'})
+            return self.session(node).request(method, f'http://{node}{path}', json=payload, **kwargs)
+        except requests.RequestException as ex:
+            metrics.GOSSIP_ERRORS.labels(node=node).inc()
+            logger.error({'action': 'send', 'node': node, 'method': method, 'path': path, 'error': ex})
+            return None
+        finally:
+            metrics.GOSSIP_SECONDS.labels(node=node).observe(time.perf_counter() - start)
+
+    def broadcast(self, nodes, method, path, payload=None, **kwargs):
+        # 送信をキューに入れてすぐに戻る
+        kwargs['payload'] = payload
+        self._queue.put((list(nodes), method, path, kwargs))
+
+    def broadcast_transactions(self, nodes, transactions):
+        # トランザクションの同期をキューに入れてすぐに戻る
+        for transaction in transactions:
+            self._transactions.put((tuple(nodes), transaction))
+
+    def send_transactions(self, node, transactions):
+        # 1つのノードにトランザクションをまとめて送信する
+        if node not in self._no_batch:
+            response = self.send(node, 'PUT', '/transactions/batch', payload={'transactions': transactions})
+            if response is None or response.status_code not in (404, 405):
+                return
+            self._no_batch.add(node)
+            logger.warning({'action': 'send_transactions', 'node': node, 'status': 'batch endpoint not found'})
+        for transaction in transactions:
+            self.send(node, 'PUT', '/transactions', payload=transaction)
+
+    def _next_transactions(self):
+        # 1件目が来るまでは待ち、それ以降はGOSSIP_TRANSACTION_BATCH_WAIT_SECの間にきたものをまとめる
+        batch = [self._transactions.get()]
+        while len(batch) < GOSSIP_TRANSACTION_BATCH_SIZE:
+            try:
+                batch.append(self._transactions.get(timeout=GOSSIP_TRANSACTION_BATCH_WAIT_SEC))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run_transactions(self):
+        while True:
+            # 送信先のノードごとにまとめる
+            by_node = {}
+            for nodes, transaction in self._next_transactions():
+                for node in nodes:
+                    by_node.setdefault(node, []).append(transaction)
+            for node, transactions in by_node.items():
+                self._executor.submit(self.send_transactions, node, transactions)
+
+    def _run(self):
+        while True:
+            nodes, method, path, kwargs = self._queue.get()
+            for node in nodes:
+                self._executor.submit(self.send, node, method, path, **kwargs)
@@ -0,0 +1,134 @@
+class BalanceLedger(object):
+    """
+    アドレスごとの残高を保持する台帳
+    ブロックが追加・削除されるたびに差分だけ更新するので、残高の参照はO(1)で行える
+    """
+
+    def __init__(self):
+        # chainに含まれるトランザクションから計算した残高
+        self.balances = {}
+        # transaction_poolに含まれる（まだブロックになっていない）トランザクションによる残高の増減
+        self.pending = {}
+
+    @staticmethod
+    def _apply(balances, transaction, sign):
+        value = float(transaction['value']) * sign
+        sender = transaction['sender_blockchain_address']
+        recipient = transaction['recipient_blockchain_address']
+        balances[sender] = balances.get(sender, 0.0) - value
+        balances[recipient] = balances.get(recipient, 0.0) + value
+
+    def apply_block(self, block):
+        # chainの末尾にブロックが追加された
+        for transaction in block['transactions']:
+            self._apply(self.balances, transaction, 1)
+
+    def revert_block(self, block):
+        # chainの末尾からブロックが取り除かれた
+        for transaction in block['transactions']:
+            self._apply(self.balances, transaction, -1)
+
+    def rebuild(self, chain):
+        self.balances = {}
+        for block in chain:
+            self.apply_block(block)
+
+    def add_pending(self, transaction):
+        self._apply(self.pending, transaction, 1)
+
+    def remove_pending(self, transaction):
+        self._apply(self.pending, transaction, -1)
+
+    def reset_pending(self, transactions=()):
+        self.pending = {}
+        for transaction in transactions:
+            self.add_pending(transaction)
+
+    def balance(self, blockchain_address, pending=False):
+        total_amount = self.balances.get(blockchain_address, 0.0)
+        if pending:
+            total_amount += self.pending.get(blockchain_address, 0.0)
+        return total_amount
+
+
+class AddressHistory(object):
+    """
+    アドレスごとの取引履歴の索引（アドレス -> そのアドレスが送信者・受取人のトランザクションの(ブロックのindex, ブロック内の位置)）
+    BalanceLedgerと同じくブロックの追加・削除のたびに差分だけ更新するので、履歴の参照はchainの長さではなく件数に比例する
+    """
+
+    def __init__(self):
+        # chainの順番（古い順）に並んだ(index, position)のリスト
+        self.entries = {}
+
+    @staticmethod
+    def _addresses(transaction):
+        # 自分自身への送金は1件として数える
+        sender = transaction['sender_blockchain_address']
+        recipient = transaction['recipient_blockchain_address']
+        return (sender,) if sender == recipient else (sender, recipient)
+
+    def apply_block(self, block):
+        # chainの末尾にブロックが追加された
+        for position, transaction in enumerate(block['transactions']):
+            for address in self._addresses(transaction):
+                self.entries.setdefault(address, []).append((block['index'], position))
+
+    def revert_block(self, block):
+        # chainの末尾からブロックが取り除かれた（そのブロックの履歴は各アドレスの末尾にある）
+        for transaction in reversed(block['transactions']):
+            for address in self._addresses(transaction):
+                entries = self.entries[address]
+                entries.pop()
+                if not entries:
+                    del self.entries[address]
+
+    def rebuild(self, chain):
+        self.entries = {}
+        for block in chain:
+            self.apply_block(block)
+
+    def count(self, blockchain_address):
+        return len(self.entries.get(blockchain_address, ()))
+
+    def page(self, blockchain_address, before=None, limit=None):
+        """
+        新しい順に、履歴のbefore番目（0から数える）より前をlimit件返す
+        beforeを前のページの最後の番号にすれば、その間にブロックが追加されても同じ履歴を重複して返さない
+        :return: <list> (履歴の番号, index, position)のリスト
+        """
+        entries = self.entries.get(blockchain_address, ())
+        end = len(entries) if before is None else min(max(before, 0), len(entries))
+        start = 0 if limit is None else max(end - limit, 0)
+        return [(number, *entries[number]) for number in range(end - 1, start - 1, -1)]
+
+
+class ChainIndex(object):
+    """
+    ブロックのハッシュ値 -> index、トランザクションID -> (index, position)の索引
+    chainのlistと合わせて使うので、高さ（index）からのブロックの参照はchain[index - 1]で行える
+    他の台帳と同じくブロックの追加・削除のたびに差分だけ更新する
+    """
+
+    def __init__(self):
+        self.blocks = {}
+        self.transactions = {}
+
+    def apply_block(self, block):
+        # chainの末尾にブロックが追加された
+        self.blocks[block.hash] = block.index
+        for position, transaction in enumerate(block.transactions):
+            self.transactions[transaction.transaction_id] = (block.index, position)
+
+    def revert_block(self, block):
+        # chainの末尾からブロックが取り除かれた
+        self.blocks.pop(block.hash, None)
+        for transaction in block.transactions:
+            if self.transactions.get(transaction.transaction_id, (None,))[0] == block.index:
+                del self.transactions[transaction.transaction_id]
+
+    def rebuild(self, chain):
+        self.blocks = {}
+        self.transactions = {}
+        for block in chain:
+            self.apply_block(block)
@@ -0,0 +1,80 @@
+import collections
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+# トランザクションプールに保持するトランザクションの最大数
+MEMPOOL_MAX_TRANSACTIONS = 10000
+
+
+class Mempool(object):
+    """
+    トランザクションプール
+    - トランザクションIDをキーにして、同じトランザクションが何度同期されても1つだけ保持する
+    - 最大数を超えた場合は古いトランザクションから削除する（priorityで追加したものは削除しない）
+    - ブロックには優先するトランザクション、到着順の順番で選ぶ
+    """
+
+    def __init__(self, max_transactions=MEMPOOL_MAX_TRANSACTIONS):
+        self.max_transactions = max_transactions
+        # トランザクションID -> トランザクション（到着順）
+        self._transactions = collections.OrderedDict()
+        self._priority_ids = set()
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._transactions)
+
+    def __contains__(self, transaction_id):
+        return transaction_id in self._transactions
+
+    def transactions(self):
+        with self._lock:
+            return list(self._transactions.values())
+
+    def add(self, transaction, priority=False):
+        """
+        :return: <tuple> (追加されたか, 最大数を超えたために削除されたトランザクションのリスト)
+        """
+        transaction_id = transaction.transaction_id
+        with self._lock:
+            if transaction_id in self._transactions:
+                return False, []
+
+            self._transactions[transaction_id] = transaction
+            if priority:
+                self._priority_ids.add(transaction_id)
+
+            evicted = []
+            while len(self._transactions) > self.max_transactions:
+                evicted_id = next((i for i in self._transactions if i not in self._priority_ids), None)
+                if evicted_id is None:
+                    break
+                evicted.append(self._transactions.pop(evicted_id))
+            if evicted:
+                logger.warning({'action': 'add', 'evicted': len(evicted)})
+            return True, evicted
+
+    def remove(self, transactions):
+        # ブロックに含まれたトランザクションを削除し、プールにあったものを返す
+        with self._lock:
+            removed = []
+            for transaction in transactions:
+                transaction_id = transaction.transaction_id
+                if transaction_id in self._transactions:
+                    removed.append(self._transactions.pop(transaction_id))
+                    self._priority_ids.discard(transaction_id)
+            return removed
+
+    def select(self, limit=None):
+        # ブロックに含めるトランザクションを選ぶ
+        with self._lock:
+            priority = [t for i, t in self._transactions.items() if i in self._priority_ids]
+            others = [t for i, t in self._transactions.items() if i not in self._priority_ids]
+            return (priority + others)[:limit]
+
+    def clear(self):
+        with self._lock:
+            self._transactions.clear()
+            self._priority_ids.clear()
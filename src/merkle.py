@@ -0,0 +1,72 @@
+import hashlib
+
+# 葉と内部のノードで別の接頭辞をつけて、内部のノードを葉として偽装できないようにする
+LEAF_PREFIX = b'\x00'
+NODE_PREFIX = b'\x01'
+# トランザクションがないブロックのマークルルート
+EMPTY_ROOT = hashlib.sha256(b'').hexdigest()
+
+
+def _leaf(transaction_id):
+    return hashlib.sha256(LEAF_PREFIX + bytes.fromhex(transaction_id)).digest()
+
+
+def _node(left, right):
+    return hashlib.sha256(NODE_PREFIX + left + right).digest()
+
+
+def _next_level(level):
+    # 2つずつまとめて1つ上の段を作る（奇数個の場合、最後のノードはそのまま上の段に上げる）
+    parents = [_node(level[i], level[i + 1]) for i in range(0, len(level) - 1, 2)]
+    if len(level) % 2:
+        parents.append(level[-1])
+    return parents
+
+
+def merkle_root(transaction_ids):
+    """
+    トランザクションID（hex）のリストからマークルルート（hex）を計算する
+    :param transaction_ids: <list> ブロック内の順番のトランザクションID
+    """
+    if not transaction_ids:
+        return EMPTY_ROOT
+    level = [_leaf(transaction_id) for transaction_id in transaction_ids]
+    while len(level) > 1:
+        level = _next_level(level)
+    return level[0].hex()
+
+
+def merkle_proof(transaction_ids, position):
+    """
+    position番目のトランザクションがマークルルートに含まれることの証明
+    :return: <list> 葉から順番の[兄弟のノードが'left'か'right'か, 兄弟のノードのハッシュ値(hex)]
+    """
+    if not 0 <= position < len(transaction_ids):
+        raise IndexError(position)
+    level = [_leaf(transaction_id) for transaction_id in transaction_ids]
+    proof = []
+    while len(level) > 1:
+        sibling = position ^ 1
+        # 兄弟のノードがない（奇数個の最後）場合はそのまま上の段に上がる
+        if sibling < len(level):
+            proof.append(['left' if sibling < position else 'right', level[sibling].hex()])
+        level = _next_level(level)
+        position //= 2
+    return proof
+
+
+def verify_merkle_proof(transaction_id, proof, root):
+    # merkle_proofの結果から計算したルートがrootと一致すれば、トランザクションはブロックに含まれている
+    try:
+        current = _leaf(transaction_id)
+        for side, sibling in proof:
+            sibling = bytes.fromhex(sibling)
+            if side == 'left':
+                current = _node(sibling, current)
+            elif side == 'right':
+                current = _node(current, sibling)
+            else:
+                return False
+    except (TypeError, ValueError):
+        return False
+    return current.hex() == root
@@ -0,0 +1,268 @@
+import bisect
+import contextlib
+import threading
+import time
+
+# レイテンシーのヒストグラムのデフォルトのバケット（秒）
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+# /metricsのContent-Type（Prometheusのテキスト形式）
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if value == float('-inf'):
+        return '-Inf'
+    return repr(float(value))
+
+
+def _format_labels(names, values):
+    if not names:
+        return ''
+    pairs = []
+    for name, value in zip(names, values):
+        value = value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+        pairs.append(f'{name}="{value}"')
+    return '{' + ','.join(pairs) + '}'
+
+
+class Registry(object):
+    # /metricsで出力するメトリクスの一覧
+
+    def __init__(self):
+        self._metrics = []
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            self._metrics.append(metric)
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics)
+        lines = []
+        for metric in metrics:
+            lines.append(f'# HELP {metric.name} {metric.documentation}')
+            lines.append(f'# TYPE {metric.name} {metric.type}')
+            lines.extend(metric.samples())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+class _Metric(object):
+    """
+    メトリクスの共通部分
+    labelnamesを指定した場合はlabels()でラベルの値ごとのメトリクスを取得して使う
+    値の更新はロックを1回取るだけなので、常に有効にしておいてよい
+    """
+    type = None
+
+    def __init__(self, name, documentation, labelnames=(), registry=REGISTRY):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        self._lock = threading.Lock()
+        if not self.labelnames:
+            self._children[()] = self._new_child()
+        registry.register(self)
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def labels(self, *values, **labels):
+        if labels:
+            values = tuple(str(labels[name]) for name in self.labelnames)
+        else:
+            values = tuple(str(value) for value in values)
+        if len(values) != len(self.labelnames):
+            raise ValueError(f'{self.name} expects labels {self.labelnames}')
+        child = self._children.get(values)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(values, self._new_child())
+        return child
+
+    def _items(self):
+        with self._lock:
+            return sorted(self._children.items())
+
+    def samples(self):
+        raise NotImplementedError
+
+
+class _CounterValue(object):
+    __slots__ = ('value', '_lock')
+
+    def __init__(self):
+        self.value = 0.0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+
+class Counter(_Metric):
+    # 増えるだけの値（処理回数・失敗回数・バイト数など）
+    type = 'counter'
+
+    def _new_child(self):
+        return _CounterValue()
+
+    def inc(self, amount=1):
+        self._children[()].inc(amount)
+
+    def samples(self):
+        return [
+            f'{self.name}{_format_labels(self.labelnames, values)} {_format_value(child.value)}'
+            for values, child in self._items()
+        ]
+
+
+class _GaugeValue(object):
+    __slots__ = ('value', 'function', '_lock')
+
+    def __init__(self):
+        self.value = 0.0
+        self.function = None
+        self._lock = threading.Lock()
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def dec(self, amount=1):
+        self.inc(-amount)
+
+    def set_function(self, function):
+        # /metricsの出力時にfunctionを呼んで値を取得する（トランザクションプールの大きさなど）
+        self.function = function
+
+    def get(self):
+        return self.function() if self.function is not None else self.value
+
+
+class Gauge(_Metric):
+    # 増減する値
+    type = 'gauge'
+
+    def _new_child(self):
+        return _GaugeValue()
+
+    def set(self, value):
+        self._children[()].set(value)
+
+    def inc(self, amount=1):
+        self._children[()].inc(amount)
+
+    def dec(self, amount=1):
+        self._children[()].dec(amount)
+
+    def set_function(self, function):
+        self._children[()].set_function(function)
+
+    def samples(self):
+        return [
+            f'{self.name}{_format_labels(self.labelnames, values)} {_format_value(child.get())}'
+            for values, child in self._items()
+        ]
+
+
+class _HistogramValue(object):
+    __slots__ = ('buckets', 'counts', 'sum', '_lock')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        # 最後の要素は+Inf
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    @contextlib.contextmanager
+    def time(self):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+
+class Histogram(_Metric):
+    # 値の分布（レイテンシーなど）
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS, registry=REGISTRY):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames, registry)
+
+    def _new_child(self):
+        return _HistogramValue(self.buckets)
+
+    def observe(self, value):
+        self._children[()].observe(value)
+
+    def time(self):
+        return self._children[()].time()
+
+    def samples(self):
+        lines = []
+        for values, child in self._items():
+            with child._lock:
+                counts = list(child.counts)
+                total = child.sum
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                labels = _format_labels(self.labelnames + ('le',), values + (_format_value(bound),))
+                lines.append(f'{self.name}_bucket{labels} {cumulative}')
+            labels = _format_labels(self.labelnames, values)
+            lines.append(f'{self.name}_sum{labels} {_format_value(total)}')
+            lines.append(f'{self.name}_count{labels} {cumulative}')
+        return lines
+
+
+def render():
+    return REGISTRY.render()
+
+
+# マイニング
+MINING_HASHES = Counter('blockchain_mining_hashes_total', 'Nonces tried by proof of work')
+MINING_BLOCKS = Counter('blockchain_mining_blocks_total', 'Blocks mined by this node')
+MINING_BLOCK_SECONDS = Histogram(
+    'blockchain_mining_block_seconds', 'Time spent in proof of work per block',
+    buckets=(0.01, 0.05, 0.1, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300))
+MINING_HASH_RATE = Gauge('blockchain_mining_hash_rate', 'Hashes per second of the last mined block')
+MINING_DIFFICULTY = Gauge('blockchain_mining_difficulty', 'Difficulty of the next block relative to the easiest target')
+# chainの検証
+VALID_PROOF_CALLS = Counter('blockchain_valid_proof_total', 'Proof of work checks', ['result'])
+VALID_CHAIN_SECONDS = Histogram('blockchain_valid_chain_seconds', 'Time spent validating received chains')
+# 署名の検証
+VERIFY_TRANSACTION_SECONDS = Histogram(
+    'blockchain_verify_transaction_seconds', 'Latency of verifying one transaction signature')
+VERIFY_BATCH_SECONDS = Histogram('blockchain_verify_batch_seconds', 'Latency of verifying a batch of gossiped signatures')
+SIGNATURE_VERIFICATIONS = Counter('blockchain_signature_verifications_total', 'Signature verifications', ['result'])
+# トランザクションプール・chain
+MEMPOOL_TRANSACTIONS = Gauge('blockchain_mempool_transactions', 'Transactions in the pool')
+CHAIN_LENGTH = Gauge('blockchain_chain_length', 'Blocks in the chain')
+# コンセンサス
+RESOLVE_CONFLICTS_SECONDS = Histogram('blockchain_resolve_conflicts_seconds', 'Duration of resolve_conflicts')
+RESOLVE_CONFLICTS = Counter('blockchain_resolve_conflicts_total', 'resolve_conflicts runs', ['result'])
+SYNC_BYTES = Counter('blockchain_sync_received_bytes_total', 'Bytes received from neighbors while syncing the chain')
+# 他ノードへの同期
+GOSSIP_SECONDS = Histogram('blockchain_gossip_request_seconds', 'Latency of requests sent to neighbors', ['node'])
+GOSSIP_ERRORS = Counter('blockchain_gossip_errors_total', 'Failed requests sent to neighbors', ['node'])
+# ノードの探索
+FIND_NEIGHBORS_SECONDS = Histogram('blockchain_find_neighbors_seconds', 'Duration of scanning for neighbors')
@@ -0,0 +1,150 @@
+import concurrent.futures
+import hashlib
+import logging
+import multiprocessing
+import os
+import threading
+
+import models
+import parallel
+
+logger = logging.getLogger(__name__)
+
+# マイニングに使うプロセス数（デフォルトはCPUのコア数）
+MINING_WORKERS = os.cpu_count() or 1
+# 各ワーカーが停止フラグを確認するまでに試すnonceの個数
+NONCE_BATCH_SIZE = 1000
+# 試すnonceの数の期待値がこれ以下のtargetは、ワーカーを使わずに自身のプロセスで探す（1プロセスで約0.1秒）
+IN_PROCESS_MAX_HASHES = 1 << 16
+
+# ワーカーのプロセスで、MiningPoolから受け取った探索の世代
+_generation = None
+
+
+class NonceHasher(object):
+    """
+    nonce以外は変わらないブロックヘッダーのハッシュ値を、nonceごとに高速に計算する
+    models.Block.hashとバイト単位で同じハッシュ値になる
+    """
+
+    def __init__(self, header_prefix):
+        # nonceより前の部分（models.Block.header_prefix）はsha256の途中状態を保持しておき、nonceごとにコピーして使う
+        self._prefix_sha256 = hashlib.sha256(header_prefix)
+
+    def hexdigest(self, nonce):
+        sha256 = self._prefix_sha256.copy()
+        sha256.update(models.encode_nonce(nonce))
+        return sha256.hexdigest()
+
+    def is_valid(self, nonce, target):
+        # ハッシュ値を256bitの整数としてtarget以下であれば正しいnonce
+        sha256 = self._prefix_sha256.copy()
+        sha256.update(models.encode_nonce(nonce))
+        return int.from_bytes(sha256.digest(), 'big') <= target
+
+
+def valid_proof(header_prefix, nonce, target):
+    """
+    validator（受け取ったブロックの検証）と同じ判定を行う
+    :return: <bool> True if correct, False if not.
+    """
+    return NonceHasher(header_prefix).is_valid(nonce, target)
+
+
+def _init_worker(generation):
+    # ワーカーのプロセスの作成時に、探索の世代（共有メモリの整数）を受け取る
+    global _generation
+    _generation = generation
+
+
+def _search_nonce(header_prefix, target, start, step, generation):
+    """
+    start, start + step, start + 2 * step, ... の順にnonceを探す
+    ワーカーごとにstartをずらすことで、nonceの探索範囲が重ならないようにする
+    親プロセスが世代を進めたら（他のワーカーが見つけた）探索を止めてNoneを返す
+    hashlibのオブジェクトはpickleできないので、NonceHasherは各ワーカーで作成する
+    """
+    hasher = NonceHasher(header_prefix)
+    nonce = start
+    while _generation.value == generation:
+        for _ in range(NONCE_BATCH_SIZE):
+            if hasher.is_valid(nonce, target):
+                return nonce
+            nonce += step
+    return None
+
+
+def expected_hashes(target):
+    # target以下のハッシュ値が見つかるまでに試すnonceの数の期待値
+    return (1 << 256) // (target + 1)
+
+
+def _search_in_process(header_prefix, target):
+    hasher = NonceHasher(header_prefix)
+    nonce = 0
+    while hasher.is_valid(nonce, target) is False:
+        nonce += 1
+    return nonce
+
+
+class MiningPool(object):
+    """
+    マイニングのワーカーのプロセスを起動したままにしておき、ブロックごとに探索だけを依頼する
+    （ブロックごとにプロセスを起動・終了すると、易しいtargetでは探索よりも時間がかかる）
+    ワーカーの停止は共有メモリの世代で伝える。探索は同時に1つだけ行う
+    """
+
+    def __init__(self, workers):
+        self.workers = workers
+        ctx = multiprocessing.get_context()
+        self._generation = ctx.Value('Q', 0, lock=False)
+        self._pool = parallel.ProcessPool(workers, _init_worker, (self._generation,))
+        self._lock = threading.Lock()
+
+    def search(self, header_prefix, target):
+        with self._lock:
+            self._generation.value += 1
+            generation = self._generation.value
+            executor = self._pool.executor()
+            futures = [
+                executor.submit(_search_nonce, header_prefix, target, start, self.workers, generation)
+                for start in range(self.workers)
+            ]
+            try:
+                for future in concurrent.futures.as_completed(futures):
+                    nonce = future.result()
+                    if nonce is not None:
+                        return nonce
+                raise RuntimeError('all mining workers exited without finding a nonce')
+            finally:
+                # 他のワーカーに探索を止めさせ、次の探索までにプールを空ける
+                self._generation.value += 1
+                concurrent.futures.wait(futures)
+
+
+# プロセス数 -> MiningPool（BlockChainごとではなくプロセス全体で共有する）
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(workers):
+    with _pools_lock:
+        if workers not in _pools:
+            _pools[workers] = MiningPool(workers)
+        return _pools[workers]
+
+
+def proof_of_work(header_prefix, target, workers=MINING_WORKERS):
+    """
+    nonceの探索空間をworkers個のプロセスに分割してproof of workを行う
+    最初にnonceを見つけたワーカーが見つかった時点で、他のワーカーは探索を止める
+    試すnonceの数が少ない（易しいtarget）場合は、プロセス間のやり取りの方が重いので自身のプロセスで探す
+    :param header_prefix: <bytes> nonce以外のブロックヘッダー（models.Block.header_prefix）
+    :return: <int> nonce
+    """
+    if workers <= 1 or expected_hashes(target) <= IN_PROCESS_MAX_HASHES:
+        return _search_in_process(header_prefix, target)
+
+    nonce = get_pool(workers).search(header_prefix, target)
+    logger.info({'action': 'proof_of_work', 'workers': workers, 'nonce': nonce})
+    return nonce
@@ -0,0 +1,231 @@
+import hashlib
+import json
+import struct
+
+import merkle
+import utils
+
+# トランザクションのバイト列の形式のバージョン
+TRANSACTION_ENCODING_VERSION = 1
+# ブロックヘッダーの形式のバージョン
+BLOCK_HEADER_VERSION = 2
+# Block.to_jsonでトランザクションの位置を見つけるための仮の値
+TRANSACTIONS_PLACEHOLDER = '__transactions__'
+
+
+# ブロックヘッダーのnonce以外の部分: version, index, previous_hash, merkle_root, timestamp, target
+_HEADER_PREFIX = struct.Struct('>BQ32s32sd32s')
+_NONCE = struct.Struct('>Q')
+
+
+def _encode_str(value):
+    data = value.encode('utf-8')
+    return struct.pack('>I', len(data)) + data
+
+
+def block_header_prefix(index, previous_hash, merkle_root, timestamp, target):
+    # proof_of_workではnonce以外は変わらないので、この部分のsha256の途中状態を使い回す
+    return _HEADER_PREFIX.pack(
+        BLOCK_HEADER_VERSION, index, bytes.fromhex(previous_hash), bytes.fromhex(merkle_root), timestamp,
+        target.to_bytes(32, 'big'))
+
+
+def encode_target(target):
+    # jsonでは256bitの整数を扱えない環境もあるので、64桁のhexにする
+    return '%064x' % target
+
+
+def encode_nonce(nonce):
+    return _NONCE.pack(nonce)
+
+
+def block_header_hash(header):
+    # Block.header_fieldsの値からブロックのハッシュ値を計算する（ブロック全体がなくても計算できる）
+    prefix = block_header_prefix(
+        header['index'], header['previous_hash'], header['merkle_root'], header['timestamp'], int(header['target'], 16))
+    return hashlib.sha256(prefix + encode_nonce(header['nonce'])).hexdigest()
+
+
+class Transaction(object):
+    """
+    トランザクション
+    __slots__でインスタンスごとの__dict__を持たないようにしてメモリを節約する
+    json（/chainやgossip）にはto_dictで変換する（utils.sort_dict_by_keyで作成していた時と同じ内容になる）
+
+    署名・検証・トランザクションID・ブロックのハッシュ値の計算には、一度だけ作成したバイト列・jsonを使い回す
+    timestampは同じ送金者・受取人・金額のトランザクションを区別するために使う
+    （timestampがないトランザクションは以前の形式で署名されたもの）
+    """
+    __slots__ = (
+        'sender_blockchain_address', 'recipient_blockchain_address', 'value', 'timestamp',
+        '_encoding', '_transaction_id', '_json',
+    )
+
+    def __init__(self, sender_blockchain_address, recipient_blockchain_address, value, timestamp=None):
+        self.sender_blockchain_address = sender_blockchain_address
+        self.recipient_blockchain_address = recipient_blockchain_address
+        self.value = float(value)  # bitcoinは小数点以下を扱う
+        self.timestamp = None if timestamp is None else float(timestamp)
+        self._encoding = None
+        self._transaction_id = None
+        self._json = None
+
+    def __getitem__(self, key):
+        # dictと同じようにtransaction['value']で値を取得できるようにする
+        return getattr(self, key)
+
+    def __repr__(self):
+        return f'Transaction({self.to_dict()!r})'
+
+    def to_dict(self):
+        transaction = {
+            'sender_blockchain_address': self.sender_blockchain_address,
+            'recipient_blockchain_address': self.recipient_blockchain_address,
+            'value': self.value,
+        }
+        if self.timestamp is not None:
+            transaction['timestamp'] = self.timestamp
+        return utils.sort_dict_by_key(transaction)
+
+    def to_json(self):
+        # ブロックのハッシュ値の計算で使うjson（json.dumps(sort_keys=True)と同じ文字列）
+        if self._json is None:
+            self._json = json.dumps(self.to_dict(), sort_keys=True)
+        return self._json
+
+    def encode(self):
+        """
+        バージョン付きのバイト列
+        version(1byte) + 送金者 + 受取人（それぞれ4byteの長さ + utf-8） + value(8byte) + timestamp(1byte + 8byte)
+        """
+        if self._encoding is None:
+            self._encoding = b''.join([
+                struct.pack('>B', TRANSACTION_ENCODING_VERSION),
+                _encode_str(self.sender_blockchain_address),
+                _encode_str(self.recipient_blockchain_address),
+                struct.pack('>d?d', self.value, self.timestamp is not None, self.timestamp or 0.0),
+            ])
+        return self._encoding
+
+    @property
+    def transaction_id(self):
+        # バイト列のsha256
+        if self._transaction_id is None:
+            self._transaction_id = hashlib.sha256(self.encode()).hexdigest()
+        return self._transaction_id
+
+    def signing_message(self):
+        # 署名の対象（トランザクションIDと同じsha256）
+        return bytes.fromhex(self.transaction_id)
+
+    def legacy_signing_message(self):
+        # 以前の形式の署名の対象（OrderedDictのreprのsha256）
+        return hashlib.sha256(str(self.to_dict()).encode('utf-8')).digest()
+
+    @classmethod
+    def from_dict(cls, transaction):
+        return cls(
+            transaction['sender_blockchain_address'],
+            transaction['recipient_blockchain_address'],
+            transaction['value'],
+            transaction.get('timestamp'),
+        )
+
+
+class Block(object):
+    """
+    ブロック
+    ハッシュ値は固定長のヘッダー（index, previous_hash, merkle_root, timestamp, target, nonce）のsha256
+    トランザクションはマークルルートでヘッダーに含まれるので、ブロックの大きさに関係なくハッシュ値の計算の重さは変わらない
+    ハッシュ値は最初に必要になった時に一度だけ計算して保持する（作成後にブロックの中身を書き換えてはいけない）
+    """
+    __slots__ = ('index', 'timestamp', 'transactions', 'nonce', 'previous_hash', 'target', 'merkle_root', '_hash')
+
+    def __init__(self, index, timestamp, transactions, nonce, previous_hash, target, merkle_root=None):
+        self.index = index
+        self.timestamp = timestamp
+        self.transactions = tuple(transactions)
+        self.nonce = nonce
+        self.previous_hash = previous_hash
+        # ハッシュ値（256bitの整数）の上限
+        self.target = target
+        # 他ノードから受け取ったブロックは送られてきた値を使う（トランザクションと一致するかはvalid_chainで検証する）
+        self.merkle_root = self.compute_merkle_root() if merkle_root is None else merkle_root
+        self._hash = None
+
+    def __getitem__(self, key):
+        # dictと同じようにblock['transactions']で値を取得できるようにする
+        return getattr(self, key)
+
+    def __repr__(self):
+        return f'Block({self.to_dict()!r})'
+
+    def _fields(self, transactions):
+        return utils.sort_dict_by_key({
+            'index': self.index,
+            'timestamp': self.timestamp,
+            'transactions': transactions,
+            'nonce': self.nonce,
+            'previous_hash': self.previous_hash,
+            'target': encode_target(self.target),
+            'merkle_root': self.merkle_root,
+        })
+
+    def transaction_ids(self):
+        return [transaction.transaction_id for transaction in self.transactions]
+
+    def compute_merkle_root(self):
+        return merkle.merkle_root(self.transaction_ids())
+
+    def merkle_proof(self, position):
+        # position番目のトランザクションがこのブロックに含まれることの証明
+        return merkle.merkle_proof(self.transaction_ids(), position)
+
+    def header_prefix(self):
+        return block_header_prefix(self.index, self.previous_hash, self.merkle_root, self.timestamp, self.target)
+
+    def header(self):
+        # ブロックヘッダー（固定長のバイト列）
+        return self.header_prefix() + encode_nonce(self.nonce)
+
+    def header_fields(self):
+        # ブロックヘッダーの値（block_header_hashでハッシュ値を計算できる）
+        return {
+            'index': self.index,
+            'previous_hash': self.previous_hash,
+            'merkle_root': self.merkle_root,
+            'timestamp': self.timestamp,
+            'target': encode_target(self.target),
+            'nonce': self.nonce,
+        }
+
+    def to_dict(self):
+        return self._fields([transaction.to_dict() for transaction in self.transactions])
+
+    def to_json(self):
+        # json.dumps(self.to_dict(), sort_keys=True)と同じ文字列（/chainのレスポンスで使う）
+        # トランザクションのjsonは各トランザクションが保持しているものを使い回す
+        return json.dumps(self._fields(TRANSACTIONS_PLACEHOLDER), sort_keys=True).replace(
+            json.dumps(TRANSACTIONS_PLACEHOLDER),
+            '[' + ', '.join(transaction.to_json() for transaction in self.transactions) + ']',
+            1,
+        )
+
+    @property
+    def hash(self):
+        # ブロックヘッダーのsha256（proof_of_workで整数としてtarget以下になるようにnonceを探す値）
+        if self._hash is None:
+            self._hash = hashlib.sha256(self.header()).hexdigest()
+        return self._hash
+
+    @classmethod
+    def from_dict(cls, block):
+        return cls(
+            block['index'],
+            block['timestamp'],
+            [Transaction.from_dict(transaction) for transaction in block['transactions']],
+            block['nonce'],
+            block['previous_hash'],
+            int(block['target'], 16),
+            block.get('merkle_root'),
+        )
@@ -0,0 +1,59 @@
+import concurrent.futures
+import threading
+
+
+class ProcessPool(object):
+    """
+    必要になった時に1度だけ作成するプロセスプール
+    ブロックの検証・署名の検証・署名・walletの作成・マイニングで使う（プロセスの起動は重いので、処理ごとには作成しない）
+    複数のスレッド（Flaskのリクエスト、バックグラウンドの処理）から同時に使っても、プールは1つだけ作成する
+    ワーカーに渡す関数はpickleできるように、モジュールのトップレベルの関数にする
+    """
+
+    def __init__(self, workers, initializer=None, initargs=()):
+        self.workers = workers
+        self._initializer = initializer
+        self._initargs = initargs
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = concurrent.futures.ProcessPoolExecutor(
+                    max_workers=self.workers, initializer=self._initializer, initargs=self._initargs)
+            return self._executor
+
+    def imap_chunks(self, func, sequences, chunks=None):
+        """
+        同じ長さのsequencesをchunks個（デフォルトはworkers個）に均等に分けて、func(*チャンク)を並列に実行する
+        結果はチャンクの順番に返す。途中で読むのをやめた場合は、まだ開始していないチャンクを実行しない
+        :param sequences: <tuple> funcの引数になるリスト（全て同じ長さ）
+        :return: <generator> チャンクごとのfuncの戻り値
+        """
+        length = len(sequences[0])
+        chunk_size = max(-(-length // (chunks or self.workers)), 1)
+        executor = self.executor()
+        futures = [
+            executor.submit(func, *(sequence[start:start + chunk_size] for sequence in sequences))
+            for start in range(0, length, chunk_size)
+        ]
+        try:
+            for future in futures:
+                yield future.result()
+        finally:
+            for future in futures:
+                future.cancel()
+
+    def map_chunks(self, func, items, chunks=None):
+        # itemsをチャンクに分けて並列に処理し、itemsと同じ順番の結果のリストを返す（funcはリストを返す）
+        results = []
+        for chunk_results in self.imap_chunks(func, (items,), chunks):
+            results.extend(chunk_results)
+        return results
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown()
+                self._executor = None
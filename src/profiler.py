@@ -0,0 +1,210 @@
+import collections
+import cProfile
+import json
+import marshal
+import pstats
+import sys
+import threading
+import time
+
+# サンプリングの間隔
+PROFILER_SAMPLE_INTERVAL_SEC = 0.005
+# 止め忘れても負荷をかけ続けないように、この時間が経ったらサンプリングを止める
+PROFILER_MAX_DURATION_SEC = 300
+# 1つのスタックで記録する最大の深さ
+PROFILER_MAX_STACK_DEPTH = 128
+# レポートに含める関数の数
+PROFILE_TOP_FUNCTIONS = 30
+# リクエストのプロファイルの並び順（pstatsのsort key）
+PROFILE_SORT_KEYS = ('cumulative', 'tottime', 'calls')
+
+
+def function_name(filename, line, name):
+    # pstatsと同じ形式（ファイル名:行番号(関数名)）
+    return f'{filename}:{line}({name})'
+
+
+class SamplingProfiler(object):
+    """
+    全スレッド（Flaskのリクエスト、start_mining・sync_neighborsのTimerなど）のスタックを一定間隔で記録する
+    実行中の処理に手を加えないので、再起動せずに開始・停止できる
+    開始していない間はスレッドも動いていないので負荷はない
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stop = threading.Event()
+        # (スレッド名, スタック（外側から順番の関数のtuple）) -> サンプル数
+        self._stacks = collections.Counter()
+        self.samples = 0
+        self.interval = PROFILER_SAMPLE_INTERVAL_SEC
+        self.started_at = None
+        self.stopped_at = None
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, interval=PROFILER_SAMPLE_INTERVAL_SEC, max_duration=PROFILER_MAX_DURATION_SEC):
+        # すでに実行中の場合はFalse
+        with self._lock:
+            if self.running:
+                return False
+            self._stacks = collections.Counter()
+            self.samples = 0
+            self.interval = interval
+            self.started_at = time.time()
+            self.stopped_at = None
+            self._stop.clear()
+            self._thread = threading.Thread(
+                target=self._run, args=(interval, time.monotonic() + max_duration), name='profiler', daemon=True)
+            self._thread.start()
+            return True
+
+    def stop(self):
+        with self._lock:
+            thread = self._thread
+            self._stop.set()
+        if thread is not None:
+            thread.join()
+        return self.report()
+
+    def _run(self, interval, deadline):
+        own_ident = threading.get_ident()
+        while not self._stop.wait(interval) and time.monotonic() < deadline:
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own_ident:
+                    continue
+                stack = []
+                while frame is not None and len(stack) < PROFILER_MAX_STACK_DEPTH:
+                    code = frame.f_code
+                    stack.append((code.co_filename, code.co_firstlineno, code.co_name))
+                    frame = frame.f_back
+                stack.reverse()
+                self._stacks[(names.get(ident, str(ident)), tuple(stack))] += 1
+            self.samples += 1
+        self.stopped_at = time.time()
+
+    def report(self, top=PROFILE_TOP_FUNCTIONS):
+        """
+        self: その関数を実行していたサンプル数、total: その関数がスタックに含まれていたサンプル数
+        """
+        stacks = dict(self._stacks)
+        self_counts = collections.Counter()
+        total_counts = collections.Counter()
+        thread_counts = collections.Counter()
+        for (thread, stack), count in stacks.items():
+            thread_counts[thread] += count
+            if stack:
+                self_counts[stack[-1]] += count
+            for function in set(stack):
+                total_counts[function] += count
+
+        def functions(counts):
+            return [
+                {
+                    'function': function_name(*function),
+                    'self': self_counts[function],
+                    'total': total_counts[function],
+                }
+                for function, _ in counts.most_common(top)
+            ]
+
+        return {
+            'running': self.running,
+            'samples': self.samples,
+            'interval': self.interval,
+            'started_at': self.started_at,
+            'stopped_at': self.stopped_at,
+            'threads': dict(thread_counts.most_common()),
+            'top_self': functions(self_counts),
+            'top_total': functions(total_counts),
+        }
+
+    def collapsed(self):
+        # flamegraph.pl・speedscopeで読み込める形式（スレッド名;外側の関数;...;内側の関数 サンプル数）
+        lines = []
+        for (thread, stack), count in sorted(self._stacks.items()):
+            frames = [thread] + [f'{name} ({filename}:{line})' for filename, line, name in stack]
+            lines.append(f'{";".join(frames)} {count}')
+        return '\n'.join(lines) + '\n'
+
+
+def top_functions(stats, sort='cumulative', limit=PROFILE_TOP_FUNCTIONS):
+    # cProfileの結果から上位の関数を返す
+    index = {'calls': 1, 'tottime': 2, 'cumulative': 3}[sort]
+    rows = sorted(stats.stats.items(), key=lambda item: item[1][index], reverse=True)[:limit]
+    return [
+        {
+            'function': function_name(*function),
+            'primitive_calls': primitive_calls,
+            'calls': calls,
+            'tottime': tottime,
+            'cumulative': cumulative,
+        }
+        for function, (primitive_calls, calls, tottime, cumulative, _) in rows
+    ]
+
+
+class RequestProfilerMiddleware(object):
+    """
+    X-Profileヘッダーがついたリクエストだけを、cProfileを有効にして処理する
+    - X-Profile: cumulative・tottime・calls -> 元のレスポンスの代わりに上位の関数をjsonで返す（X-Profile-Limitで数を指定）
+    - X-Profile: pstats -> pstatsのファイル（python -m pstatsで読み込める）を返す
+    authorizeがFalseを返すリクエストはそのまま処理する
+    有効にする場合だけwsgi_appをこのクラスで包むので、無効の場合は何もしない
+    """
+
+    def __init__(self, app, authorize):
+        self.app = app
+        self.authorize = authorize
+
+    def __call__(self, environ, start_response):
+        mode = environ.get('HTTP_X_PROFILE')
+        if not mode or not self.authorize(environ):
+            return self.app(environ, start_response)
+        if mode != 'pstats' and mode not in PROFILE_SORT_KEYS:
+            start_response('400 BAD REQUEST', [('Content-Type', 'application/json')])
+            return [json.dumps({'message': f'X-Profile must be pstats or one of {PROFILE_SORT_KEYS}'}).encode()]
+
+        captured = {}
+
+        def capture(status, headers, exc_info=None):
+            captured['status'] = status
+            return lambda data: None
+
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            # ストリーミングのレスポンスも最後まで読み込んだ時間を含める
+            iterable = self.app(environ, capture)
+            try:
+                size = sum(len(chunk) for chunk in iterable)
+            finally:
+                if hasattr(iterable, 'close'):
+                    iterable.close()
+        finally:
+            profile.disable()
+        stats = pstats.Stats(profile)
+
+        headers = [('X-Profile-Status', captured.get('status', '')), ('X-Profile-Bytes', str(size))]
+        if mode == 'pstats':
+            body = marshal.dumps(stats.stats)
+            headers += [
+                ('Content-Type', 'application/octet-stream'),
+                ('Content-Disposition', 'attachment; filename="request.pstats"'),
+            ]
+        else:
+            limit = environ.get('HTTP_X_PROFILE_LIMIT', '')
+            limit = int(limit) if limit.isdigit() else PROFILE_TOP_FUNCTIONS
+            body = json.dumps({
+                'status': captured.get('status'),
+                'total_time': stats.total_tt,
+                'functions': top_functions(stats, mode, limit),
+            }).encode()
+            headers.append(('Content-Type', 'application/json'))
+        headers.append(('Content-Length', str(len(body))))
+        start_response('200 OK', headers)
+        return [body]
@@ -0,0 +1,138 @@
+import collections
+import itertools
+import json
+import logging
+import os
+import sys
+import time
+
+import parallel
+import wallet
+
+logger = logging.getLogger(__name__)
+
+# 1つのワーカーでまとめて作成するwalletの数（プロセス間の受け渡しの回数を減らす）
+PROVISION_CHUNK_SIZE = 1000
+# walletの作成に使うプロセス数（デフォルトはCPUのコア数）
+PROVISION_WORKERS = os.cpu_count() or 1
+# この数より少ない場合はプロセスプールを使わずに作成する
+PARALLEL_PROVISION_MIN_COUNT = 1000
+# ワーカーごとに先に投入しておくチャンクの数（多いほど待ち時間は減るが、出力が遅い場合にメモリを使う）
+PROVISION_PREFETCH_CHUNKS = 2
+
+
+def _generate_wallets(count):
+    # count個のwalletのNDJSON（1行が1つのwallet）
+    lines = []
+    for _ in range(count):
+        my_wallet = wallet.Wallet()
+        lines.append(json.dumps({
+            'private_key': my_wallet.private_key,
+            'public_key': my_wallet.public_key,
+            'blockchain_address': my_wallet.blockchain_address,
+        }) + '\n')
+    return ''.join(lines)
+
+
+class WalletProvisioner(object):
+    """
+    大量のwalletをプロセスプールで作成し、NDJSONのチャンクとして順番に返す
+    - walletの作成（楕円曲線の演算）はCPUを使うので、スレッドではなくプロセスで並列にする
+    - ワーカーはjsonに変換した文字列を返すので、親プロセスではそのまま書き出すだけで済む
+    - 投入するチャンクの数を制限するので、100万件でも全体をメモリに載せない
+    """
+
+    def __init__(self, workers=PROVISION_WORKERS, chunk_size=PROVISION_CHUNK_SIZE):
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self._pool = parallel.ProcessPool(workers)
+
+    def _chunk_sizes(self, count):
+        for start in range(0, count, self.chunk_size):
+            yield min(self.chunk_size, count - start)
+
+    def generate(self, count):
+        """
+        :param count: <int> 作成するwalletの数
+        :return: <generator> NDJSONのチャンク（str）
+        """
+        if self.workers <= 1 or count < PARALLEL_PROVISION_MIN_COUNT:
+            for size in self._chunk_sizes(count):
+                yield _generate_wallets(size)
+            return
+
+        executor = self._pool.executor()
+        sizes = self._chunk_sizes(count)
+        pending = collections.deque(
+            executor.submit(_generate_wallets, size)
+            for size in itertools.islice(sizes, self.workers * PROVISION_PREFETCH_CHUNKS)
+        )
+        try:
+            while pending:
+                chunk = pending.popleft().result()
+                # 1つ受け取ったら次のチャンクを1つ投入する（出力が遅い場合は作成も待つ）
+                size = next(sizes, None)
+                if size is not None:
+                    pending.append(executor.submit(_generate_wallets, size))
+                yield chunk
+        finally:
+            # 途中でクライアントが切断した場合は、残りのチャンクを作成しない
+            for future in pending:
+                future.cancel()
+
+    def shutdown(self):
+        self._pool.shutdown()
+
+
+def write_wallets(provisioner, count, output, split=None):
+    """
+    walletをチャンクごとにファイルへ書き出す
+    :param output: <str> 出力するファイル（splitを指定した場合は output.00000, output.00001, ...）
+    :param split: <int> 1つのファイルに書くwalletの数（provisionerのchunk_sizeの倍数に切り上げる）
+    :return: <list> 書き出したファイル
+    """
+    if split:
+        split = -(-split // provisioner.chunk_size) * provisioner.chunk_size
+    paths = []
+    f = None
+    written = 0
+    started_at = time.time()
+    try:
+        for chunk in provisioner.generate(count):
+            if f is None or (split and written and written % split == 0):
+                if f is not None:
+                    f.close()
+                path = f'{output}.{len(paths):05d}' if split else output
+                f = open(path, 'w')
+                paths.append(path)
+            f.write(chunk)
+            written += chunk.count('\n')
+            logger.info({'action': 'write_wallets', 'written': written, 'count': count})
+    finally:
+        if f is not None:
+            f.close()
+    logger.info({'action': 'write_wallets', 'count': written, 'files': len(paths), 'time': time.time() - started_at})
+    return paths
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser()
+    parser.add_argument('-n', '--count', required=True, type=int, help='number of wallets')
+    parser.add_argument('-o', '--output', default=None, type=str, help='file to write the wallets as NDJSON (default: stdout)')
+    parser.add_argument('-w', '--workers', default=PROVISION_WORKERS, type=int, help='number of processes')
+    parser.add_argument('-c', '--chunk-size', default=PROVISION_CHUNK_SIZE, type=int, help='wallets per worker task')
+    parser.add_argument('--split', default=None, type=int, help='wallets per output file')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, stream=sys.stderr)
+    provisioner = WalletProvisioner(args.workers, args.chunk_size)
+    try:
+        if args.output:
+            write_wallets(provisioner, args.count, args.output, args.split)
+        else:
+            for chunk in provisioner.generate(args.count):
+                sys.stdout.write(chunk)
+    finally:
+        provisioner.shutdown()
@@ -0,0 +1,132 @@
+import collections
+import logging
+import threading
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+
+# 結果を保持しておく終了したジョブの数
+MINING_JOB_HISTORY = 1000
+# chainが置き換えられてマイニングが無駄になった場合に、同じジョブでやり直す回数
+MINING_JOB_ATTEMPTS = 3
+
+JOB_QUEUED = 'queued'
+JOB_RUNNING = 'running'
+JOB_SUCCEEDED = 'succeeded'
+JOB_FAILED = 'failed'
+
+
+class MiningJob(object):
+    # /mineのリクエスト1つ（まとめられた場合は複数）に対応するマイニング
+
+    def __init__(self):
+        self.job_id = uuid.uuid4().hex
+        self.status = JOB_QUEUED
+        # このジョブにまとめられたリクエストの数
+        self.requests = 1
+        self.attempts = 0
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.block = None
+        self.error = None
+        self._finished = threading.Event()
+
+    @property
+    def finished(self):
+        return self._finished.is_set()
+
+    def wait(self, timeout=None):
+        return self._finished.wait(timeout)
+
+    def finish(self, block, error=None):
+        self.block = block
+        self.error = error
+        self.status = JOB_SUCCEEDED if block is not None else JOB_FAILED
+        self.finished_at = time.time()
+        self._finished.set()
+
+    def to_dict(self):
+        return {
+            'job_id': self.job_id,
+            'status': self.status,
+            'requests': self.requests,
+            'attempts': self.attempts,
+            'created_at': self.created_at,
+            'started_at': self.started_at,
+            'finished_at': self.finished_at,
+            'block': self.block.to_dict() if self.block is not None else None,
+            'error': self.error,
+        }
+
+
+class MiningScheduler(object):
+    """
+    マイニングのリクエストを1つのバックグラウンドのスレッドで順番に実行する
+    - submitはジョブをすぐに返す（リクエストのスレッドはproof of workの間待たされない）
+    - まだ開始していないジョブがある間のリクエストは、そのジョブにまとめる（同じブロックを何度もマイニングしない）
+    - 実行中のジョブがある間のリクエストは、その次のブロックのジョブになる
+    """
+
+    def __init__(self, mine, history=MINING_JOB_HISTORY, attempts=MINING_JOB_ATTEMPTS):
+        # mine: 作成したブロックを返す関数（chainが置き換えられてブロックを作成できなかった場合はFalse）
+        self.mine = mine
+        self.history = history
+        self.attempts = attempts
+        self._jobs = collections.OrderedDict()
+        self._pending = None
+        self._condition = threading.Condition()
+        self._thread = None
+
+    def submit(self):
+        with self._condition:
+            if self._pending is not None:
+                self._pending.requests += 1
+                return self._pending
+            job = MiningJob()
+            self._pending = job
+            self._jobs[job.job_id] = job
+            self._trim()
+            if self._thread is None:
+                # プロファイラーの結果でスレッドを区別できるように名前をつける
+                self._thread = threading.Thread(target=self._run, name='mining_scheduler', daemon=True)
+                self._thread.start()
+            self._condition.notify()
+            return job
+
+    def get(self, job_id):
+        with self._condition:
+            return self._jobs.get(job_id)
+
+    def _trim(self):
+        # 古い順に終了したジョブの結果を削除する
+        for job_id in list(self._jobs):
+            if len(self._jobs) <= self.history:
+                break
+            if self._jobs[job_id].finished:
+                del self._jobs[job_id]
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while self._pending is None:
+                    self._condition.wait()
+                job = self._pending
+                self._pending = None
+                job.status = JOB_RUNNING
+                job.started_at = time.time()
+            self._execute(job)
+
+    def _execute(self, job):
+        try:
+            block = False
+            while not block and job.attempts < self.attempts:
+                job.attempts += 1
+                block = self.mine()
+        except Exception as ex:
+            logger.exception({'action': 'mining_job', 'job_id': job.job_id, 'error': repr(ex)})
+            job.finish(None, repr(ex))
+            return
+        job.finish(block or None, None if block else 'chain was replaced while mining')
+        logger.info({'action': 'mining_job', 'job_id': job.job_id, 'status': job.status, 'requests': job.requests})
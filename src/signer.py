@@ -0,0 +1,161 @@
+import collections
+import hashlib
+import logging
+import os
+import threading
+import time
+
+from ecdsa import NIST256p
+from ecdsa import SigningKey
+
+import parallel
+
+logger = logging.getLogger(__name__)
+
+# 復元したprivateKeyを保持しておく時間（最初に使ってからの時間。使い続けても延長しない）
+SIGNING_KEY_CACHE_TTL_SEC = 300
+# 復元したprivateKeyを保持しておく数
+SIGNING_KEY_CACHE_SIZE = 1024
+# 期限切れのprivateKeyを削除する間隔
+SIGNING_KEY_SWEEP_SEC = 10
+# 署名に使うプロセス数（デフォルトはCPUのコア数）
+SIGNING_WORKERS = os.cpu_count() or 1
+# この数より少ない署名はプロセスプールを使わずに行う
+PARALLEL_SIGNING_MIN_BATCH = 16
+
+
+class _CachedKey(object):
+    __slots__ = ('secret', 'signing_key', 'expires_at')
+
+    def __init__(self, secret, signing_key, expires_at):
+        self.secret = secret
+        self.signing_key = signing_key
+        self.expires_at = expires_at
+
+    def zero(self):
+        # 保持していたprivateKeyを0で上書きする（復元したSigningKeyもそれ以降は使えなくなる）
+        # Pythonのint・strは上書きできないので、参照を外してガベージコレクションに任せる
+        self.secret[:] = bytes(len(self.secret))
+        self.signing_key.privkey.secret_multiplier = 0
+        self.signing_key = None
+
+
+class SigningKeyCache(object):
+    """
+    hexのprivateKeyから復元したSigningKeyを一定時間だけ保持する
+    SigningKey.from_stringはpublicKeyの計算（楕円曲線の演算）を含むので、同じ送信者の2回目以降の署名が速くなる
+    - キーはprivateKeyのsha256（privateKeyそのものをdictのキーとして残さない）
+    - 期限切れ・最大数を超えて削除したprivateKeyは0で上書きする
+    - 署名中に削除されないように、署名はロックを取って行う（ecdsaはpure Pythonなので、スレッドで並列にはならない）
+    """
+
+    def __init__(self, ttl=SIGNING_KEY_CACHE_TTL_SEC, max_size=SIGNING_KEY_CACHE_SIZE):
+        self.ttl = ttl
+        self.max_size = max_size
+        # 期限は追加した順番なので、先頭から期限切れを削除できる
+        self._keys = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._sweeper = None
+
+    def __len__(self):
+        return len(self._keys)
+
+    def sign(self, private_key, message):
+        # messageをprivateKey（hex）で署名する
+        secret = bytearray.fromhex(private_key)
+        cache_key = hashlib.sha256(secret).digest()
+        now = time.monotonic()
+        with self._lock:
+            self._evict_expired(now)
+            cached = self._keys.get(cache_key)
+            if cached is not None:
+                secret[:] = bytes(len(secret))
+                return cached.signing_key.sign(message)
+
+        signing_key = SigningKey.from_string(bytes(secret), curve=NIST256p)
+        with self._lock:
+            cached = self._keys.get(cache_key)
+            if cached is None:
+                cached = self._keys[cache_key] = _CachedKey(secret, signing_key, now + self.ttl)
+            else:
+                secret[:] = bytes(len(secret))
+            signature = cached.signing_key.sign(message)
+            while len(self._keys) > self.max_size:
+                self._keys.popitem(last=False)[1].zero()
+            self._start_sweeper()
+        return signature
+
+    def clear(self):
+        with self._lock:
+            while self._keys:
+                self._keys.popitem(last=False)[1].zero()
+
+    def _evict_expired(self, now):
+        while self._keys:
+            cached = next(iter(self._keys.values()))
+            if cached.expires_at > now:
+                break
+            self._keys.popitem(last=False)[1].zero()
+
+    def _start_sweeper(self):
+        # リクエストがなくても期限切れのprivateKeyを削除する
+        if self._sweeper is None:
+            self._sweeper = threading.Thread(target=self._sweep, name='signing_key_cache', daemon=True)
+            self._sweeper.start()
+
+    def _sweep(self):
+        while True:
+            time.sleep(SIGNING_KEY_SWEEP_SEC)
+            with self._lock:
+                self._evict_expired(time.monotonic())
+
+
+# プロセスごとのキャッシュ（プロセスプールのワーカーもそれぞれ保持する）
+_key_cache = SigningKeyCache()
+
+
+def sign(private_key, message, key_cache=None):
+    # messageをprivateKeyで署名してhexで返す
+    return (key_cache or _key_cache).sign(private_key, message).hex()
+
+
+def sign_transaction(private_key, transaction, key_cache=None):
+    # ブロックチェーンノードと共通のバイト列のsha256（トランザクションID）に署名する
+    return sign(private_key, transaction.signing_message(), key_cache)
+
+
+def _sign_items(items):
+    """
+    :param items: <list> (privateKey, 署名の対象)のリスト
+    :return: <list> 署名（privateKeyが正しくない場合はNone）
+    """
+    signatures = []
+    for private_key, message in items:
+        try:
+            signatures.append(sign(private_key, message))
+        except (AssertionError, TypeError, ValueError) as ex:
+            logger.error({'action': 'sign', 'error': repr(ex)})
+            signatures.append(None)
+    return signatures
+
+
+class TransactionSigner(object):
+    """
+    複数のトランザクションをまとめてプロセスプールで署名する
+    各ワーカーは復元したprivateKeyを自身のプロセスでキャッシュするので、同じ送信者の署名が続いても復元は1回で済む
+    """
+
+    def __init__(self, workers=SIGNING_WORKERS):
+        self.workers = workers
+        self._pool = parallel.ProcessPool(workers)
+
+    def sign_batch(self, items):
+        """
+        :param items: <list> (privateKey, models.Transaction)のリスト
+        :return: <list> itemsと同じ順番の署名（privateKeyが正しくない場合はNone）
+        """
+        messages = [(private_key, transaction.signing_message()) for private_key, transaction in items]
+        if self.workers <= 1 or len(messages) < PARALLEL_SIGNING_MIN_BATCH:
+            return _sign_items(messages)
+
+        return self._pool.map_chunks(_sign_items, messages)
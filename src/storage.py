@@ -0,0 +1,162 @@
+import array
+import json
+import logging
+import mmap
+import os
+import struct
+
+logger = logging.getLogger(__name__)
+
+# ブロックを追記していくファイル（ブロックごとに4byteの長さ + jsonを書き込む）
+BLOCK_LOG_FILE = 'blocks.log'
+# ブロックごとのblocks.log上の位置（8byte）を書き込むファイル
+BLOCK_INDEX_FILE = 'blocks.idx'
+# 残高・トランザクションプールのスナップショット
+SNAPSHOT_FILE = 'snapshot.json'
+# 何ブロックごとにスナップショットを保存するか
+SNAPSHOT_INTERVAL_BLOCKS = 100
+
+RECORD_HEADER = struct.Struct('>I')
+
+
+class BlockStore(object):
+    """
+    chainをディスクに保存する追記型のブロックストア
+    ノードを再起動した際に、他ノードからchain全体を取得し直さなくてもよいようにする
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.log_path = os.path.join(directory, BLOCK_LOG_FILE)
+        self.index_path = os.path.join(directory, BLOCK_INDEX_FILE)
+        self.snapshot_path = os.path.join(directory, SNAPSHOT_FILE)
+        # ブロックごとのblocks.log上の位置
+        self.offsets = array.array('Q')
+        self._log = open(self.log_path, 'ab+')
+        self._index = open(self.index_path, 'ab+')
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def _read_index(self):
+        with open(self.index_path, 'rb') as f:
+            data = f.read()
+        offsets = array.array('Q')
+        offsets.frombytes(data[:len(data) - len(data) % offsets.itemsize])
+        return offsets
+
+    @staticmethod
+    def _record_end(mapped, offset):
+        # offsetから始まるブロックの終わりの位置（ファイルの途中までしか書き込まれていなければNone）
+        if offset + RECORD_HEADER.size > len(mapped):
+            return None
+        end = offset + RECORD_HEADER.size + RECORD_HEADER.unpack_from(mapped, offset)[0]
+        return end if end <= len(mapped) else None
+
+    def load(self):
+        # blocks.logをメモリマップして、インデックスの位置からブロックを読み込む
+        indexed_offsets = self._read_index()
+        self.offsets = array.array('Q')
+        if not os.path.getsize(self.log_path):
+            self._truncate_files(0)
+            return []
+
+        blocks = []
+        end = 0
+        with open(self.log_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            # 書き込み途中で止まったブロックがあれば、そこから先は捨てる
+            for offset in indexed_offsets:
+                record_end = self._record_end(mapped, offset)
+                if offset != end or record_end is None:
+                    break
+                blocks.append(self._read_record(mapped, offset))
+                self.offsets.append(offset)
+                end = record_end
+            # インデックスに書き込まれる前に止まったブロックがあればインデックスに追加する
+            record_end = self._record_end(mapped, end)
+            while record_end is not None:
+                blocks.append(self._read_record(mapped, end))
+                self.offsets.append(end)
+                end = record_end
+                record_end = self._record_end(mapped, end)
+
+        # 途中まで書き込まれたブロックを切り捨てて、インデックスを書き直す
+        self._log.truncate(end)
+        self._index.truncate(0)
+        self._index.write(self.offsets.tobytes())
+        self._sync(self._log)
+        self._sync(self._index)
+        logger.info({'action': 'load', 'directory': self.directory, 'blocks': len(blocks)})
+        return blocks
+
+    @staticmethod
+    def _read_record(mapped, offset):
+        length = RECORD_HEADER.unpack_from(mapped, offset)[0]
+        start = offset + RECORD_HEADER.size
+        return json.loads(mapped[start:start + length])
+
+    def append(self, block):
+        data = json.dumps(block, sort_keys=True).encode()
+        self._log.seek(0, os.SEEK_END)
+        offset = self._log.tell()
+        self._log.write(RECORD_HEADER.pack(len(data)) + data)
+        # インデックスより先にブロックをディスクに書き込む（インデックスだけが残ることはない）
+        self._sync(self._log)
+        self.offsets.append(offset)
+        self._index.write(struct.pack('Q', offset))
+        self._sync(self._index)
+
+    def truncate(self, length):
+        # length個目より後ろのブロックを削除する（chainが置き換えられた場合）
+        if length >= len(self.offsets):
+            return
+        end = self.offsets[length]
+        del self.offsets[length:]
+        self._truncate_files(end)
+
+    def _truncate_files(self, log_size):
+        self._log.truncate(log_size)
+        self._index.truncate(len(self.offsets) * self.offsets.itemsize)
+        self._sync(self._log)
+        self._sync(self._index)
+
+    @staticmethod
+    def _sync(f):
+        # flushだけではOSのバッファに残るので、電源が落ちても消えないようにディスクまで書き込む
+        f.flush()
+        os.fsync(f.fileno())
+
+    def _sync_directory(self):
+        # os.replaceで置き換えたファイル名をディスクに書き込む（Windowsではディレクトリを開けない）
+        if os.name != 'posix':
+            return
+        fd = os.open(self.directory, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def save_snapshot(self, snapshot):
+        # 書き込み途中でスナップショットが壊れないように、一時ファイルに書いてから置き換える
+        tmp_path = self.snapshot_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(snapshot, f)
+            self._sync(f)
+        os.replace(tmp_path, self.snapshot_path)
+        self._sync_directory()
+
+    def load_snapshot(self):
+        # 空・壊れたスナップショットは無いものとして扱う（全ブロックから計算し直す）
+        if not os.path.exists(self.snapshot_path):
+            return None
+        try:
+            with open(self.snapshot_path) as f:
+                snapshot = json.load(f)
+        except (OSError, ValueError) as ex:
+            logger.warning({'action': 'load_snapshot', 'error': repr(ex)})
+            return None
+        if not isinstance(snapshot, dict):
+            logger.warning({'action': 'load_snapshot', 'error': 'invalid snapshot'})
+            return None
+        return snapshot
@@ -1,11 +1,26 @@
 import collections
+import concurrent.futures
 import logging
 import re
 import socket
+import threading
+import time
 
 logger = logging.getLogger(__name__)
 
 RE_IP = re.compile('(?P<first_ip>^\\d{1,3})\\.(?P<second_ip>\\d{1,3})\\.(?P<third_ip>\\d{1,3})\\.(?P<last_ip>\\d{1,3}$)')
+# ノードのアドレス（'host:port'）。他ノードから受け取ったアドレスはこの形式のものだけ使う
+RE_ADDRESS = re.compile('^(?P<host>[A-Za-z0-9][A-Za-z0-9.\\-]{0,252}):(?P<port>\\d{1,5})$')
+
+# 同時に接続を試すホストの最大数
+NEIGHBOR_SCAN_CONCURRENCY = 64
+# ノードが見つかった・見つからなかった結果を覚えておく時間
+HOST_FOUND_TTL_SEC = 60
+HOST_NOT_FOUND_TTL_SEC = 30
+
+# (host, port) -> (見つかったか, 確認した時刻)
+_host_cache = {}
+_host_cache_lock = threading.Lock()
 
 
 def pprint(chains):
@@ -50,6 +65,54 @@ def is_found_host(target, port):
             })
             return False
 
+def is_found_host_cached(target, port):
+    # 一定時間内に確認済みのホストは接続を試さずに前回の結果を返す
+    now = time.monotonic()
+    with _host_cache_lock:
+        cached = _host_cache.get((target, port))
+    if cached:
+        found, checked_at = cached
+        ttl = HOST_FOUND_TTL_SEC if found else HOST_NOT_FOUND_TTL_SEC
+        if now - checked_at < ttl:
+            return found
+
+    found = is_found_host(target, port)
+    with _host_cache_lock:
+        _host_cache[(target, port)] = (found, now)
+    return found
+
+
+def parse_address(address):
+    # 'host:port'を(host, port)にする（正しい形式でなければNone）
+    if not isinstance(address, str):
+        return None
+    m = RE_ADDRESS.match(address)
+    if not m or not 1 <= int(m.group('port')) <= 65535:
+        return None
+    return m.group('host'), int(m.group('port'))
+
+
+def find_live_hosts(addresses, concurrency=NEIGHBOR_SCAN_CONCURRENCY):
+    # 'host:port'のリストのうち、接続できるものを返す
+    # 1つずつ接続を試すとタイムアウト（1秒）* 候補数だけ時間がかかるので、スレッドプールで同時に試す
+    # 正しい形式でないアドレス（他ノードから受け取ったものなど）は除く
+    targets = {}
+    for address in addresses:
+        target = parse_address(address)
+        if target is None:
+            logger.warning({'action': 'find_live_hosts', 'address': repr(address), 'error': 'invalid address'})
+            continue
+        targets.setdefault(address, target)
+    if not targets:
+        return []
+
+    addresses = list(targets)
+    targets = list(targets.values())
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(concurrency, len(targets))) as executor:
+        found = list(executor.map(lambda target: is_found_host_cached(*target), targets))
+    return [address for address, is_found in zip(addresses, found) if is_found]
+
+
 def get_host():
     try:
         return socket.gethostbyname(socket.gethostname())
@@ -60,29 +123,30 @@ def get_host():
         })
         return "127.0.0.1"
 
-def find_neighbors(my_host, my_port, start_ip_range, end_ip_range, start_port, end_port):
+def find_neighbors(my_host, my_port, start_ip_range, end_ip_range, start_port, end_port, seeds=()):
     # 範囲を指定して新しいノードを見つけるメソッド
     # 自分のhost, portを元にip range, port rangeを指定して、自分以外のノードを探す
+    # seeds('host:port'のリスト)で指定したノードも候補に加える
     address = f'{my_host}:{my_port}'
+    seeds = [seed for seed in seeds if seed != address]
     m = RE_IP.match(my_host)
     if not m:
-        return None
+        return find_live_hosts(seeds) if seeds else None
 
     first_ip = m.group('first_ip')
     second_ip = m.group('second_ip')
     third_ip = m.group('third_ip')
     last_ip = m.group('last_ip')
 
-    neighbors = []
+    candidates = []
     for guess_port in range(start_port, end_port):
         for ip_range in range(start_ip_range, end_ip_range):
             guess_host = f'{int(first_ip)}.{int(second_ip)}.{int(third_ip)}.{int(last_ip) + int(ip_range)}'
             guess_address = f'{guess_host}:{guess_port}'
             if guess_address == address:
                 continue
-            if is_found_host(guess_host, guess_port):
-                neighbors.append(guess_address)
-    return neighbors
+            candidates.append(guess_address)
+    return find_live_hosts(candidates + seeds)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,135 @@
+import collections
+import logging
+import os
+import struct
+import threading
+
+import difficulty
+import metrics
+import parallel
+
+logger = logging.getLogger(__name__)
+
+# ブロックの検証に使うプロセス数（デフォルトはCPUのコア数）
+VALIDATION_WORKERS = os.cpu_count() or 1
+# この数より少ないブロックの検証はプロセスプールを使わずに行う（プロセス間のやり取りの方が重くなるため）
+PARALLEL_VALIDATION_MIN_BLOCKS = 1000
+# 1つのワーカーにまとめて渡すブロックの数の目安（ワーカー数 * この値 個のチャンクに分ける）
+CHUNKS_PER_WORKER = 4
+# 検証済みのブロックのハッシュ値を覚えておく数
+VERIFIED_BLOCK_CACHE_SIZE = 100000
+
+
+def _check_blocks(blocks, skip_proofs):
+    """
+    ブロックのハッシュ値（ヘッダーのsha256）を計算し、トランザクションとマークルルート・nonceが正しいか検証する
+    各ブロックの検証には1つ前のブロックのハッシュ値(previous_hash)しか必要ないので、チャンクごとに独立して検証できる
+    :param skip_proofs: <list> ブロックごとにnonceの検証を省略するかどうか
+    :return: <list> 各ブロックのハッシュ値。正しくないブロックがあればNone
+    """
+    hashes = []
+    for block, skip_proof in zip(blocks, skip_proofs):
+        try:
+            block_hash = block.hash
+        except (TypeError, ValueError, struct.error):
+            # ヘッダーの値の形式が正しくない（previous_hashがhexでないなど）
+            return None
+        # ヘッダーが検証済みでも、トランザクションが書き換えられていないかは必ず確認する
+        if block.compute_merkle_root() != block.merkle_root:
+            return None
+        # targetが正しいか（難易度の調整の通りか）はvalid_chainでまとめて検証する
+        if not skip_proof and int(block_hash, 16) > block.target:
+            return None
+        hashes.append(block_hash)
+    return hashes
+
+
+class ChainValidator(object):
+    """
+    chainの検証を行う
+    一度検証したブロックのハッシュ値を覚えておき、次回以降はそのブロックのnonceの検証を省略する
+    検証するブロックが多い場合はプロセスプールで並列に検証する
+    """
+
+    def __init__(self, initial_target=difficulty.INITIAL_TARGET, workers=VALIDATION_WORKERS,
+                 cache_size=VERIFIED_BLOCK_CACHE_SIZE):
+        self.initial_target = initial_target
+        self.workers = workers
+        self.cache_size = cache_size
+        # 検証済みのブロックのハッシュ値（nonceが正しいことが確認できている）
+        self._verified = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._pool = parallel.ProcessPool(workers)
+
+    def remember(self, block_hash):
+        # 自身で作成したブロックなど、正しいことがわかっているブロックのハッシュ値を登録する
+        with self._lock:
+            self._verified[block_hash] = True
+            self._verified.move_to_end(block_hash)
+            while len(self._verified) > self.cache_size:
+                self._verified.popitem(last=False)
+
+    def is_verified(self, block_hash):
+        with self._lock:
+            return block_hash in self._verified
+
+    def _skip_proofs(self, chain):
+        # 次のブロックのprevious_hashが検証済みのハッシュ値であれば、そのブロックのnonceは検証しない
+        # （ハッシュ値の繋がりの検証で、実際にそのハッシュ値になることを確認する）
+        # 最初のブロックは検証しない。最後のブロックは次のブロックがないので必ず検証する
+        skip_proofs = [True]
+        for position in range(1, len(chain) - 1):
+            skip_proofs.append(self.is_verified(chain[position + 1]['previous_hash']))
+        if len(chain) > 1:
+            skip_proofs.append(False)
+        return skip_proofs
+
+    def _check(self, chain):
+        skip_proofs = self._skip_proofs(chain)
+        skipped = sum(skip_proofs)
+        metrics.VALID_PROOF_CALLS.labels(result='skipped').inc(skipped)
+        metrics.VALID_PROOF_CALLS.labels(result='checked').inc(len(skip_proofs) - skipped)
+        if self.workers <= 1 or len(chain) < PARALLEL_VALIDATION_MIN_BLOCKS:
+            return _check_blocks(chain, skip_proofs)
+
+        hashes = []
+        for chunk_hashes in self._pool.imap_chunks(
+                _check_blocks, (chain, skip_proofs), self.workers * CHUNKS_PER_WORKER):
+            if chunk_hashes is None:
+                return None
+            hashes.extend(chunk_hashes)
+        return hashes
+
+    def valid_chain(self, chain, history=()):
+        """
+        :param chain: <list> 最初のブロックは検証済み（自身のchainとの共通のブロック、または最初のブロック）
+        :param history: <list> chainの最初のブロックより前のブロック（2番目以降のブロックのtargetの計算に使う）
+        """
+        with metrics.VALID_CHAIN_SECONDS.time():
+            hashes = self._check(chain)
+        if hashes is None:
+            return False
+
+        # 1つ前のブロックを使ったハッシュ値であり、indexが1つ前のブロックの次であることを検証
+        # （ブロックはchain[index - 1]にあるものとして索引から参照する）
+        for i in range(1, len(chain)):
+            if chain[i]['previous_hash'] != hashes[i - 1] or chain[i]['index'] != chain[i - 1]['index'] + 1:
+                return False
+
+        # 同じトランザクションが複数のブロック（同じブロックの中も含む）に含まれていないことを検証
+        transaction_ids = set()
+        for block in chain:
+            for transaction in block['transactions']:
+                if transaction.transaction_id in transaction_ids:
+                    return False
+                transaction_ids.add(transaction.transaction_id)
+
+        # 各ブロックのtargetが、それまでのブロックのtimestampから計算した値と一致することを検証
+        history = list(history)
+        if not difficulty.valid_schedule(history + list(chain), len(history) + 1, self.initial_target):
+            return False
+
+        for block_hash in hashes[1:]:
+            self.remember(block_hash)
+        logger.info({'action': 'valid_chain', 'blocks': len(chain)})
+        return True
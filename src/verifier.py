@@ -0,0 +1,136 @@
+import functools
+import logging
+import os
+import queue
+import threading
+import time
+
+from ecdsa import BadSignatureError
+from ecdsa import NIST256p
+from ecdsa import VerifyingKey
+
+import metrics
+import parallel
+
+logger = logging.getLogger(__name__)
+
+# 署名の検証に使うプロセス数（デフォルトはCPUのコア数）
+VERIFICATION_WORKERS = os.cpu_count() or 1
+# 復元したpublicKeyを覚えておく数
+PUBLIC_KEY_CACHE_SIZE = 4096
+# この数より少ない署名の検証はプロセスプールを使わずに行う
+PARALLEL_VERIFICATION_MIN_BATCH = 16
+# バックグラウンドでまとめて検証するトランザクションの最大数
+VERIFICATION_BATCH_SIZE = 256
+# バッチが埋まるまでに待つ最大時間
+VERIFICATION_BATCH_WAIT_SEC = 0.05
+# 以前の形式（OrderedDictのrepr）で署名されたトランザクションを受け付けるか
+ACCEPT_LEGACY_SIGNATURES = True
+
+
+@functools.lru_cache(maxsize=PUBLIC_KEY_CACHE_SIZE)
+def load_verifying_key(public_key):
+    # hexのpublicKeyから楕円曲線上の点を復元するのは重いので、同じ送信者のpublicKeyは使い回す
+    return VerifyingKey.from_string(bytes().fromhex(public_key), curve=NIST256p)
+
+
+def transaction_messages(transaction):
+    # 署名の対象となるトランザクションのハッシュ値（署名の形式ごと）
+    # timestampがないトランザクションは以前の形式で署名されている可能性が高いので先に試す
+    if ACCEPT_LEGACY_SIGNATURES and transaction.timestamp is None:
+        return transaction.legacy_signing_message(), transaction.signing_message()
+    return transaction.signing_message(),
+
+
+def verify_signature(public_key, signature, *messages):
+    # 署名をpublicKeyで元に戻して比較（messagesのいずれかと一致すれば正しい署名）
+    # signatureはバイト配列で渡す必要がある
+    try:
+        verifying_key = load_verifying_key(public_key)
+        signature_bytes = bytes().fromhex(signature)
+    except (AssertionError, TypeError, ValueError) as ex:
+        # publicKey・signatureの形式が正しくない
+        logger.error({'action': 'verify_signature', 'error': repr(ex)})
+        return False
+
+    for message in messages:
+        try:
+            return verifying_key.verify(signature_bytes, message)
+        except BadSignatureError:
+            continue
+        except (AssertionError, TypeError, ValueError) as ex:
+            # signatureの長さが正しくない
+            logger.error({'action': 'verify_signature', 'error': repr(ex)})
+            return False
+    # 書き換えが起きている
+    logger.error({'action': 'verify_signature', 'error': 'BadSignatureError'})
+    return False
+
+
+def _verify_signatures(items):
+    # publicKey・signature・署名の対象のリストをまとめて検証する
+    return [verify_signature(public_key, signature, *messages) for public_key, signature, messages in items]
+
+
+class SignatureVerifier(object):
+    """
+    複数の署名をまとめてプロセスプールで検証する
+    submitされたトランザクションはバックグラウンドのスレッドでバッチにまとめて検証し、正しいものだけon_verifiedに渡す
+    """
+
+    def __init__(self, on_verified=None, workers=VERIFICATION_WORKERS):
+        self.on_verified = on_verified
+        self.workers = workers
+        self._pool = parallel.ProcessPool(workers)
+        self._queue = queue.Queue()
+        self._thread = None
+        self._thread_lock = threading.Lock()
+
+    def verify_batch(self, items):
+        """
+        :param items: <list> (public_key, signature, transaction_messagesの結果)のリスト
+        :return: <list> itemsと同じ順番の検証結果
+        """
+        if self.workers <= 1 or len(items) < PARALLEL_VERIFICATION_MIN_BATCH:
+            return _verify_signatures(items)
+
+        return self._pool.map_chunks(_verify_signatures, items)
+
+    def submit(self, public_key, signature, transaction):
+        # 検証をキューに入れてすぐに戻る
+        self._queue.put(((public_key, signature, transaction_messages(transaction)), transaction))
+        with self._thread_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='signature_verifier', daemon=True)
+                self._thread.start()
+
+    def _next_batch(self):
+        # 1件目が来るまでは待ち、それ以降はVERIFICATION_BATCH_WAIT_SECの間にきたものをまとめる
+        batch = [self._queue.get()]
+        while len(batch) < VERIFICATION_BATCH_SIZE:
+            try:
+                batch.append(self._queue.get(timeout=VERIFICATION_BATCH_WAIT_SEC))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            start = time.perf_counter()
+            try:
+                results = self.verify_batch([item for item, _ in batch])
+            except Exception as ex:
+                logger.error({'action': 'verify_batch', 'error': repr(ex)})
+                continue
+            metrics.VERIFY_BATCH_SECONDS.observe(time.perf_counter() - start)
+            metrics.SIGNATURE_VERIFICATIONS.labels(result='ok').inc(sum(results))
+            metrics.SIGNATURE_VERIFICATIONS.labels(result='failed').inc(len(results) - sum(results))
+            for (_, transaction), verified in zip(batch, results):
+                if verified:
+                    self.on_verified(transaction)
+            logger.info({
+                'action': 'verify_batch',
+                'size': len(batch),
+                'verified': sum(results),
+            })
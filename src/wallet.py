@@ -3,10 +3,12 @@ import binascii
 import base58
 import codecs
 import hashlib
+import time
 
 from ecdsa import NIST256p
 from ecdsa import SigningKey
 
+import models
 import utils
 
 
@@ -91,23 +93,25 @@ class Wallet(object):
 
 class Transaction(object):
     def __init__(self, sender_private_key, sender_public_key, sender_blockchain_address,
-                 recipient_blockchain_address, value):
+                 recipient_blockchain_address, value, timestamp=None):
         self.sender_private_key = sender_private_key
         self.sender_public_key = sender_public_key
         self.sender_blockchain_address = sender_blockchain_address
         self.recipient_blockchain_address = recipient_blockchain_address
         self.value = value
+        # 同じ相手に同じ金額を送金しても別のトランザクションになるようにtimestampを付ける
+        self.timestamp = time.time() if timestamp is None else timestamp
 
     def generate_signature(self):
-        sha256 = hashlib.sha256()
         # 相手に送信するトランザクションをprivateKeyで署名する
-        transaction = utils.sort_dict_by_key({
-            'sender_blockchain_address': self.sender_blockchain_address,
-            'recipient_blockchain_address': self.recipient_blockchain_address,
-            'value': float(self.value)
-        })
-        sha256.update(str(transaction).encode('utf-8'))
-        message = sha256.digest()
+        # 署名の対象はブロックチェーンノードと共通のバイト列のsha256（トランザクションID）
+        transaction = models.Transaction(
+            self.sender_blockchain_address,
+            self.recipient_blockchain_address,
+            self.value,
+            self.timestamp,
+        )
+        message = transaction.signing_message()
         # walletのprivateKeyを復元
         private_key = SigningKey.from_string(
             bytes().fromhex(self.sender_private_key), curve=NIST256p
@@ -150,16 +154,17 @@ if __name__ == '__main__':
         2.0,
         wallet.public_key,
         transaction.generate_signature(),
+        timestamp=transaction.timestamp,
     )
     print('ADDED?', is_added)
     if is_added:
         # 6. 送金を実行するためのマイニング開始
-        # 7. マイニングではマイニング報酬受け取り用のトランザクションをトランザクションプールに追加
+        # 7. マイニングではマイニング報酬受け取り用のトランザクションをブロックの先頭に追加
         # 8. 次にproof_of_work（マイニング難易度を満たすハッシュを作り出すことができるnonceを見つける）を実行
         # 9. nonceが見つかったら処理するトランザクションとnonce, timestamp等をまとめた「Block」を作成する
         # 10. BlockをChainにappendする = 記帳される = 送金完了
         block_chain.mining()
-    utils.pprint(block_chain.chain)
+    utils.pprint([block.to_dict() for block in block_chain.chain])
     # 送金結果
     print('A', block_chain.calculate_total_amount(wallet.blockchain_address))
     print('B', block_chain.calculate_total_amount(wallet_B.blockchain_address))
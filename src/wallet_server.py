@@ -1,16 +1,74 @@
+import threading
+import time
 import urllib.parse
 
 from flask import Flask
+from flask import Response
 from flask import jsonify
 from flask import render_template
 from flask import request
 import requests
+from requests.adapters import HTTPAdapter
 
+import difficulty
+import merkle
+import models
+import provisioning
+import signer
 import wallet
 import utils
 
 app = Flask(__name__, template_folder='./templates')
 
+cache = {}
+cache_lock = threading.Lock()
+
+# ゲートウェイ（ブロックチェーンノード）へのリクエストのタイムアウト
+GATEWAY_TIMEOUT_SEC = 3
+# /transaction/batchでゲートウェイの/transactions/batchに1回で送る数と、そのタイムアウト（ノードで署名を検証する時間を含む）
+GATEWAY_BATCH_SIZE = 1000
+GATEWAY_BATCH_TIMEOUT_SEC = 300
+# ゲートウェイへのコネクションを保持しておく数（Flaskのスレッドから同時に使う）
+GATEWAY_POOL_SIZE = 16
+# /transaction/batchで1回に署名する最大数
+MAX_SIGNING_BATCH = 100000
+# /wallet/batchで1回に作成する最大数（NDJSONでストリーミングするので、全体をメモリには載せない）
+MAX_PROVISION_BATCH = 1000000
+SENDER_KEYS = ('sender_private_key', 'sender_public_key', 'sender_blockchain_address')
+
+
+def get_gateway():
+    # ゲートウェイへのセッション（keep-aliveでコネクションを使い回す）
+    with cache_lock:
+        if 'gateway' not in cache:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=GATEWAY_POOL_SIZE)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            cache['gateway'] = session
+        return cache['gateway']
+
+
+def get_signer():
+    # 複数のトランザクションをプロセスプールで署名する
+    with cache_lock:
+        if 'signer' not in cache:
+            cache['signer'] = signer.TransactionSigner(app.config.get('workers') or signer.SIGNING_WORKERS)
+        return cache['signer']
+
+
+def get_provisioner():
+    # 大量のwalletをプロセスプールで作成する
+    with cache_lock:
+        if 'provisioner' not in cache:
+            cache['provisioner'] = provisioning.WalletProvisioner(
+                app.config.get('workers') or provisioning.PROVISION_WORKERS)
+        return cache['provisioner']
+
+
+def gateway_url(path):
+    return urllib.parse.urljoin(app.config['gw'], path)
+
 @app.route('/')
 def index():
     return render_template('./index.html')
@@ -25,6 +83,22 @@ def create_wallet():
     }
     return jsonify(response), 200
 
+@app.route('/wallet/batch', methods=['POST'])
+def create_wallet_batch():
+    """
+    {'count': 作成するwalletの数} のwalletを作成し、NDJSON（1行が1つのwallet）でストリーミングで返す
+    作成した順に返すので、全てのwalletの作成を待たずに受け取り始められる
+    """
+    request_json = request.json
+    count = request_json.get('count') if isinstance(request_json, dict) else None
+    if not isinstance(count, int) or isinstance(count, bool) or count < 1:
+        return jsonify({'message': 'invalid count'}), 400
+    if count > MAX_PROVISION_BATCH:
+        return jsonify({'message': f'too many wallets (max {MAX_PROVISION_BATCH})'}), 413
+    response = Response(get_provisioner().generate(count), mimetype='application/x-ndjson')
+    response.headers['X-Wallet-Count'] = str(count)
+    return response
+
 @app.route('/transaction', methods=['POST'])
 def create_transaction():
     request_json = request.json
@@ -44,32 +118,114 @@ def create_transaction():
     recipient_blockchain_address = request_json['recipient_blockchain_address']
     value = float(request_json['value'])
 
-    transaction = wallet.Transaction(
-        sender_private_key,
-        sender_public_key,
+    transaction = models.Transaction(
         sender_blockchain_address,
         recipient_blockchain_address,
         value,
+        time.time(),
     )
-    signature = transaction.generate_signature()
+    # 復元したprivateKeyはキャッシュされるので、同じ送信者の2回目以降の署名は速い
+    signature = signer.sign_transaction(sender_private_key, transaction)
 
+    # privateKeyはゲートウェイには送らない
     json_data = {
-        'sender_private_key': sender_private_key,
         'sender_public_key': sender_public_key,
         'sender_blockchain_address': sender_blockchain_address,
         'recipient_blockchain_address': recipient_blockchain_address,
         'value': value,
         'signature': signature,
+        'timestamp': transaction.timestamp,
     }
 
-    response = requests.post(
-        urllib.parse.urljoin(app.config['gw'], 'transactions'),
-        json=json_data,
-        timeout=3,
-    )
+    response = get_gateway().post(gateway_url('transactions'), json=json_data, timeout=GATEWAY_TIMEOUT_SEC)
     if response.status_code == 201:
-        return jsonify({'message': 'success'}), 201
-    return jsonify({'message': 'fail', 'response': response}), 400
+        # /wallet/transaction/verifyでブロックに含まれたか確認するためのID
+        return jsonify({'message': 'success', 'transaction_id': transaction.transaction_id}), 201
+    return jsonify({'message': 'fail', 'error': response.text}), 400
+
+@app.route('/transaction/batch', methods=['POST'])
+def create_transaction_batch():
+    """
+    複数の送金をまとめて署名し、ゲートウェイの/transactions/batchに送る
+    {
+        'sender_private_key', 'sender_public_key', 'sender_blockchain_address': 全ての送金で共通の送信者（省略可）,
+        'transactions': [{'recipient_blockchain_address', 'value', （送信者ごとに異なる場合は）'sender_private_key', ...}],
+        'submit': Falseの場合は署名だけ返してゲートウェイには送らない,
+    }
+    署名はプロセスプールで並列に行い、送金ごとの結果を同じ順番で返す
+    """
+    request_json = request.json
+    items = request_json.get('transactions') if isinstance(request_json, dict) else None
+    if not isinstance(items, list):
+        return jsonify({'message': 'missing values'}), 400
+    if len(items) > MAX_SIGNING_BATCH:
+        return jsonify({'message': f'too many transactions (max {MAX_SIGNING_BATCH})'}), 413
+    defaults = {key: request_json[key] for key in SENDER_KEYS if key in request_json}
+
+    results = []
+    signing = []
+    for item in items:
+        result = {'transaction_id': None, 'signature': None, 'accepted': None, 'error': None}
+        results.append(result)
+        item = dict(defaults, **item) if isinstance(item, dict) else {}
+        if not all(k in item for k in SENDER_KEYS + ('recipient_blockchain_address', 'value')):
+            result['error'] = 'missing values'
+            continue
+        try:
+            transaction = models.Transaction(
+                item['sender_blockchain_address'],
+                item['recipient_blockchain_address'],
+                item['value'],
+                item.get('timestamp') or time.time(),
+            )
+            result['transaction_id'] = transaction.transaction_id
+        except (AttributeError, TypeError, ValueError):
+            result['error'] = 'invalid values'
+            continue
+        signing.append((result, item, transaction))
+
+    signatures = get_signer().sign_batch([(item['sender_private_key'], transaction) for _, item, transaction in signing])
+    payloads = []
+    for (result, item, transaction), signature in zip(signing, signatures):
+        if signature is None:
+            result['error'] = 'invalid private key'
+            continue
+        result['signature'] = signature
+        payloads.append((result, {
+            'sender_public_key': item['sender_public_key'],
+            'sender_blockchain_address': transaction.sender_blockchain_address,
+            'recipient_blockchain_address': transaction.recipient_blockchain_address,
+            'value': transaction.value,
+            'signature': signature,
+            'timestamp': transaction.timestamp,
+        }))
+
+    if request_json.get('submit', True):
+        for start in range(0, len(payloads), GATEWAY_BATCH_SIZE):
+            chunk = payloads[start:start + GATEWAY_BATCH_SIZE]
+            try:
+                response = get_gateway().post(
+                    gateway_url('transactions/batch'),
+                    json={'transactions': [payload for _, payload in chunk]},
+                    timeout=GATEWAY_BATCH_TIMEOUT_SEC,
+                )
+                gateway_results = response.json()['results'] if response.status_code == 200 else None
+            except (requests.RequestException, ValueError, KeyError):
+                gateway_results = None
+            for position, (result, _) in enumerate(chunk):
+                if gateway_results is None:
+                    result['accepted'] = False
+                    result['error'] = 'gateway error'
+                else:
+                    result['accepted'] = gateway_results[position]['accepted']
+                    result['error'] = gateway_results[position]['error']
+
+    return jsonify({
+        'message': 'success',
+        'signed': len(payloads),
+        'accepted': sum(1 for result in results if result['accepted']),
+        'results': results,
+    }), 200
 
 # 例えapp.runで分かれている（ポートも異なる）とはいえ、blockchain_server側と同じrouteのpathを書くとrequests.getを行った際にtimeoutが発生するようになる
 @app.route('/wallet/amount', methods=['GET'])
@@ -79,23 +235,82 @@ def calculate_amount():
         return 'Missing values', 400
 
     my_blockchain_address = request.args.get('blockchain_address')
-    response = requests.get(
-        urllib.parse.urljoin(app.config['gw'], 'amount'),
-        {'blockchain_address': my_blockchain_address},
-        timeout=3
+    response = get_gateway().get(
+        gateway_url('amount'),
+        params={'blockchain_address': my_blockchain_address},
+        timeout=GATEWAY_TIMEOUT_SEC,
     )
     if response.status_code == 200:
         total = response.json()['amount']
         return jsonify({'message': 'success', 'amount': total}), 200
     return jsonify({'message': 'fail', 'error': response.content}), 400
 
+@app.route('/wallet/transactions/history', methods=['GET'])
+def transaction_history():
+    # ゲートウェイのアドレスの取引履歴（ページング）をそのまま返す
+    if 'blockchain_address' not in request.args:
+        return 'Missing values', 400
+
+    params = {key: request.args[key] for key in ('blockchain_address', 'before', 'limit') if key in request.args}
+    response = get_gateway().get(gateway_url('transactions/history'), params=params, timeout=GATEWAY_TIMEOUT_SEC)
+    if response.status_code == 200:
+        return jsonify(dict(response.json(), message='success')), 200
+    return jsonify({'message': 'fail', 'error': response.text}), 400
+
+@app.route('/wallet/transaction/verify', methods=['GET'])
+def verify_transaction():
+    # ブロック全体を受け取らずに、マークル証明とブロックヘッダーだけでトランザクションがブロックに含まれたか確認する
+    transaction_id = request.args.get('transaction_id')
+    if not transaction_id:
+        return 'Missing values', 400
+
+    response = get_gateway().get(
+        gateway_url('transactions/proof'),
+        params={'transaction_id': transaction_id},
+        timeout=GATEWAY_TIMEOUT_SEC,
+    )
+    if response.status_code == 404:
+        # まだブロックに含まれていない（トランザクションプールにある）
+        return jsonify({'message': 'success', 'confirmed': False}), 200
+    if response.status_code != 200:
+        return jsonify({'message': 'fail', 'error': response.text}), 400
+
+    # ゲートウェイのレスポンスは信用せず、形式が正しくなければ400を返す
+    try:
+        proof = response.json()
+        header = proof['header']
+        block_hash = models.block_header_hash(header)
+        target = int(header['target'], 16)
+        # - トランザクションIDとマークル証明から計算したルートがヘッダーのマークルルートと一致すること
+        # - ヘッダーのハッシュ値がブロックのハッシュ値と一致し、ヘッダーのtarget以下であること
+        # （targetが難易度の調整の通りかは、前のブロックのヘッダーがないので確認できない。最も易しいtarget以下かだけ確認する）
+        is_valid = merkle.verify_merkle_proof(transaction_id, proof['proof'], header['merkle_root']) and \
+            block_hash == proof['block_hash'] and \
+            target <= difficulty.MAX_TARGET and \
+            int(block_hash, 16) <= target
+        # このブロックの後に何個ブロックが追加されたか（1の場合は最新のブロック）
+        confirmations = proof['length'] - header['index'] + 1
+    except (KeyError, IndexError, TypeError, ValueError, OverflowError):
+        return jsonify({'message': 'fail', 'error': 'invalid proof'}), 400
+    if not is_valid:
+        return jsonify({'message': 'fail', 'error': 'invalid proof'}), 400
+    return jsonify({
+        'message': 'success',
+        'confirmed': True,
+        'block_index': header['index'],
+        'block_hash': block_hash,
+        'confirmations': confirmations,
+    }), 200
+
 if __name__ == '__main__':
     from argparse import ArgumentParser
     parser = ArgumentParser()
     parser.add_argument('-p', '--port', default=8080, type=int, help='port to listen on')
     parser.add_argument('-g', '--gw', default=f'http://{utils.get_host()}:5050', type=str, help='blockchain gateway')
+    parser.add_argument('-w', '--workers', default=None, type=int, help='number of signing and wallet generation processes')
     args = parser.parse_args()
     port = args.port
     app.config['gw'] = args.gw
+    app.config['workers'] = args.workers
 
     app.run(host='0.0.0.0', port=port, threaded=True, debug=True)
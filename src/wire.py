@@ -0,0 +1,326 @@
+import re
+import struct
+import zlib
+
+# ノード間の通信で使うバイナリ形式（Accept・Content-Typeでjsonと切り替える）
+MEDIA_TYPE = 'application/x-blockchain'
+# 複数の値を順番に送るバイナリ形式（/chainのストリーミングで使う）
+STREAM_MEDIA_TYPE = 'application/x-blockchain-stream'
+# 他ノードへのリクエストで使うAccept（バイナリ形式を知らないノードからはjsonが返ってくる）
+ACCEPT = f'{MEDIA_TYPE}, application/json;q=0.9'
+STREAM_ACCEPT = f'{STREAM_MEDIA_TYPE}, application/json;q=0.9'
+# 先頭につけるマジックバイトとバージョン
+MAGIC = b'BC'
+VERSION = 1
+# この大きさ以上のデータはzlibで圧縮する
+COMPRESS_MIN_BYTES = 512
+COMPRESSION_LEVEL = 6
+# ストリーミングのレスポンスを読み込む単位
+STREAM_CHUNK_BYTES = 64 * 1024
+# この長さ以上の小文字のhex（ハッシュ値・署名・publicKey）はバイト列にして半分の大きさで送る
+HEX_MIN_LENGTH = 16
+# 展開後の大きさの上限（ストリーミングでは1つの値ごと）。小さく圧縮された巨大なデータでメモリを使い切らないようにする
+MAX_BODY_BYTES = 64 * 1024 * 1024
+
+FLAG_COMPRESSED = 0x01
+
+# 値の種類
+_NONE = 0
+_FALSE = 1
+_TRUE = 2
+_INT = 3
+_FLOAT = 4
+_STR = 5
+_HEX = 6
+_REF = 7
+_LIST = 8
+_DICT = 9
+
+_HEADER = struct.Struct('>2sBB')
+_DOUBLE = struct.Struct('>d')
+_HEX_PATTERN = re.compile('[0-9a-f]*')
+
+
+class WireError(ValueError):
+    pass
+
+
+def _write_varint(out, number):
+    while number > 0x7f:
+        out.append((number & 0x7f) | 0x80)
+        number >>= 7
+    out.append(number)
+
+
+def _encode(value, strings):
+    """
+    msgpackのように値の種類（1byte）+ 値で書き出す
+    同じ文字列（dictのキー・アドレスなど）は2回目以降は最初に出てきた順番の番号だけを書き出す
+    stringsはストリーミングでは複数の値で共有する
+    """
+    out = bytearray()
+    pack_double = _DOUBLE.pack
+    is_hex = _HEX_PATTERN.fullmatch
+
+    def write_varint(number):
+        _write_varint(out, number)
+
+    def encode_str(text):
+        index = strings.get(text)
+        if index is not None:
+            out.append(_REF)
+            write_varint(index)
+            return
+        strings[text] = len(strings)
+        if len(text) >= HEX_MIN_LENGTH and not len(text) % 2 and is_hex(text):
+            data = bytes.fromhex(text)
+            out.append(_HEX)
+        else:
+            data = text.encode('utf-8')
+            out.append(_STR)
+        write_varint(len(data))
+        out.extend(data)
+
+    def encode(item):
+        if isinstance(item, str):
+            encode_str(item)
+        elif isinstance(item, float):
+            out.append(_FLOAT)
+            out.extend(pack_double(item))
+        elif isinstance(item, dict):
+            out.append(_DICT)
+            write_varint(len(item))
+            for key, child in item.items():
+                encode_str(key)
+                encode(child)
+        elif isinstance(item, (list, tuple)):
+            out.append(_LIST)
+            write_varint(len(item))
+            for child in item:
+                encode(child)
+        elif item is None:
+            out.append(_NONE)
+        elif item is True:
+            out.append(_TRUE)
+        elif item is False:
+            out.append(_FALSE)
+        elif isinstance(item, int):
+            # 負の数も小さい値になるようにzigzagでvarintにする
+            out.append(_INT)
+            write_varint(item << 1 if item >= 0 else (-item << 1) - 1)
+        else:
+            raise WireError(f'unsupported type: {type(item).__name__}')
+
+    encode(value)
+    return bytes(out)
+
+
+def _decode(data, strings):
+    """
+    _encodeで書き出した値を読み込む
+    呼び出し回数が多いので、メソッドではなくローカル変数だけで読み込む
+    """
+    unpack_double = _DOUBLE.unpack_from
+    size = len(data)
+    position = 0
+
+    def read_varint():
+        nonlocal position
+        byte = data[position]
+        position += 1
+        if byte < 0x80:
+            return byte
+        result = byte & 0x7f
+        shift = 7
+        while True:
+            byte = data[position]
+            position += 1
+            result |= (byte & 0x7f) << shift
+            if byte < 0x80:
+                return result
+            shift += 7
+
+    def read_bytes():
+        nonlocal position
+        length = read_varint()
+        start = position
+        position += length
+        if position > size:
+            raise WireError('truncated data')
+        return data[start:position]
+
+    def decode():
+        nonlocal position
+        tag = data[position]
+        position += 1
+        if tag == _STR:
+            value = read_bytes().decode('utf-8')
+            strings.append(value)
+            return value
+        if tag == _REF:
+            return strings[read_varint()]
+        if tag == _DICT:
+            result = {}
+            for _ in range(read_varint()):
+                key = decode()
+                result[key] = decode()
+            return result
+        if tag == _FLOAT:
+            position += 8
+            return unpack_double(data, position - 8)[0]
+        if tag == _INT:
+            value = read_varint()
+            return -((value + 1) >> 1) if value & 1 else value >> 1
+        if tag == _HEX:
+            value = read_bytes().hex()
+            strings.append(value)
+            return value
+        if tag == _LIST:
+            return [decode() for _ in range(read_varint())]
+        if tag == _NONE:
+            return None
+        if tag == _TRUE:
+            return True
+        if tag == _FALSE:
+            return False
+        raise WireError(f'unknown tag: {tag}')
+
+    value = decode()
+    if position != size:
+        raise WireError('trailing data')
+    return value
+
+
+def dumps(value, compress=True):
+    # ヘッダー（マジックバイト・バージョン・フラグ）+ 値（大きい場合はzlibで圧縮）
+    body = _encode(value, {})
+    flags = 0
+    if compress and len(body) >= COMPRESS_MIN_BYTES:
+        body = zlib.compress(body, COMPRESSION_LEVEL)
+        flags |= FLAG_COMPRESSED
+    return _HEADER.pack(MAGIC, VERSION, flags) + body
+
+
+def loads(data):
+    try:
+        magic, version, flags = _HEADER.unpack_from(data)
+    except struct.error:
+        raise WireError('truncated header')
+    if magic != MAGIC or version != VERSION:
+        raise WireError(f'unsupported format: {magic!r} version {version}')
+    body = data[_HEADER.size:]
+    try:
+        if flags & FLAG_COMPRESSED:
+            decompressor = zlib.decompressobj()
+            body = decompressor.decompress(body, MAX_BODY_BYTES)
+            if decompressor.unconsumed_tail:
+                raise WireError('body too large')
+        return _decode(body, [])
+    except (zlib.error, IndexError, TypeError, struct.error, UnicodeDecodeError, RecursionError) as ex:
+        raise WireError(repr(ex))
+
+
+def dump_stream(values):
+    """
+    複数の値を1つずつバイト列にして返すジェネレーター
+    ヘッダー + zlibで圧縮した（長さ + 値）の繰り返し
+    文字列の番号と圧縮の辞書は値をまたいで共有するので、1つずつ送っても全体をまとめた場合と同じくらい小さくなる
+    """
+    strings = {}
+    compressor = zlib.compressobj(COMPRESSION_LEVEL)
+    yield _HEADER.pack(MAGIC, VERSION, FLAG_COMPRESSED)
+    for value in values:
+        body = _encode(value, strings)
+        record = bytearray()
+        _write_varint(record, len(body))
+        record.extend(body)
+        chunk = compressor.compress(bytes(record))
+        if chunk:
+            yield chunk
+    yield compressor.flush()
+
+
+def load_stream(chunks):
+    """
+    dump_streamで書き出したバイト列（chunksは任意の大きさで区切られていてよい）から値を1つずつ返すジェネレーター
+    全体を受け取る前から値を読み込めるので、メモリに保持するのは読み込み途中の1つ分だけ
+    """
+    strings = []
+    header = b''
+    decompressor = None
+    buffer = bytearray()
+    for chunk in chunks:
+        if decompressor is None:
+            header += chunk
+            if len(header) < _HEADER.size:
+                continue
+            magic, version, flags = _HEADER.unpack_from(header)
+            if magic != MAGIC or version != VERSION or not flags & FLAG_COMPRESSED:
+                raise WireError(f'unsupported format: {magic!r} version {version}')
+            decompressor = zlib.decompressobj()
+            chunk = header[_HEADER.size:]
+        while chunk:
+            # 展開するのは読み込み途中の値がMAX_BODY_BYTESになるまで（残りは値を読み込んでから展開する）
+            if len(buffer) >= MAX_BODY_BYTES:
+                raise WireError('record too large')
+            try:
+                buffer.extend(decompressor.decompress(chunk, MAX_BODY_BYTES - len(buffer)))
+            except zlib.error as ex:
+                raise WireError(repr(ex))
+            chunk = decompressor.unconsumed_tail
+
+            while buffer:
+                # 長さ（varint）と値が全て届いていなければ次のchunkを待つ
+                length = 0
+                shift = 0
+                position = 0
+                while position < len(buffer):
+                    byte = buffer[position]
+                    position += 1
+                    length |= (byte & 0x7f) << shift
+                    shift += 7
+                    if byte < 0x80:
+                        break
+                else:
+                    break
+                if len(buffer) < position + length:
+                    break
+                try:
+                    value = _decode(bytes(buffer[position:position + length]), strings)
+                except (IndexError, TypeError, struct.error, UnicodeDecodeError, RecursionError) as ex:
+                    raise WireError(repr(ex))
+                del buffer[:position + length]
+                yield value
+
+    if decompressor is None or buffer or not decompressor.eof:
+        raise WireError('truncated stream')
+
+
+def _mimetype(response):
+    return response.headers.get('Content-Type', '').split(';')[0].strip()
+
+
+def parse_response(response, on_bytes=None):
+    # 他ノードからのレスポンスをContent-Typeに合わせて読み込む
+    # on_bytesには受け取ったバイト数が渡される
+    if on_bytes is not None:
+        on_bytes(len(response.content))
+    if _mimetype(response) == MEDIA_TYPE:
+        return loads(response.content)
+    return response.json()
+
+
+def _count_bytes(chunks, on_bytes):
+    for chunk in chunks:
+        on_bytes(len(chunk))
+        yield chunk
+
+
+def iter_response(response, key, chunk_size=STREAM_CHUNK_BYTES, on_bytes=None):
+    # ストリーミングのレスポンスから値を1つずつ返す（jsonの場合はresponse_json[key]の値）
+    if _mimetype(response) == STREAM_MEDIA_TYPE:
+        chunks = response.iter_content(chunk_size)
+        if on_bytes is not None:
+            chunks = _count_bytes(chunks, on_bytes)
+        return load_stream(chunks)
+    return iter(parse_response(response, on_bytes)[key])
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# src/のモジュールはフラットにimportされる（python src/blockchain_server.py と同じ）
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
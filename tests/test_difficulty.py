@@ -0,0 +1,54 @@
+import pytest
+
+import difficulty
+import models
+
+INTERVAL = difficulty.TARGET_BLOCK_INTERVAL_SEC
+TARGET = 1 << 240
+
+
+def _chain(intervals, target=TARGET, start=1600000000.0):
+    # 最初のブロック（index 1）は間隔の計算に使われない
+    blocks = [models.Block(1, 0.0, [], 0, '0' * 64, difficulty.INITIAL_TARGET)]
+    timestamp = start
+    for index, interval in enumerate(intervals, start=2):
+        timestamp += interval
+        blocks.append(models.Block(index, timestamp, [], 0, '0' * 64, target))
+    return blocks
+
+
+@pytest.mark.parametrize('blocks', [[], _chain([]), _chain([INTERVAL])[:2]])
+def test_initial_target_until_two_blocks(blocks):
+    assert difficulty.next_target(blocks) == difficulty.INITIAL_TARGET
+    assert difficulty.next_target(blocks, 12345) == 12345
+
+
+def test_on_schedule_keeps_target():
+    assert difficulty.next_target(_chain([INTERVAL] * 5)) == TARGET
+
+
+def test_slow_blocks_raise_target():
+    assert difficulty.next_target(_chain([INTERVAL * 2] * 5)) == TARGET * 2
+
+
+def test_fast_blocks_lower_target():
+    assert difficulty.next_target(_chain([INTERVAL / 2] * 5)) == TARGET // 2
+
+
+def test_adjustment_is_clamped():
+    factor = difficulty.MAX_RETARGET_FACTOR
+    assert difficulty.next_target(_chain([INTERVAL * 100] * 5)) == TARGET * factor
+    assert difficulty.next_target(_chain([0] * 5)) == TARGET // factor
+    # 時計が戻ってtimestampが逆順になった場合も最小の倍率にする
+    assert difficulty.next_target(_chain([-INTERVAL] * 5)) == TARGET // factor
+
+
+def test_target_is_clamped_to_range():
+    assert difficulty.next_target(_chain([INTERVAL * 100] * 5, target=difficulty.MAX_TARGET)) == difficulty.MAX_TARGET
+    assert difficulty.next_target(_chain([0] * 5, target=1)) == 1
+
+
+def test_only_recent_window_is_used():
+    window = difficulty.RETARGET_WINDOW_BLOCKS
+    blocks = _chain([INTERVAL * 100] * 20 + [INTERVAL] * window)
+    assert difficulty.next_target(blocks) == TARGET
@@ -0,0 +1,58 @@
+import hashlib
+
+import pytest
+
+import merkle
+
+
+def _ids(count):
+    return [hashlib.sha256(str(i).encode()).hexdigest() for i in range(count)]
+
+
+def test_empty_root():
+    assert merkle.merkle_root([]) == merkle.EMPTY_ROOT
+
+
+def test_single_leaf():
+    ids = _ids(1)
+    assert merkle.merkle_proof(ids, 0) == []
+    assert merkle.verify_merkle_proof(ids[0], [], merkle.merkle_root(ids))
+
+
+@pytest.mark.parametrize('count', [2, 3, 5, 6, 7, 9, 16, 17])
+def test_proof_for_every_position(count):
+    ids = _ids(count)
+    root = merkle.merkle_root(ids)
+    for position, transaction_id in enumerate(ids):
+        proof = merkle.merkle_proof(ids, position)
+        assert merkle.verify_merkle_proof(transaction_id, proof, root)
+        # 他のトランザクションIDでは同じ証明を使えない
+        assert not merkle.verify_merkle_proof(ids[position - 1], proof, root)
+
+
+@pytest.mark.parametrize('count', [3, 5, 7])
+def test_last_leaf_of_odd_level_is_not_duplicated(count):
+    # 奇数個の最後を複製しないので、最後のトランザクションを2回並べたリストとはルートが一致しない
+    ids = _ids(count)
+    assert merkle.merkle_root(ids) != merkle.merkle_root(ids + ids[-1:])
+
+
+def test_root_depends_on_order():
+    ids = _ids(4)
+    assert merkle.merkle_root(ids) != merkle.merkle_root(ids[::-1])
+
+
+def test_position_out_of_range():
+    with pytest.raises(IndexError):
+        merkle.merkle_proof(_ids(3), 3)
+
+
+@pytest.mark.parametrize('proof', [
+    [['up', '00' * 32]],
+    [['left', 'not hex']],
+    [['left']],
+    None,
+])
+def test_malformed_proof(proof):
+    ids = _ids(2)
+    assert not merkle.verify_merkle_proof(ids[0], proof, merkle.merkle_root(ids))
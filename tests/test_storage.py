@@ -0,0 +1,86 @@
+import os
+import struct
+
+import pytest
+
+import blockchain
+import storage
+
+BLOCKS = [{'index': index, 'previous_hash': f'{index:064x}', 'transactions': []} for index in range(1, 6)]
+
+
+@pytest.fixture
+def store(tmp_path):
+    block_store = storage.BlockStore(str(tmp_path))
+    for block in BLOCKS:
+        block_store.append(block)
+    return block_store
+
+
+def test_load(store, tmp_path):
+    assert storage.BlockStore(str(tmp_path)).load() == BLOCKS
+
+
+def test_torn_record_is_dropped(store, tmp_path):
+    # 長さだけ書き込まれて、ブロックの途中で止まった場合
+    size = os.path.getsize(store.log_path)
+    with open(store.log_path, 'ab') as f:
+        f.write(struct.pack('>I', 100) + b'{"index": 6')
+    with open(store.index_path, 'ab') as f:
+        f.write(struct.pack('Q', size))
+
+    reopened = storage.BlockStore(str(tmp_path))
+    assert reopened.load() == BLOCKS
+    assert os.path.getsize(store.log_path) == size
+    reopened.append(BLOCKS[0])
+    assert storage.BlockStore(str(tmp_path)).load() == BLOCKS + BLOCKS[:1]
+
+
+def test_torn_header_is_dropped(store, tmp_path):
+    size = os.path.getsize(store.log_path)
+    with open(store.log_path, 'ab') as f:
+        f.write(b'\x00\x00')
+    assert storage.BlockStore(str(tmp_path)).load() == BLOCKS
+    assert os.path.getsize(store.log_path) == size
+
+
+def test_record_missing_from_index_is_recovered(store, tmp_path):
+    # ブロックは書き込まれたが、インデックスに書き込む前に止まった場合
+    with open(store.index_path, 'r+b') as f:
+        f.truncate(os.path.getsize(store.index_path) - 8 - 3)
+    reopened = storage.BlockStore(str(tmp_path))
+    assert reopened.load() == BLOCKS
+    assert len(reopened) == len(BLOCKS)
+    assert os.path.getsize(store.index_path) == len(BLOCKS) * 8
+
+
+def test_truncate(store, tmp_path):
+    store.truncate(2)
+    assert storage.BlockStore(str(tmp_path)).load() == BLOCKS[:2]
+
+
+@pytest.mark.parametrize('content', ['', '{"length": 3, "ha', '[]', '{"length": "3"}', '{"length": 3}'])
+def test_bad_snapshot_is_rebuilt_from_log(tmp_path, content):
+    chain = blockchain.BlockChain('miner', store=storage.BlockStore(str(tmp_path)), mining_workers=1)
+    for _ in range(3):
+        chain.mining()
+    chain.save_snapshot()
+    balances = dict(chain.ledger.balances)
+    with open(os.path.join(str(tmp_path), storage.SNAPSHOT_FILE), 'w') as f:
+        f.write(content)
+
+    restored = blockchain.BlockChain('miner', store=storage.BlockStore(str(tmp_path)), mining_workers=1)
+    assert len(restored.chain) == len(chain.chain)
+    assert restored.ledger.balances == balances
+    assert restored.snapshot_length == 0
+
+
+def test_snapshot_is_used(tmp_path):
+    chain = blockchain.BlockChain('miner', store=storage.BlockStore(str(tmp_path)), mining_workers=1)
+    for _ in range(3):
+        chain.mining()
+    chain.save_snapshot()
+
+    restored = blockchain.BlockChain('miner', store=storage.BlockStore(str(tmp_path)), mining_workers=1)
+    assert restored.snapshot_length == len(chain.chain)
+    assert restored.ledger.balances == chain.ledger.balances
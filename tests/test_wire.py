@@ -0,0 +1,87 @@
+import struct
+import zlib
+
+import pytest
+
+import wire
+
+VALUES = [
+    None,
+    True,
+    False,
+    0,
+    -1,
+    2 ** 70,
+    1.5,
+    '',
+    'テスト',
+    'ab' * 40,
+    'AB' * 40,
+    [],
+    {},
+    {'chain': [{'index': 1, 'previous_hash': '0' * 64, 'transactions': [{'value': 1.0}] * 50}], 'length': 1},
+]
+
+
+@pytest.mark.parametrize('value', VALUES)
+@pytest.mark.parametrize('compress', [True, False])
+def test_round_trip(value, compress):
+    assert wire.loads(wire.dumps(value, compress=compress)) == value
+
+
+@pytest.mark.parametrize('chunk_size', [1, 7, wire.STREAM_CHUNK_BYTES])
+def test_stream_round_trip(chunk_size):
+    values = [{'index': index, 'hash': f'{index:064x}', 'transactions': ['x'] * index} for index in range(200)]
+    data = b''.join(wire.dump_stream(values))
+    chunks = (data[start:start + chunk_size] for start in range(0, len(data), chunk_size))
+    assert list(wire.load_stream(chunks)) == values
+
+
+def _header(flags=0, magic=wire.MAGIC, version=wire.VERSION):
+    return struct.pack('>2sBB', magic, version, flags)
+
+
+@pytest.mark.parametrize('data', [
+    b'',
+    b'B',
+    _header(magic=b'XX'),
+    _header(version=wire.VERSION + 1),
+    _header(),
+    _header() + bytes([255]),
+    wire.dumps('abcdef')[:-1],
+    wire.dumps([1, 2]) + b'\x00',
+    _header(wire.FLAG_COMPRESSED) + b'not zlib',
+    _header(wire.FLAG_COMPRESSED) + zlib.compress(b'\x00' * 16),
+])
+def test_loads_malformed(data):
+    with pytest.raises(wire.WireError):
+        wire.loads(data)
+
+
+def test_loads_rejects_large_body(monkeypatch):
+    monkeypatch.setattr(wire, 'MAX_BODY_BYTES', 1024)
+    with pytest.raises(wire.WireError):
+        wire.loads(_header(wire.FLAG_COMPRESSED) + zlib.compress(b'\x00' * 4096))
+
+
+def test_load_stream_malformed():
+    data = b''.join(wire.dump_stream([{'a': 1}, {'b': 2}]))
+    with pytest.raises(wire.WireError):
+        list(wire.load_stream([data[:-1]]))
+    with pytest.raises(wire.WireError):
+        list(wire.load_stream([_header(), data[4:]]))
+    with pytest.raises(wire.WireError):
+        list(wire.load_stream([data[:2]]))
+
+
+def test_load_stream_rejects_large_record(monkeypatch):
+    monkeypatch.setattr(wire, 'MAX_BODY_BYTES', 1024)
+    record = bytearray()
+    wire._write_varint(record, 4096)
+    record.extend(b'\x00' * 4096)
+    data = _header(wire.FLAG_COMPRESSED) + zlib.compress(bytes(record))
+    with pytest.raises(wire.WireError):
+        list(wire.load_stream([data]))
+    # 1つの値が上限より小さければ、全体が上限より大きくても読み込める
+    values = [{'value': 'x' * 100}] * 100
+    assert list(wire.load_stream(wire.dump_stream(values))) == values